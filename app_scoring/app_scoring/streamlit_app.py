@@ -1,15 +1,27 @@
+import os
 import pickle
+import sys
 
 import pandas as pd
 import streamlit as st
 from PIL import Image
 
+# Le tableau de bord est déployé depuis ce dépôt (fichier principal app_scoring/app_scoring/streamlit_app.py), les
+# modules de src/ font donc partie du checkout. Les chemins sont pris par rapport à ce fichier et non au répertoire
+# de lancement, qui est la racine du dépôt sur Streamlit Cloud
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../src')))
+from feature_matrix import FeatureMatrix
+from feature_store import FeatureStore
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.abspath(os.path.join(APP_DIRECTORY, '..', '..'))
+
 # Charger le modèle ML
-with open('model.pkl', 'rb') as file:
+with open(os.path.join(APP_DIRECTORY, 'model.pkl'), 'rb') as file:
     model = pickle.load(file)
 
 # Charger l'image
-image = Image.open('Home_Credit_logo.svg.png')
+image = Image.open(os.path.join(APP_DIRECTORY, 'Home_Credit_logo.svg.png'))
 
 # Redimensionner l'image
 new_width = 300  # spécifiez la largeur souhaitée
@@ -19,13 +31,27 @@ resized_image = image.resize((new_width, new_height))
 # Afficher l'image avec Streamlit
 st.image(resized_image, use_column_width=True)
 
-# Charger le dataset de test
-test_data = pd.read_csv('test_data_final.csv', index_col=0)
+
+# Ouvrir le feature store une seule fois pour toutes les sessions, sans charger le dataset. Un répertoire est une
+# matrice de features, mappée en mémoire. Un store absent est publié au premier lancement à partir des features de
+# test du dépôt (FEATURE_TABLE_PATH), Streamlit Cloud n'ayant pas d'étape de construction
+@st.cache_resource
+def open_feature_store():
+    path = os.environ.get("FEATURE_STORE_PATH", os.path.join(APP_DIRECTORY, 'features.sqlite'))
+    if os.path.isdir(path):
+        return FeatureMatrix(path)
+    if not os.path.exists(path):
+        table_path = os.environ.get(
+            "FEATURE_TABLE_PATH", os.path.join(REPOSITORY_DIRECTORY, 'src', 'API', 'test_data_final.csv')
+        )
+        with FeatureStore(path) as store:
+            store.publish(pd.read_csv(table_path, index_col=0), replace=True)
+    return FeatureStore(path, read_only=True)
 
 
 # Fonction pour obtenir les informations du client et faire une prédiction
-def get_client_data(client_id, data):
-    client_data = data[data['SK_ID_CURR'] == client_id]
+def get_client_data(client_id, feature_store):
+    client_data = feature_store.get_frame([client_id])
     if client_data.empty:
         return None
     return client_data
@@ -50,7 +76,7 @@ client_id = st.text_input("Please enter client ID; ex: 100001, 100005")
 
 if client_id:
     client_id = int(client_id)
-    client_data = get_client_data(client_id, test_data)
+    client_data = get_client_data(client_id, open_feature_store())
 
     if client_data is not None:
         st.subheader("Customer's features")
@@ -0,0 +1,119 @@
+"""
+Benchmark of the pandas and polars engines of the preprocess_* classes, at 1x and 10x data scale.
+
+Usage:
+    python benchmarks/backends.py [--rows 1000000] [--customers 100000] [--scales 1 10] [--repeat 3]
+
+For each scale, synthetic credit_card_balance.csv, bureau.csv and bureau_balance.csv tables are written to a
+temporary directory, `--rows` times the scale rows of monthly balances each, and loaded once to warm the columnar
+cache. `preprocess_credit_card_balance` (flat and hierarchical) and `preprocess_bureau_balance_and_bureau` then run
+with each engine, without the stage cache. The script checks that both engines give the same tables and reports
+the best end-to-end time of each.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from datasets.bureau import preprocess_bureau_balance_and_bureau
+from datasets.credit_card_balance import preprocess_credit_card_balance
+
+
+def write_tables(directory: str, rows: int, customers: int):
+    rng = np.random.default_rng(0)
+    loans = max(rows // 20, 1)
+    loan_customers = rng.integers(100_000, 100_000 + customers, loans)
+    loan_ids = rng.integers(0, loans, rows)
+    amounts = rng.gamma(2.0, 5_000, rows)
+    amounts[rng.random(rows) < 0.2] = np.nan
+    pd.DataFrame(
+        {
+            'SK_ID_PREV': 1_000_000 + loan_ids,
+            'SK_ID_CURR': loan_customers[loan_ids],
+            'MONTHS_BALANCE': rng.integers(-96, 0, rows),
+            'AMT_BALANCE': amounts,
+            'AMT_CREDIT_LIMIT_ACTUAL': rng.choice([45_000, 90_000, 135_000, 180_000], rows),
+            'AMT_DRAWINGS_CURRENT': rng.gamma(1.0, 2_000, rows),
+            'AMT_PAYMENT_TOTAL_CURRENT': rng.gamma(1.0, 3_000, rows),
+            'CNT_DRAWINGS_CURRENT': rng.integers(0, 10, rows),
+            'SK_DPD': rng.integers(0, 30, rows),
+            'NAME_CONTRACT_STATUS': rng.choice(['Active', 'Completed', 'Signed', 'Demand'], rows),
+        }
+    ).to_csv(os.path.join(directory, 'credit_card_balance.csv'), index=False)
+
+    credits = max(rows // 10, 1)
+    pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_000 + customers, credits),
+            'SK_ID_BUREAU': np.arange(5_000_000, 5_000_000 + credits),
+            'CREDIT_ACTIVE': rng.choice(['Active', 'Closed', 'Sold', 'Bad debt'], credits),
+            'DAYS_CREDIT': rng.integers(-2_900, 0, credits),
+            'CREDIT_DAY_OVERDUE': rng.integers(0, 30, credits),
+            'AMT_CREDIT_SUM': rng.gamma(2.0, 100_000, credits),
+            'AMT_CREDIT_SUM_DEBT': rng.gamma(2.0, 50_000, credits),
+        }
+    ).to_csv(os.path.join(directory, 'bureau.csv'), index=False)
+    pd.DataFrame(
+        {
+            'SK_ID_BUREAU': 5_000_000 + rng.integers(0, credits, rows),
+            'MONTHS_BALANCE': rng.integers(-60, 0, rows),
+            'STATUS': rng.choice(
+                ['C', '0', 'X', '1', '2', '3', '4', '5'], rows, p=[0.4, 0.3, 0.1, 0.1, 0.04, 0.03, 0.02, 0.01]
+            ),
+        }
+    ).to_csv(os.path.join(directory, 'bureau_balance.csv'), index=False)
+
+
+STAGES = {
+    'credit_card_balance': lambda directory, engine: preprocess_credit_card_balance(
+        file_directory=directory, engine=engine, verbose=False, stage_cache=False
+    ).main(),
+    'credit_card_balance hierarchical': lambda directory, engine: preprocess_credit_card_balance(
+        file_directory=directory, engine=engine, hierarchical=True, verbose=False, stage_cache=False
+    ).main(),
+    'bureau': lambda directory, engine: preprocess_bureau_balance_and_bureau(
+        file_directory=directory, engine=engine, verbose=False, stage_cache=False
+    ).main(),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logger.remove()
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as directory:
+            directory += os.sep
+            write_tables(directory, args.rows * scale, args.customers * scale)
+            print(f'{scale}x: {args.rows * scale} rows, {args.customers * scale} customers')
+            for name, stage in STAGES.items():
+                results, timings = {}, {}
+                for engine in ['pandas', 'polars']:
+                    results[engine] = stage(directory, engine)
+                    timings[engine] = []
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        stage(directory, engine)
+                        timings[engine].append(time.perf_counter() - start)
+                pd.testing.assert_frame_equal(results['pandas'], results['polars'])
+                print(
+                    f'{name:>34}: pandas best {min(timings["pandas"]):.2f}s, '
+                    f'polars best {min(timings["polars"]):.2f}s, result {results["pandas"].shape}'
+                )
+
+
+if __name__ == '__main__':
+    main()
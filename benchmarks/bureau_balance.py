@@ -0,0 +1,126 @@
+"""
+Benchmark of `preprocess_bureau_balance_and_bureau.main()`: bureau_balance joined month by month to bureau, against
+bureau_balance reduced to one row per credit before the join.
+
+Usage:
+    python benchmarks/bureau_balance.py [--credits 300000] [--customers 100000] [--months 40] [--repeat 3]
+
+Synthetic bureau.csv and bureau_balance.csv tables are written to a temporary directory and loaded once to warm the
+columnar cache. The month-by-month version merges bureau into every row of bureau_balance and aggregates that
+expanded table over SK_ID_CURR, as `main()` used to. The per-credit version is the current `main()`. The script
+reports the best end-to-end time and the peak memory allocated (traced with tracemalloc) for each.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from aggregation import category_frequencies, segment_aggregate
+from datasets.bureau import preprocess_bureau_balance_and_bureau
+from raw_tables import read_raw_table
+
+# Statistics of `main()` before bureau_balance was reduced per credit
+MONTHLY_SPEC = {
+    '*': ['mean'],
+    'DAYS_CREDIT': ['mean', 'min', 'max'],
+    'CREDIT_DAY_OVERDUE': ['mean', 'max'],
+    'DAYS_CREDIT_ENDDATE': ['mean', 'min', 'max'],
+    'AMT_CREDIT_MAX_OVERDUE': ['mean', 'max'],
+    'AMT_CREDIT_SUM': ['mean', 'max'],
+    'AMT_CREDIT_SUM_DEBT': ['mean', 'max'],
+    'MONTHS_BALANCE': ['mean', 'min', 'count'],
+}
+MONTHLY_WINDOW_SPEC = {'MONTHS_BALANCE': ['count'], 'CREDIT_DAY_OVERDUE': ['mean'], 'AMT_CREDIT_SUM_DEBT': ['mean']}
+
+
+def write_tables(directory: str, credits: int, customers: int, months: int):
+    rng = np.random.default_rng(0)
+    bureau = pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_000 + customers, credits),
+            'SK_ID_BUREAU': np.arange(5_000_000, 5_000_000 + credits),
+            'CREDIT_ACTIVE': rng.choice(['Active', 'Closed', 'Sold', 'Bad debt'], credits),
+            'CREDIT_CURRENCY': rng.choice(['currency 1', 'currency 2', 'currency 3'], credits),
+            'DAYS_CREDIT': rng.integers(-2_900, 0, credits),
+            'CREDIT_DAY_OVERDUE': rng.integers(0, 30, credits),
+            'DAYS_CREDIT_ENDDATE': rng.integers(-2_900, 30_000, credits).astype(np.float64),
+            'AMT_CREDIT_MAX_OVERDUE': rng.gamma(2.0, 5_000, credits),
+            'AMT_CREDIT_SUM': rng.gamma(2.0, 100_000, credits),
+            'AMT_CREDIT_SUM_DEBT': rng.gamma(2.0, 50_000, credits),
+            'CREDIT_TYPE': rng.choice(['Consumer credit', 'Credit card', 'Car loan', 'Mortgage'], credits),
+        }
+    )
+    bureau.to_csv(os.path.join(directory, 'bureau.csv'), index=False)
+
+    history = rng.integers(1, 2 * months, credits)
+    months_balance = np.concatenate([-np.arange(length) for length in history])
+    statuses = np.array(['C', '0', 'X', '1', '2', '3', '4', '5'])
+    bureau_balance = pd.DataFrame(
+        {
+            'SK_ID_BUREAU': np.repeat(bureau['SK_ID_BUREAU'].to_numpy(), history),
+            'MONTHS_BALANCE': months_balance,
+            'STATUS': statuses[rng.choice(8, len(months_balance), p=[0.4, 0.3, 0.1, 0.1, 0.04, 0.03, 0.02, 0.01])],
+        }
+    )
+    bureau_balance.to_csv(os.path.join(directory, 'bureau_balance.csv'), index=False)
+    return len(bureau_balance)
+
+
+def month_by_month(directory: str) -> pd.DataFrame:
+    bureau_balance = read_raw_table(os.path.join(directory, 'bureau_balance.csv'), dtype_policy='compute')
+    bureau = read_raw_table(os.path.join(directory, 'bureau.csv'), dtype_policy='compute')
+    merged = bureau.merge(bureau_balance, on=['SK_ID_BUREAU'], how='right').drop('SK_ID_BUREAU', axis=1)
+    numerical = segment_aggregate(
+        merged,
+        'SK_ID_CURR',
+        MONTHLY_SPEC,
+        order_by='MONTHS_BALANCE',
+        windows=preprocess_bureau_balance_and_bureau.WINDOWS,
+        window_spec=MONTHLY_WINDOW_SPEC,
+    )
+    return numerical.merge(category_frequencies(merged, 'SK_ID_CURR'), on='SK_ID_CURR')
+
+
+def per_credit(directory: str) -> pd.DataFrame:
+    return preprocess_bureau_balance_and_bureau(file_directory=directory + os.sep, verbose=False).main()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--credits', type=int, default=300_000)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--months', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logger.remove()
+    with tempfile.TemporaryDirectory() as directory:
+        rows = write_tables(directory, args.credits, args.customers, args.months)
+        print(f'{args.credits} credits, {rows} months of bureau_balance, {args.customers} customers')
+        for name, preprocess in [('month by month', month_by_month), ('per credit', per_credit)]:
+            shape = preprocess(directory).shape
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                preprocess(directory)
+                timings.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            preprocess(directory)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f'{name:>14}: best {min(timings):.2f}s, peak {peak / 1024**2:.0f} MB, result {shape}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark of the per-customer category frequencies: dense dummies averaged by groupby against the fused kernel.
+
+Usage:
+    python benchmarks/category_frequencies.py [--rows 2000000] [--customers 300000] [--repeat 3]
+
+A synthetic table shaped like previous_application (a dozen categorical columns, most with a handful of categories
+and a few with several dozens) is aggregated over SK_ID_CURR with `pd.get_dummies(...).groupby().mean()` and with
+`aggregation.category_frequencies`. The script checks that both give the same table and reports the best time and
+the peak memory allocated (traced with tracemalloc) for each.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from aggregation import category_frequencies
+
+
+def make_table(rows: int, customers: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame({'SK_ID_CURR': rng.integers(100_000, 100_000 + customers, rows)})
+    for i, width in enumerate([4, 4, 3, 7, 2, 25, 8, 11, 5, 27, 3, 17]):
+        codes = rng.integers(-1, width, rows).astype(np.int8)
+        table[f'NAME_{i}'] = pd.Categorical.from_codes(codes, [f'value {j}' for j in range(width)])
+    return table
+
+
+def dummies_means(table: pd.DataFrame) -> pd.DataFrame:
+    dummies = pd.get_dummies(table.select_dtypes(['object', 'category']))
+    dummies['SK_ID_CURR'] = table['SK_ID_CURR']
+    return dummies.groupby('SK_ID_CURR').mean().reset_index()
+
+
+def fused(table: pd.DataFrame) -> pd.DataFrame:
+    return category_frequencies(table, 'SK_ID_CURR')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--customers', type=int, default=300_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    table = make_table(args.rows, args.customers)
+    pd.testing.assert_frame_equal(fused(table), dummies_means(table))
+
+    print(f'{args.rows} rows, {args.customers} customers')
+    for name, aggregate in [('dummies', dummies_means), ('fused', fused)]:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            aggregate(table)
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        aggregate(table)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f'{name:>8}: best {min(timings):.2f}s, peak {peak / 1024**2:.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of the per-customer aggregation under each dtype policy ("storage" allows float16, "compute" keeps float32).
+
+Usage:
+    python benchmarks/dtype_policy.py [--rows 5000000] [--customers 300000] [--repeat 3]
+
+For each policy, a synthetic monthly-balance table is downcast with `reduce_memory_usage`, then averaged over
+SK_ID_CURR like the dataset classes do. The script reports the best time, the peak memory allocated during the
+aggregation (traced with tracemalloc) and the largest relative error against a float64 aggregation.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from utils import DTYPE_POLICIES, reduce_memory_usage
+
+
+def make_table(rows: int, customers: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_000 + customers, rows),
+            'MONTHS_BALANCE': rng.integers(-96, 0, rows),
+            'SK_DPD': rng.integers(0, 30, rows),
+        }
+    )
+    # Float columns whose range fits float16, as most of the balance amounts and counts do once downcast
+    for i, scale in enumerate([10, 100, 1_000, 10_000, 50, 5]):
+        values = rng.gamma(2.0, scale / 2, rows)
+        values[rng.random(rows) < 0.1] = np.nan
+        table[f'AMOUNT_{i}'] = values
+    return table
+
+
+def aggregate(table: pd.DataFrame) -> pd.DataFrame:
+    return table.groupby('SK_ID_CURR').mean()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--customers', type=int, default=300_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logger.remove()
+
+    table = make_table(args.rows, args.customers)
+    reference = aggregate(table)
+
+    print(f'{args.rows} rows, {args.customers} customers')
+    for policy in DTYPE_POLICIES:
+        reduced = reduce_memory_usage(table, policy=policy)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            aggregate(reduced)
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        result = aggregate(reduced)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        error = ((result.astype(np.float64) - reference).abs() / reference.abs()).max().max()
+        print(
+            f'{policy:>8}: table {reduced.memory_usage().sum() / 1024**2:.0f} MB, '
+            f'aggregation best {min(timings):.2f}s, peak {peak / 1024**2:.0f} MB, max relative error {error:.1e}'
+        )
+
+
+if __name__ == '__main__':
+    main()
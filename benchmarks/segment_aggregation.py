@@ -0,0 +1,85 @@
+"""
+Benchmark of the multi-statistic per-customer aggregation: `groupby().agg` against `aggregation.segment_aggregate`.
+
+Usage:
+    python benchmarks/segment_aggregation.py [--rows 5000000] [--customers 300000] [--repeat 3]
+
+A synthetic table shaped like credit_card_balance is aggregated over SK_ID_CURR with the default aggregation spec of
+`preprocess_credit_card_balance`, once with the equivalent pandas `agg` dict and once with the sorted-segment engine.
+The script checks that both give the same values and reports the best time of each.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from aggregation import expand_spec, segment_aggregate, statistic_name
+from datasets.credit_card_balance import preprocess_credit_card_balance
+
+
+def make_table(rows: int, customers: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(
+        {
+            'SK_ID_PREV': rng.integers(1_000_000, 2_000_000, rows).astype(np.int32),
+            'SK_ID_CURR': rng.integers(100_000, 100_000 + customers, rows).astype(np.int32),
+            'MONTHS_BALANCE': rng.integers(-96, 0, rows).astype(np.int8),
+            'SK_DPD': rng.integers(0, 30, rows).astype(np.int16),
+            'SK_DPD_DEF': rng.integers(0, 30, rows).astype(np.int16),
+        }
+    )
+    for column in [
+        'AMT_BALANCE',
+        'AMT_CREDIT_LIMIT_ACTUAL',
+        'AMT_DRAWINGS_ATM_CURRENT',
+        'AMT_DRAWINGS_CURRENT',
+        'AMT_PAYMENT_TOTAL_CURRENT',
+        'CNT_DRAWINGS_CURRENT',
+    ]:
+        values = rng.gamma(2.0, 5_000, rows).astype(np.float32)
+        values[rng.random(rows) < 0.2] = np.nan
+        table[column] = values
+    return table
+
+
+def pandas_agg(table: pd.DataFrame, spec: dict) -> pd.DataFrame:
+    expanded = expand_spec(table, spec, 'SK_ID_CURR', exclude=['SK_ID_PREV'])
+    aggregated = table.sort_values('MONTHS_BALANCE', kind='stable').groupby('SK_ID_CURR').agg(expanded)
+    aggregated.columns = [statistic_name(column, statistic) for column, statistic in aggregated.columns]
+    return aggregated.reset_index()
+
+
+def segments(table: pd.DataFrame, spec: dict) -> pd.DataFrame:
+    return segment_aggregate(table, 'SK_ID_CURR', spec, exclude=['SK_ID_PREV'], order_by='MONTHS_BALANCE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--customers', type=int, default=300_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    table = make_table(args.rows, args.customers)
+    spec = preprocess_credit_card_balance.AGGREGATION_SPEC
+    pd.testing.assert_frame_equal(segments(table, spec), pandas_agg(table, spec), check_dtype=False, rtol=1e-4)
+
+    statistics = sum(len(value) for value in expand_spec(table, spec, 'SK_ID_CURR', exclude=['SK_ID_PREV']).values())
+    print(f'{args.rows} rows, {args.customers} customers, {statistics} statistics')
+    for name, aggregate in [('pandas', pandas_agg), ('segments', segments)]:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            aggregate(table, spec)
+            timings.append(time.perf_counter() - start)
+        print(f'{name:>9}: best {min(timings):.2f}s')
+
+
+if __name__ == '__main__':
+    main()
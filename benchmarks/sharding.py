@@ -0,0 +1,67 @@
+"""
+Benchmark of the sharded execution of the preprocess_* classes over SK_ID_CURR, by number of workers.
+
+Usage:
+    python benchmarks/sharding.py [--rows 1000000] [--customers 100000] [--workers 1 2 4 8] [--repeat 3]
+
+Synthetic credit_card_balance.csv, bureau.csv and bureau_balance.csv tables are written to a temporary directory, as
+in benchmarks/backends.py, and loaded once to warm the columnar cache. Each stage then runs whole, then with
+`run_sharded_stage` over as many shards as workers, without the stage cache. The script checks that the sharded
+runs give the same tables and reports the best end-to-end time of each, partitioning included, and its speedup
+over the whole stage. The speedup is bounded by the number of CPUs of the machine.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from loguru import logger
+
+# Add the src directory and the repository to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from backends import write_tables
+from src.pipeline import STAGES, run_sharded_stage
+
+
+def best_time(function, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--customers', type=int, default=100_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logger.remove()
+    with tempfile.TemporaryDirectory() as directory:
+        directory += os.sep
+        write_tables(directory, args.rows, args.customers)
+        print(f'{args.rows} rows, {args.customers} customers, {os.cpu_count()} CPUs')
+        for stage in ['credit_card_balance', 'bureau']:
+            expected, whole = best_time(
+                lambda: STAGES[stage](file_directory=directory, verbose=False, stage_cache=False).main(), args.repeat
+            )
+            print(f'{stage:>20}: whole {whole:.2f}s, result {expected.shape}')
+            for workers in args.workers:
+                result, sharded = best_time(
+                    lambda: run_sharded_stage(stage, directory, shards=workers, workers=workers, verbose=False),
+                    args.repeat,
+                )
+                pd.testing.assert_frame_equal(result, expected)
+                print(f'{workers:>17} workers: {sharded:.2f}s, speedup {whole / sharded:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
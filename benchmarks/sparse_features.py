@@ -0,0 +1,164 @@
+"""
+Memory benchmark of the sparse category frequencies, from the aggregation through the merge to the LightGBM fit.
+
+Usage:
+    python benchmarks/sparse_features.py [--rows 2000000] [--customers 200000] [--categories 50 50 50 50]
+        [--numerical 100] [--estimators 50]
+
+A synthetic table of `--rows` rows over `--customers` customers, with one categorical column per number of
+`--categories`, is aggregated per customer with `category_frequencies`, dense then sparse. Each result is merged by
+`merge_all_tables` with a synthetic application table and `--numerical` dense aggregates, and a LightGBM classifier
+is fitted on the merged training table through `Trainer.define_pipeline`. Each variant runs in its own processes,
+and the script reports the size of the merged table and the peak memory of each step: traced by tracemalloc for
+the aggregation and the merge, and the peak resident memory of a separate process for the fit, LightGBM allocating
+outside of NumPy. The fitted models must give the same predictions.
+"""
+
+import argparse
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the src directory and the repository to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from aggregation import category_frequencies
+from datasets.merge_all_tables import merge_all_tables
+from utils import read_feather, write_feather
+
+
+def traced(function):
+    tracemalloc.start()
+    result = function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak / 1024**2
+
+
+def prepare(args, sparse: bool, directory: str) -> dict:
+    rng = np.random.default_rng(0)
+    ids = np.arange(100_000, 100_000 + args.customers)
+    table = pd.DataFrame({'SK_ID_CURR': rng.choice(ids, args.rows)})
+    for column, categories in enumerate(args.categories):
+        # A few frequent categories and a long tail, as in the competition tables
+        weights = 1 / np.arange(1, categories + 1) ** 1.5
+        table[f'CATEGORY{column}'] = pd.Categorical.from_codes(
+            rng.choice(categories, args.rows, p=weights / weights.sum()), [f'C{i}' for i in range(categories)]
+        )
+
+    frequencies, aggregation_peak = traced(functools.partial(category_frequencies, table, 'SK_ID_CURR', sparse=sparse))
+    del table
+    numerical = pd.DataFrame(
+        rng.normal(size=(len(frequencies), args.numerical)).astype(np.float32),
+        columns=[f'NUMERICAL{i}' for i in range(args.numerical)],
+    )
+    numerical.insert(0, 'SK_ID_CURR', frequencies['SK_ID_CURR'])
+    application = pd.DataFrame(
+        {
+            'SK_ID_CURR': ids,
+            'AMT_CREDIT': rng.gamma(2.0, 100_000, args.customers),
+            'FLAG_OWN_CAR': rng.random(args.customers) < 0.5,
+        }
+    )
+    # The target depends on the most frequent categories, so that the model has something to learn from them
+    target = frequencies.iloc[:, 1].to_numpy() + rng.normal(0, 0.5, len(frequencies)) > 0.8
+    application = application.merge(
+        pd.DataFrame({'SK_ID_CURR': frequencies['SK_ID_CURR'], 'TARGET': target.astype(np.int8)}), how='left'
+    )
+    application['TARGET'] = application['TARGET'].fillna(0).astype(np.int8)
+    n_train = int(args.customers * 0.9)
+
+    (train, _), merge_peak = traced(
+        lambda: merge_all_tables(
+            application.iloc[:n_train],
+            application.iloc[n_train:].drop(columns='TARGET'),
+            numerical,
+            frequencies,
+            numerical.iloc[:0, :1],
+            numerical.iloc[:0, :1],
+            numerical.iloc[:0, :1],
+        )
+    )
+    write_feather(train, os.path.join(directory, 'train.feather'))
+    return {
+        'aggregation_peak_mb': aggregation_peak,
+        'merge_peak_mb': merge_peak,
+        'merged_mb': train.memory_usage().sum() / 1024**2,
+    }
+
+
+def fit(args, sparse: bool, directory: str) -> dict:
+    from lightgbm import LGBMClassifier
+    from sklearn.impute import SimpleImputer
+
+    from trainer import Trainer
+
+    data = read_feather(os.path.join(directory, 'train.feather'))
+    estimator = LGBMClassifier(n_estimators=args.estimators, verbose=-1)
+    trainer = Trainer(
+        data,
+        [SimpleImputer(strategy='median')],
+        [SimpleImputer(strategy='most_frequent')],
+        estimator,
+        'TARGET',
+        sparse=sparse,
+    )
+    del data
+    model = trainer.define_pipeline(
+        trainer.numerical_transformer, trainer.categorical_transformer, estimator, sparse=sparse
+    )
+    model.fit(trainer.x_train, trainer.y_train)
+    np.save(os.path.join(directory, f'predictions_{sparse}.npy'), model.predict_proba(trainer.x_test)[:, 1])
+    # ru_maxrss is in kB on Linux
+    return {'fit_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--customers', type=int, default=200_000)
+    parser.add_argument('--categories', type=int, nargs='+', default=[50, 50, 50, 50])
+    parser.add_argument('--numerical', type=int, default=100)
+    parser.add_argument('--estimators', type=int, default=50)
+    parser.add_argument('--step', choices=['prepare', 'fit'], help=argparse.SUPPRESS)
+    parser.add_argument('--sparse', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logger.remove()
+    if args.step is not None:
+        step = prepare if args.step == 'prepare' else fit
+        print(json.dumps(step(args, args.sparse, args.directory)))
+        return
+
+    print(f'{args.rows} rows, {args.customers} customers, categories {args.categories}, {args.numerical} numerical')
+    with tempfile.TemporaryDirectory() as directory:
+        for sparse in [False, True]:
+            report = {}
+            for step in ['prepare', 'fit']:
+                command = [sys.executable, __file__, *sys.argv[1:], '--step', step, '--directory', directory]
+                output = subprocess.run(command + ['--sparse'] * sparse, capture_output=True, text=True, check=True)
+                report.update(json.loads(output.stdout.splitlines()[-1]))
+            print(
+                f'{"sparse" if sparse else "dense":>6}: merged table {report["merged_mb"]:.0f} MB, '
+                f'aggregation peak {report["aggregation_peak_mb"]:.0f} MB, merge peak {report["merge_peak_mb"]:.0f} MB, '
+                f'fit peak RSS {report["fit_peak_rss_mb"]:.0f} MB'
+            )
+        np.testing.assert_allclose(
+            np.load(os.path.join(directory, 'predictions_True.npy')),
+            np.load(os.path.join(directory, 'predictions_False.npy')),
+            atol=1e-3,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark of the recency-windowed aggregations as the number of windows grows.
+
+Usage:
+    python benchmarks/windowed_aggregation.py [--rows 5000000] [--customers 300000] [--repeat 3]
+
+A synthetic monthly-balance table is aggregated over SK_ID_CURR over its whole history and over 0, 1, 2, 4 and 8
+recency windows of MONTHS_BALANCE, like the dataset classes do. The pandas version groups the table, then filters
+and groups it again for each window. `aggregation.segment_aggregate` sorts the table once and derives every window
+from prefix sums. The script checks that both give the same values and reports the best time of each.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from aggregation import segment_aggregate, statistic_name
+
+WINDOW_SPEC = {'AMT_BALANCE': ['mean', 'sum'], 'SK_DPD': ['mean', 'sum'], 'MONTHS_BALANCE': ['count']}
+
+
+def make_table(rows: int, customers: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    amounts = rng.gamma(2.0, 5_000, rows).astype(np.float32)
+    amounts[rng.random(rows) < 0.2] = np.nan
+    return pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_000 + customers, rows).astype(np.int32),
+            'MONTHS_BALANCE': rng.integers(-96, 0, rows).astype(np.int8),
+            'AMT_BALANCE': amounts,
+            'SK_DPD': rng.integers(0, 30, rows).astype(np.int16),
+        }
+    )
+
+
+def filtered_groupby(table: pd.DataFrame, windows: dict) -> pd.DataFrame:
+    aggregated = [table.groupby('SK_ID_CURR').agg(WINDOW_SPEC)]
+    aggregated[0].columns = [statistic_name(column, statistic) for column, statistic in aggregated[0].columns]
+    for label, lower in windows.items():
+        window = table[table['MONTHS_BALANCE'] >= lower].groupby('SK_ID_CURR').agg(WINDOW_SPEC)
+        window.columns = [statistic_name(column, statistic, label) for column, statistic in window.columns]
+        aggregated.append(window)
+    return pd.concat(aggregated, axis=1)
+
+
+def segments(table: pd.DataFrame, windows: dict) -> pd.DataFrame:
+    return segment_aggregate(
+        table, 'SK_ID_CURR', WINDOW_SPEC, order_by='MONTHS_BALANCE', windows=windows, window_spec=WINDOW_SPEC
+    ).set_index('SK_ID_CURR')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--customers', type=int, default=300_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    table = make_table(args.rows, args.customers)
+    print(f'{args.rows} rows, {args.customers} customers')
+    for n_windows in [0, 1, 2, 4, 8]:
+        windows = {f'{months}M': -months for months in [3, 6, 12, 24, 36, 48, 60, 72][:n_windows]}
+        result = segments(table, windows)
+        expected = filtered_groupby(table, windows).reindex(result.index)
+        # Customers without any row in a window are missing from the filtered groupby
+        pd.testing.assert_frame_equal(
+            result[expected.columns].where(expected.notna()), expected, check_dtype=False, rtol=1e-4
+        )
+
+        line = f'{n_windows} windows:'
+        for name, aggregate in [('filtered groupby', filtered_groupby), ('segments', segments)]:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                aggregate(table, windows)
+                timings.append(time.perf_counter() - start)
+            line += f' {name} {min(timings):.2f}s'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark reading a table out of the competition zip archive: extract-then-read against direct streaming.
+
+Usage:
+    python benchmarks/zip_streaming.py [--rows 2000000] [--repeat 3]
+
+A synthetic POS_CASH_balance-like table is generated and zipped in a temporary directory, so no Kaggle data is
+needed.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the src directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from raw_tables import read_raw_table
+from schemas import load_schema
+
+
+def make_archive(directory: str, rows: int) -> str:
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(
+        {
+            'SK_ID_PREV': rng.integers(1_000_000, 2_000_000, rows),
+            'SK_ID_CURR': rng.integers(100_000, 400_000, rows),
+            'MONTHS_BALANCE': rng.integers(-96, 0, rows),
+            'CNT_INSTALMENT': rng.integers(1, 60, rows).astype(float),
+            'CNT_INSTALMENT_FUTURE': rng.integers(0, 60, rows).astype(float),
+            'NAME_CONTRACT_STATUS': rng.choice(['Active', 'Completed', 'Signed', 'Returned to the store'], rows),
+            'SK_DPD': rng.integers(0, 5, rows),
+            'SK_DPD_DEF': rng.integers(0, 2, rows),
+        }
+    )
+    archive_path = os.path.join(directory, 'home-credit-default-risk.zip')
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('POS_CASH_balance.csv', 'w', force_zip64=True) as f:
+            table.to_csv(f, index=False)
+    return archive_path
+
+
+def extract_then_read(archive_path: str, directory: str) -> pd.DataFrame:
+    with zipfile.ZipFile(archive_path) as archive:
+        file_path = archive.extract('POS_CASH_balance.csv', directory)
+    return read_raw_table(file_path, use_cache=False)
+
+
+def stream_from_archive(archive_path: str) -> pd.DataFrame:
+    return read_raw_table(os.path.join(archive_path, 'POS_CASH_balance.csv'), use_cache=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logger.remove()
+
+    with tempfile.TemporaryDirectory() as directory:
+        archive_path = make_archive(directory, args.rows)
+        member_size = zipfile.ZipFile(archive_path).getinfo('POS_CASH_balance.csv').file_size
+        # Build the schema once, it is shared by both paths since they hold the same content
+        load_schema(os.path.join(archive_path, 'POS_CASH_balance.csv'))
+
+        timings = {'extract then read': [], 'stream from zip': []}
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory(dir=directory) as extract_directory:
+                start = time.perf_counter()
+                extracted = extract_then_read(archive_path, extract_directory)
+                timings['extract then read'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            streamed = stream_from_archive(archive_path)
+            timings['stream from zip'].append(time.perf_counter() - start)
+
+        pd.testing.assert_frame_equal(extracted, streamed)
+
+    print(f'{args.rows} rows, archive member of {member_size / 1024**2:.1f} MB')
+    for name, values in timings.items():
+        extra_disk = member_size if name == 'extract then read' else 0
+        print(f'{name:>20}: best {min(values):.2f}s, extra disk {extra_disk / 1024**2:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@
 PARAMS = {
     'file_directory': "data/home-credit-default-risk/",
     'cleaned_data_directory': "data/home-credit-default-risk/cleaned_data/",
+    # Zip archive or directory holding a copy of the competition files, used instead of the Kaggle API when set
+    'dataset_mirror': None,
 }
 
 MODEL_PARAMS = {
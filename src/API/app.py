@@ -1,4 +1,3 @@
-import pandas as pd
 import pickle
 from flask import Flask, request, jsonify
 import os
@@ -6,7 +5,9 @@ import sys
 
 # Ajoute le répertoire parent du répertoire de votre script au chemin de recherche des modules
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
-from settings.params import MODEL_PARAMS
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../')))
+from feature_matrix import FeatureMatrix
+from feature_store import FeatureStore
 
 
 app = Flask(__name__)
@@ -26,12 +27,15 @@ with open('model.pkl', 'rb') as file:
     model = pickle.load(file)
 
 
-# Charger les données de test (préalablement lues)
-test_data = pd.read_csv('test_data_final.csv', index_col=0)
-
-
-# Filtrer les features selon feature_selection
-feature_selection = MODEL_PARAMS["features_selected"] + ["SK_ID_CURR"]
+# Ouvrir le feature store (publié avec `python src/feature_store.py test_data_final.csv features.sqlite`) : chaque
+# requête lit une seule ligne, et les features republiées sont prises en compte sans redéploiement. Un répertoire
+# est une matrice de features (`python src/feature_matrix.py test_data_final.csv features/`), mappée en mémoire et
+# partagée entre les workers du serveur
+feature_store_path = os.environ.get("FEATURE_STORE_PATH", "features.sqlite")
+if os.path.isdir(feature_store_path):
+    feature_store = FeatureMatrix(feature_store_path)
+else:
+    feature_store = FeatureStore(feature_store_path, read_only=True)
 
 
 @app.route('/')
@@ -39,8 +43,6 @@ def home():
     return "Hello, World!"
 
 
-test_data_filtered = test_data[feature_selection]
-
 # Définir le seuil de décision pour accorder un prêt
 threshold = 0.5
 
@@ -51,7 +53,7 @@ def predict():
     client_id = request.args.get('client_id')
 
     # Extraire les données du client
-    client_data = test_data_filtered[test_data_filtered['SK_ID_CURR'] == int(client_id)]
+    client_data = feature_store.get_frame([int(client_id)])
 
     if client_data.empty:
         return jsonify({'error': 'Client ID not found'}), 404
@@ -0,0 +1,254 @@
+"""Acquisition of the competition files from a pluggable source: the Kaggle API, a local directory or a zip mirror."""
+
+import os
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import IO, Dict, Iterator, List, NamedTuple, Optional
+
+from loguru import logger
+
+COPY_BLOCK_SIZE = 4 * 1024**2
+
+
+class Member(NamedTuple):
+    '''A file offered by a source, with what is needed to tell whether a local copy is up to date.'''
+
+    name: str
+    size: int
+    mtime_ns: int
+    crc32: Optional[int] = None
+
+
+class ChecksumError(IOError):
+    '''Raised when an acquired file does not match the size or checksum announced by its source.'''
+
+
+def file_crc32(file_path: str) -> int:
+    '''Compute the CRC32 of a file, the checksum recorded for each member of a zip archive.'''
+    crc = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def _zip_mtime_ns(info: zipfile.ZipInfo) -> int:
+    return int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+
+
+class ZipMirrorSource:
+    '''
+    Files stored in a local zip archive, such as a copy of the competition archive used as an offline mirror.
+
+    Members are decompressed as a stream, so large members are never staged in memory, and each call to `open`
+    uses its own handle on the archive so that several members can be extracted concurrently.
+
+    Attributes:
+        archive_path (str): Path of the zip archive.
+    '''
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+
+    def members(self) -> Dict[str, Member]:
+        with zipfile.ZipFile(self.archive_path) as archive:
+            return {
+                info.filename: Member(info.filename, info.file_size, _zip_mtime_ns(info), info.CRC)
+                for info in archive.infolist()
+                if not info.is_dir()
+            }
+
+    @contextmanager
+    def open(self, name: str) -> Iterator[IO[bytes]]:
+        with zipfile.ZipFile(self.archive_path) as archive, archive.open(name) as member:
+            yield member
+
+
+class LocalDirectorySource:
+    '''
+    Files stored in a local directory, e.g. a shared copy of the extracted competition data.
+
+    Attributes:
+        directory (str): Directory holding the files.
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def members(self) -> Dict[str, Member]:
+        members = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                members[entry.name] = Member(entry.name, stat.st_size, stat.st_mtime_ns)
+        return members
+
+    def open(self, name: str) -> IO[bytes]:
+        return open(os.path.join(self.directory, name), 'rb')
+
+
+class KaggleSource:
+    '''
+    Files of a Kaggle competition, downloaded with the Kaggle API.
+
+    The competition archive (or the archive of a single file) is downloaded into the target directory, where the
+    Kaggle client resumes interrupted downloads and skips archives that are already up to date. The members are then
+    extracted from it like from a zip mirror. The Kaggle package is only imported here, since it authenticates on
+    import.
+
+    Attributes:
+        competition (str): Name of the Kaggle competition.
+        directory (str): Directory where the archives are downloaded.
+        file_name (str, optional): Single file of the competition to download instead of the whole archive.
+    '''
+
+    def __init__(self, competition: str, directory: str, file_name: Optional[str] = None):
+        self.competition = competition
+        self.directory = directory
+        self.file_name = file_name
+        self._source = None
+
+    def _download(self):
+        from kaggle.api.kaggle_api_extended import KaggleApi
+
+        api = KaggleApi()
+        api.authenticate()
+        logger.info(f"Downloading data for {self.competition} into directory: {self.directory}")
+        if self.file_name is None:
+            api.competition_download_files(self.competition, path=self.directory, quiet=False)
+            downloaded = os.path.join(self.directory, f"{self.competition}.zip")
+        else:
+            api.competition_download_file(self.competition, self.file_name, path=self.directory, quiet=False)
+            downloaded = os.path.join(self.directory, f"{self.file_name}.zip")
+            if not os.path.exists(downloaded):
+                # Small files are served as is rather than zipped, straight to their final location
+                downloaded = os.path.join(self.directory, self.file_name)
+        logger.info("Download successful.")
+
+        if zipfile.is_zipfile(downloaded):
+            return ZipMirrorSource(downloaded)
+        return LocalDirectorySource(self.directory)
+
+    def members(self) -> Dict[str, Member]:
+        if self._source is None:
+            self._source = self._download()
+        members = self._source.members()
+        if isinstance(self._source, LocalDirectorySource):
+            members = {self.file_name: members[self.file_name]}
+        return members
+
+    def open(self, name: str) -> IO[bytes]:
+        return self._source.open(name)
+
+
+def make_source(source, competition: str, directory: str, file_name: Optional[str] = None):
+    '''
+    Build the source to acquire the data from.
+
+    Args:
+        source: None for the Kaggle API, the path of a zip mirror or of a local directory, or a source object.
+        competition (str): Name of the Kaggle competition.
+        directory (str): Directory where the data is acquired.
+        file_name (str, optional): Single file to acquire, for the Kaggle API.
+
+    Returns:
+        The source object.
+    '''
+    if source is None:
+        return KaggleSource(competition, directory, file_name=file_name)
+    if not isinstance(source, str):
+        return source
+    if os.path.isdir(source):
+        return LocalDirectorySource(source)
+    if zipfile.is_zipfile(source):
+        return ZipMirrorSource(source)
+    raise ValueError(f"{source} is neither a directory nor a zip archive.")
+
+
+def is_up_to_date(file_path: str, member: Member) -> bool:
+    '''
+    Tell whether a local file already holds the content of a member.
+
+    Files extracted by `acquire_member` get the modification time of their member, so an unchanged file is recognised
+    from its size and modification time alone. When only the modification time differs, the checksum decides.
+    '''
+    if not os.path.isfile(file_path):
+        return False
+    stat = os.stat(file_path)
+    if stat.st_size != member.size:
+        return False
+    if stat.st_mtime_ns == member.mtime_ns:
+        return True
+    if member.crc32 is None or file_crc32(file_path) != member.crc32:
+        return False
+    os.utime(file_path, ns=(stat.st_atime_ns, member.mtime_ns))
+    return True
+
+
+def acquire_member(source, member: Member, directory: str) -> str:
+    '''
+    Copy a member of a source into a directory, verifying its size and checksum.
+
+    The member is streamed block by block into a temporary file, which only replaces the target once verified, so an
+    interrupted acquisition never leaves a truncated file behind.
+
+    Args:
+        source: Source of the member.
+        member (Member): Member to copy.
+        directory (str): Target directory.
+
+    Returns:
+        str: Path of the acquired file.
+    '''
+    file_path = os.path.join(directory, member.name)
+    if is_up_to_date(file_path, member):
+        logger.info(f"{member.name} is already up to date, skipping.")
+        return file_path
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    crc, size = 0, 0
+    try:
+        with source.open(member.name) as src, open(tmp_path, 'wb') as dst:
+            for block in iter(lambda: src.read(COPY_BLOCK_SIZE), b''):
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                dst.write(block)
+        if size != member.size or (member.crc32 is not None and crc != member.crc32):
+            raise ChecksumError(f"{member.name} does not match the size or checksum of its source.")
+        os.utime(tmp_path, ns=(time.time_ns(), member.mtime_ns))
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    logger.info(f"{member.name} extracted ({size} bytes)")
+    return file_path
+
+
+def acquire(source, directory: str, file_names: Optional[List[str]] = None, workers: Optional[int] = None) -> List[str]:
+    '''
+    Acquire files from a source into a directory, in parallel.
+
+    Args:
+        source: Source object, see `make_source`.
+        directory (str): Target directory.
+        file_names (List[str], optional): Files to acquire. Defaults to all the files of the source.
+        workers (int, optional): Number of files copied concurrently. Defaults to the number of CPUs.
+
+    Returns:
+        List[str]: Paths of the acquired files.
+    '''
+    members = source.members()
+    if file_names is not None:
+        missing = [name for name in file_names if name not in members]
+        if missing:
+            raise FileNotFoundError(f"Files missing from the source: {missing}")
+        members = {name: members[name] for name in file_names}
+
+    workers = workers or min(len(members), os.cpu_count() or 1) or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda member: acquire_member(source, member, directory), members.values()))
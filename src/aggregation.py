@@ -0,0 +1,967 @@
+"""Aggregation kernels and mergeable aggregation state used to compute the per-customer features."""
+
+import json
+import os
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+STATISTICS = ('mean', 'sum', 'count', 'min', 'max', 'std', 'var', 'first', 'last')
+# Statistics available over recency windows, which all derive from sums and counts over the tail of each segment
+WINDOW_STATISTICS = ('mean', 'sum', 'count')
+# Key of an aggregation spec standing for every numerical column that is not listed explicitly
+OTHER_COLUMNS = '*'
+
+
+def _mean_dtype(dtype: np.dtype) -> np.dtype:
+    # Same rules as `groupby().mean()`: float32 and float64 are kept, float16 is averaged in float32, and
+    # everything else in float64
+    if dtype == np.float16:
+        return np.dtype(np.float32)
+    return dtype if pd.api.types.is_float_dtype(dtype) else np.dtype(np.float64)
+
+
+def _statistic_dtype(dtype: np.dtype, statistic: str) -> np.dtype:
+    if statistic == 'count':
+        return np.dtype(np.int64)
+    if statistic in ('min', 'max', 'first', 'last'):
+        return dtype
+    if statistic == 'sum' and not pd.api.types.is_float_dtype(dtype):
+        return np.dtype(np.int64)
+    return _mean_dtype(dtype)
+
+
+def _narrow_half(means: np.ndarray) -> np.ndarray:
+    # `groupby().mean()` narrows float16 columns back only when no mean loses precision
+    half = means.astype(np.float16)
+    return half if np.array_equal(half.astype(np.float32), means, equal_nan=True) else means
+
+
+def _categorical(values: pd.Series) -> pd.Categorical:
+    return values.array if isinstance(values.dtype, pd.CategoricalDtype) else pd.Categorical(values)
+
+
+def _category_counts(groups: np.ndarray, n_groups: int, codes: np.ndarray, width: int) -> np.ndarray:
+    # Number of rows of each category in each group, out of a single `np.bincount` of the combined codes. Rows with
+    # a missing group or category are left out
+    observed = (groups >= 0) & (codes >= 0)
+    return np.bincount(groups[observed].astype(np.int64) * width + codes[observed], minlength=n_groups * width).reshape(
+        n_groups, width
+    )
+
+
+def category_frequencies(
+    table: pd.DataFrame,
+    key: str,
+    categories: Optional[Dict[str, Optional[Sequence[str]]]] = None,
+    sparse: bool = False,
+) -> pd.DataFrame:
+    '''
+    Compute the frequency of each category of the categorical columns of a table within each group.
+
+    Returns the same table as `pd.get_dummies(table.select_dtypes(['object', 'category']))` grouped by `key` and
+    averaged, but the row-level dummies are never built: the category codes of each column are combined with the
+    group codes and counted with one `np.bincount` per column, so the memory used is close to that of the result.
+
+    Args:
+        table (pd.DataFrame): Rows of the table.
+        key (str): Column to group by. Rows with a missing key are left out, like with `groupby`.
+        categories (Dict[str, Optional[Sequence[str]]], optional): Categories whose frequencies are computed, by
+            column, None standing for all the categories of a column. The columns left out are not counted.
+            Defaults to all the categories of every categorical column.
+        sparse (bool): Whether to return the frequencies as sparse columns, 0 being left implicit. Each row has
+            one category per column, so most frequencies are 0: they are then counted into a CSR matrix of the
+            nonzero ones, and the dense table of the groups and categories is never built.
+
+    Returns:
+        pd.DataFrame: Frequencies of each category, with the group key as first column, sorted by key.
+    '''
+    groups, group_keys = pd.factorize(table[key], sort=True)
+    valid = groups >= 0
+    sizes = np.bincount(groups[valid], minlength=len(group_keys))
+
+    categoricals = {}
+    for column in table.select_dtypes(['object', 'category']).columns.drop(key, errors='ignore'):
+        if categories is not None and column not in categories:
+            continue
+        categorical = _categorical(table[column])
+        if categories is not None and categories[column] is not None:
+            # The other categories are coded as missing, so that they are not counted
+            kept = set(categories[column])
+            categorical = categorical.set_categories([c for c in categorical.categories if c in kept])
+        categoricals[column] = categorical
+
+    names = [
+        f'{column}_{category}' for column, categorical in categoricals.items() for category in categorical.categories
+    ]
+    if sparse:
+        blocks = []
+        for categorical in categoricals.values():
+            observed = valid & (categorical.codes >= 0)
+            # Each row adds 1 / the size of its group, the duplicated entries being summed into the frequencies
+            entries = 1 / sizes[groups[observed]], (groups[observed], categorical.codes[observed])
+            blocks.append(scipy.sparse.csr_matrix(entries, shape=(len(group_keys), len(categorical.categories))))
+        frequencies = (
+            scipy.sparse.hstack(blocks, format='csr') if blocks else scipy.sparse.csr_matrix((len(group_keys), 0))
+        )
+        result = pd.DataFrame.sparse.from_spmatrix(frequencies, columns=names)
+        result.insert(0, key, group_keys)
+        return result
+
+    frequencies = np.empty((len(group_keys), len(names)))
+    position = 0
+    for categorical in categoricals.values():
+        width = len(categorical.categories)
+        counts = _category_counts(groups, len(group_keys), categorical.codes, width)
+        np.divide(counts, sizes[:, None], out=frequencies[:, position : position + width])
+        position += width
+
+    result = pd.DataFrame(frequencies, columns=names, copy=False)
+    result.insert(0, key, group_keys)
+    return result
+
+
+def statistic_name(column: str, statistic: str, window: Optional[str] = None) -> str:
+    '''
+    Name of an aggregated column: the column itself for its mean over all the rows, suffixed with the statistic
+    otherwise, and with the label of the window for statistics over a recency window.
+    '''
+    if window is not None:
+        return f'{column}_{statistic.upper()}_{window}'
+    return column if statistic == 'mean' else f'{column}_{statistic.upper()}'
+
+
+def spec_statistics(spec: Dict[str, Sequence[str]]) -> set:
+    '''Return the set of statistics requested by an aggregation spec.'''
+    return {statistic for statistics in spec.values() for statistic in statistics}
+
+
+def expand_spec(
+    table: pd.DataFrame, spec: Dict[str, Sequence[str]], key: str, exclude: Sequence[str] = ()
+) -> Dict[str, List[str]]:
+    '''
+    Resolve an aggregation spec against the numerical columns of a table.
+
+    Args:
+        table (pd.DataFrame): Table to aggregate.
+        spec (Dict[str, Sequence[str]]): Statistics to compute for each column. The `OTHER_COLUMNS` entry applies to
+            the numerical columns not listed. Columns missing from the table are ignored.
+        key (str): Column to group by, never aggregated.
+        exclude (Sequence[str]): Numerical columns left out of the aggregation.
+
+    Returns:
+        Dict[str, List[str]]: Statistics of each aggregated column, in the order of the table.
+    '''
+    unknown = spec_statistics(spec) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f"Unknown statistics {sorted(unknown)}, expected some of {STATISTICS}.")
+
+    expanded = {}
+    for column in table.select_dtypes(include=[np.number]).columns:
+        if column == key or column in exclude:
+            continue
+        statistics = spec.get(column, spec.get(OTHER_COLUMNS, ()))
+        if statistics:
+            expanded[column] = list(statistics)
+    return expanded
+
+
+def _range_sums(padded: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # Sums of padded[start:end] for each pair of bounds, at the even positions of a single `reduceat` over the
+    # interleaved bounds. The values end with a padding 0, so that a range ending on the last row has a valid index
+    if len(starts) == 0:
+        return np.zeros(0)
+    sums = np.add.reduceat(padded, np.column_stack([starts, ends]).ravel())[::2]
+    # `reduceat` gives the value at the start of an empty range instead of 0
+    sums[starts == ends] = 0
+    return sums
+
+
+def _radix_argsort(codes: np.ndarray) -> np.ndarray:
+    # Stable argsort of non-negative integer codes, one 16-bit digit at a time: numpy sorts 16-bit integers with a
+    # radix sort, which is linear, where wider integers go through a comparison sort
+    codes = codes.astype(np.uint64, copy=False)
+    permutation = np.argsort(codes.astype(np.uint16), kind='stable')
+    shift = np.uint64(16)
+    while len(codes) and codes.max() >> shift:
+        digits = (codes >> shift).astype(np.uint16)
+        permutation = permutation[np.argsort(digits[permutation], kind='stable')]
+        shift += np.uint64(16)
+    return permutation
+
+
+class SortedSegments:
+    '''
+    Rows of a table sorted once by their group key, so that each group is a contiguous segment.
+
+    The sort permutation is computed once, with a linear radix sort of the group codes. Each column is then gathered
+    in that order with `take`, and all its statistics are `ufunc.reduceat` calls over the segment boundaries that
+    share their intermediate sums and counts, instead of the separate reduction `groupby().agg` runs for each
+    statistic. Rows with a missing key are left out, like with `groupby`.
+
+    When an order column is given, the rows of each segment are sorted by it as well, so that the rows whose order
+    value is above a threshold, such as the last months of a balance history, are the tail of the segment. The
+    counts and integer sums over such recency windows are then differences of prefix sums, computed once per column
+    whatever the number of windows, and the float sums one `reduceat` over the window bounds each.
+
+    Attributes:
+        group_keys (pd.Index): Sorted distinct keys, one per segment.
+        permutation (np.ndarray): Positions of the rows of the table in the sorted order.
+        sizes (np.ndarray): Number of rows of each segment.
+        starts (np.ndarray): Position of the first row of each segment in the sorted order.
+    '''
+
+    def __init__(self, keys: pd.Series, order: Optional[pd.Series] = None):
+        groups, self.group_keys = pd.factorize(keys, sort=True)
+        codes = groups.astype(np.int64)
+        if order is not None:
+            # Rows of a segment follow the order column, with its missing values last
+            ranks, self._order_values = pd.factorize(order, sort=True)
+            ranks[ranks < 0] = len(self._order_values)
+            codes = codes * (len(self._order_values) + 1) + ranks
+        valid = groups >= 0
+        if valid.all():
+            self.permutation = _radix_argsort(codes)
+        else:
+            self.permutation = np.flatnonzero(valid)[_radix_argsort(codes[valid])]
+        self.sizes = np.bincount(groups[valid], minlength=len(self.group_keys))
+        self.starts = np.cumsum(self.sizes) - self.sizes
+        self._sorted_codes = codes[self.permutation] if order is not None else None
+        self._window_ends = None
+
+    def window(self, lower: float) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Locate the rows of each segment whose order value is at least `lower`, missing order values excluded.
+
+        Args:
+            lower (float): Smallest order value in the window, e.g. -12 on MONTHS_BALANCE for the last 12 months.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Sorted positions where the window of each segment starts and ends.
+        '''
+        if self._sorted_codes is None:
+            raise ValueError('Recency windows need the rows to be sorted by an order column.')
+        bases = np.arange(len(self.group_keys), dtype=np.int64) * (len(self._order_values) + 1)
+        if self._window_ends is None:
+            # Windows end before the rows whose order value is missing, whatever their lower bound
+            self._window_ends = np.searchsorted(self._sorted_codes, bases + len(self._order_values))
+        lower_rank = np.searchsorted(self._order_values, lower, side='left')
+        return np.searchsorted(self._sorted_codes, bases + lower_rank), self._window_ends
+
+    def take(self, values: np.ndarray) -> np.ndarray:
+        '''Gather the values of a column in the sorted order.'''
+        return np.take(values, self.permutation)
+
+    def reduce(self, values: np.ndarray, statistics: Sequence[str]) -> Dict[str, np.ndarray]:
+        '''
+        Compute statistics over each segment, skipping missing values like the `groupby` reductions do.
+
+        Args:
+            values (np.ndarray): Values of a column, gathered with `take`.
+            statistics (Sequence[str]): Some of `STATISTICS`.
+
+        Returns:
+            Dict[str, np.ndarray]: One value per segment for each statistic. Sums and counts of integer columns are
+                int64, means, variances and standard deviations are float64, and the other statistics keep the dtype
+                of the values.
+        '''
+        if len(self.starts) == 0:
+            return {statistic: np.empty(0, dtype=_statistic_dtype(values.dtype, statistic)) for statistic in statistics}
+        present = ~np.isnan(values) if values.dtype.kind == 'f' else None
+        results = {}
+        for statistic in statistics:
+            if statistic in results:
+                continue
+            if statistic in ('min', 'max'):
+                results[statistic] = (np.fmin if statistic == 'min' else np.fmax).reduceat(values, self.starts)
+            elif statistic in ('first', 'last'):
+                results[statistic] = self._first_or_last(values, present, statistic)
+            elif statistic == 'count':
+                results[statistic] = self._counts(present)
+            elif statistic == 'sum' and present is None:
+                results[statistic] = np.add.reduceat(values, self.starts, dtype=np.int64)
+            else:
+                results.update(self._moments(values, present, statistics))
+        return {statistic: results[statistic] for statistic in statistics}
+
+    def reduce_windows(
+        self, values: np.ndarray, statistics: Sequence[str], windows: Dict[str, Tuple[np.ndarray, np.ndarray]]
+    ) -> Dict[Tuple[str, str], np.ndarray]:
+        '''
+        Compute statistics over recency windows of each segment, without filtering the values.
+
+        Counts and integer sums are differences of one prefix sum, which are exact. Float sums are taken over each
+        window directly: differences of float prefix sums lose the precision of the small windows that come after
+        large amounts in the table.
+
+        Args:
+            values (np.ndarray): Values of a column, gathered with `take`.
+            statistics (Sequence[str]): Some of `WINDOW_STATISTICS`.
+            windows (Dict[str, Tuple[np.ndarray, np.ndarray]]): Bounds of each window, as returned by `window`.
+
+        Returns:
+            Dict[Tuple[str, str], np.ndarray]: One value per segment for each window label and statistic. Segments
+                without any row in a window get a count and sum of 0, and a missing mean.
+        '''
+        present = ~np.isnan(values) if values.dtype.kind == 'f' else None
+        prefix_counts = None
+        if present is not None:
+            prefix_counts = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(present, out=prefix_counts[1:])
+        needs_sums = 'sum' in statistics or 'mean' in statistics
+        prefix_sums = filled = None
+        if needs_sums and present is None:
+            prefix_sums = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(values, dtype=np.int64, out=prefix_sums[1:])
+        elif needs_sums:
+            # Padded so that the windows ending on the last row have a valid end index for `reduceat`
+            filled = np.zeros(len(values) + 1)
+            np.copyto(filled[:-1], values, where=present)
+
+        results = {}
+        for label, (starts, ends) in windows.items():
+            counts = ends - starts if prefix_counts is None else prefix_counts[ends] - prefix_counts[starts]
+            sums = None
+            if prefix_sums is not None:
+                sums = prefix_sums[ends] - prefix_sums[starts]
+            elif filled is not None:
+                sums = _range_sums(filled, starts, ends)
+            for statistic in statistics:
+                if statistic == 'count':
+                    results[label, statistic] = counts
+                elif statistic == 'sum':
+                    results[label, statistic] = sums
+                else:
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        results[label, statistic] = sums / counts
+        return results
+
+    def streaks(self, flags: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Measure the runs of consecutive rows flagged within each segment, such as months past due in a history.
+
+        Args:
+            flags (np.ndarray): Boolean flag of each row, gathered with `take`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Length of the longest run of each segment, and of the run ending on its
+                last row, 0 when that row is not flagged.
+        '''
+        if len(self.starts) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        flagged = np.cumsum(flags, dtype=np.int64)
+        # Runs start over after each row not flagged and at each segment start: the number of flagged rows before
+        # the current run is carried forward from there, as a running maximum since the cumulative sum only grows
+        resets = ~flags
+        resets[self.starts] = True
+        before = np.maximum.accumulate(np.where(resets, flagged - flags, 0))
+        lengths = flagged - before
+        return np.maximum.reduceat(lengths, self.starts), lengths[self.starts + self.sizes - 1]
+
+    def _counts(self, present: Optional[np.ndarray]) -> np.ndarray:
+        return self.sizes if present is None else np.add.reduceat(present, self.starts, dtype=np.int64)
+
+    def _first_or_last(self, values: np.ndarray, present: Optional[np.ndarray], statistic: str) -> np.ndarray:
+        if present is None:
+            return values[self.starts if statistic == 'first' else self.starts + self.sizes - 1]
+        index = np.arange(len(values))
+        if statistic == 'first':
+            positions = np.minimum.reduceat(np.where(present, index, len(values)), self.starts)
+            found = positions < len(values)
+        else:
+            positions = np.maximum.reduceat(np.where(present, index, -1), self.starts)
+            found = positions >= 0
+        result = np.full(len(self.starts), np.nan, dtype=values.dtype)
+        result[found] = values[positions[found]]
+        return result
+
+    def _moments(self, values: np.ndarray, present: Optional[np.ndarray], statistics: Sequence[str]) -> dict:
+        # Sums, means and variances are computed in float64 whatever the dtype of the values
+        filled = values.astype(np.float64)
+        if present is not None:
+            filled[~present] = 0
+        counts = self._counts(present)
+        moments = {'sum': np.add.reduceat(filled, self.starts)}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            moments['mean'] = moments['sum'] / counts
+            if 'var' in statistics or 'std' in statistics:
+                # Two passes, centering on the segment means, so that large amounts do not lose the variance
+                filled -= np.repeat(moments['mean'], self.sizes)
+                if present is not None:
+                    filled[~present] = 0
+                moments['var'] = np.add.reduceat(filled * filled, self.starts) / (counts - 1)
+                moments['var'][counts < 2] = np.nan
+                moments['std'] = np.sqrt(moments['var'])
+        return moments
+
+
+def _check_windows(windows: Optional[Dict[str, float]], window_spec: Optional[dict], order_by: Optional[str]):
+    windows = windows or {}
+    window_spec = window_spec or {}
+    unsupported = spec_statistics(window_spec) - set(WINDOW_STATISTICS)
+    if unsupported:
+        raise ValueError(f"Statistics {sorted(unsupported)} are not available over windows, only {WINDOW_STATISTICS}.")
+    if windows and window_spec and order_by is None:
+        raise ValueError('Recency windows need an order_by column.')
+    return windows, window_spec
+
+
+def segment_aggregate(
+    table: pd.DataFrame,
+    key: str,
+    spec: Dict[str, Sequence[str]],
+    exclude: Sequence[str] = (),
+    order_by: Optional[str] = None,
+    windows: Optional[Dict[str, float]] = None,
+    window_spec: Optional[Dict[str, Sequence[str]]] = None,
+    segments: Optional[SortedSegments] = None,
+) -> pd.DataFrame:
+    '''
+    Compute several statistics of the numerical columns of a table per group, out of a single sort of the table.
+
+    Returns the same values as `table.groupby(key).agg(...)` with the statistics of the spec, up to rounding, with
+    the result dtypes of the `groupby` reductions, except for the sums of integer columns which are int64. The
+    statistics of `window_spec` are computed as well over each recency window, as `groupby` would on the rows of
+    the table with `order_by` at least the lower bound of the window, without filtering the table once per window.
+
+    Args:
+        table (pd.DataFrame): Rows of the table.
+        key (str): Column to group by.
+        spec (Dict[str, Sequence[str]]): Statistics to compute for each column, see `expand_spec`.
+        exclude (Sequence[str]): Numerical columns left out of the aggregation.
+        order_by (str, optional): Column ordering the rows within each group, for the "first" and "last"
+            statistics and the recency windows. Defaults to the order of the table.
+        windows (Dict[str, float], optional): Lower bound of `order_by` of each recency window, by window label,
+            e.g. {'12M': -12} on MONTHS_BALANCE.
+        window_spec (Dict[str, Sequence[str]], optional): Statistics to compute over each window for each column,
+            among `WINDOW_STATISTICS`. Defaults to no windowed statistics.
+        segments (SortedSegments, optional): Rows of the table already sorted by `key` and `order_by`, to share the
+            sort with other reductions of the same segments. Sorted here by default.
+
+    Returns:
+        pd.DataFrame: One row per group sorted by key, with the key as first column followed by the statistics of
+            each column, named with `statistic_name`.
+    '''
+    windows, window_spec = _check_windows(windows, window_spec, order_by)
+    if segments is None:
+        segments = SortedSegments(table[key], None if order_by is None else table[order_by])
+    aggregated = _aggregate_segments(segments, table, spec, key, exclude, windows, window_spec)
+    return pd.DataFrame({key: segments.group_keys, **aggregated})
+
+
+def _aggregate_segments(
+    segments: SortedSegments,
+    table: pd.DataFrame,
+    spec: Dict[str, Sequence[str]],
+    key: str,
+    exclude: Sequence[str],
+    windows: Dict[str, float],
+    window_spec: Dict[str, Sequence[str]],
+    name: Callable[..., str] = statistic_name,
+) -> Dict[str, np.ndarray]:
+    expanded = expand_spec(table, spec, key, exclude)
+    windowed = expand_spec(table, window_spec, key, exclude) if windows else {}
+    bounds = {label: segments.window(lower) for label, lower in windows.items()} if windowed else {}
+
+    aggregated = {}
+    for column in table.columns:
+        if column not in expanded and column not in windowed:
+            continue
+        dtype = table[column].dtype
+        values = segments.take(table[column].to_numpy())
+        for statistic, result in segments.reduce(values, expanded.get(column, [])).items():
+            result = result.astype(_statistic_dtype(dtype, statistic), copy=False)
+            if statistic == 'mean' and dtype == np.float16:
+                result = _narrow_half(result)
+            aggregated[name(column, statistic)] = result
+        if column in windowed:
+            for (label, statistic), result in segments.reduce_windows(values, windowed[column], bounds).items():
+                result = result.astype(_statistic_dtype(dtype, statistic), copy=False)
+                aggregated[name(column, statistic, label)] = result
+    return aggregated
+
+
+def hierarchical_aggregate(
+    table: pd.DataFrame,
+    key: str,
+    inner_key: str,
+    inner_spec: Dict[str, Sequence[str]],
+    spec: Dict[str, Sequence[str]],
+    exclude: Sequence[str] = (),
+    order_by: Optional[str] = None,
+    windows: Optional[Dict[str, float]] = None,
+    window_spec: Optional[Dict[str, Sequence[str]]] = None,
+) -> pd.DataFrame:
+    '''
+    Aggregate a table over two nested levels: first per inner group, such as a loan, then per group, such as the
+    customer holding the loans.
+
+    The rows are sorted once by inner key and reduced to one row of statistics per inner group, as with
+    `segment_aggregate`. Those per-loan statistics, a table with one row per loan, are then aggregated per key with
+    `spec`, so that every loan weighs the same in the customer statistics however long its history is.
+
+    Args:
+        table (pd.DataFrame): Rows of the table.
+        key (str): Outer group column, e.g. SK_ID_CURR.
+        inner_key (str): Inner group column, e.g. SK_ID_PREV. Each inner group belongs to a single outer group.
+        inner_spec (Dict[str, Sequence[str]]): Statistics of each column per inner group, see `expand_spec`.
+        spec (Dict[str, Sequence[str]]): Statistics of each inner statistic per outer group, keyed by the names of
+            the inner statistics given by `statistic_name`.
+        exclude (Sequence[str]): Numerical columns left out of the aggregation.
+        order_by (str, optional): Column ordering the rows within each inner group, see `segment_aggregate`.
+        windows (Dict[str, float], optional): Recency windows of the inner level, see `segment_aggregate`.
+        window_spec (Dict[str, Sequence[str]], optional): Statistics over the windows of the inner level.
+
+    Returns:
+        pd.DataFrame: One row per outer group sorted by key, with the key as first column, the number of inner
+            groups, and each statistic of `spec` named `<inner statistic>_<STATISTIC>`.
+    '''
+    windows, window_spec = _check_windows(windows, window_spec, order_by)
+    segments = SortedSegments(table[inner_key], None if order_by is None else table[order_by])
+    inner = _aggregate_segments(segments, table, inner_spec, inner_key, [key, *exclude], windows, window_spec)
+    # The outer key of each inner group, read on its first row
+    inner = pd.DataFrame({key: table[key].to_numpy()[segments.permutation[segments.starts]], **inner})
+
+    outer_segments = SortedSegments(inner[key])
+    aggregated = _aggregate_segments(
+        outer_segments, inner, spec, key, (), {}, {}, name=lambda column, statistic: f'{column}_{statistic.upper()}'
+    )
+    counts = {statistic_name(inner_key, 'count'): outer_segments.sizes}
+    return pd.DataFrame({key: outer_segments.group_keys, **counts, **aggregated})
+
+
+# Fields of the per-group state of `IncrementalAggregator` that each statistic is computed from
+STATE_FIELDS = {
+    'mean': ('count', 'sum'),
+    'sum': ('sum',),
+    'count': ('count',),
+    'min': ('min',),
+    'max': ('max',),
+    'std': ('count', 'sum', 'm2'),
+    'var': ('count', 'sum', 'm2'),
+    'first': ('first', 'first_order'),
+    'last': ('last', 'last_order'),
+}
+WINDOW_STATE_FIELDS = {'mean': ('count', 'sum'), 'sum': ('sum',), 'count': ('count',)}
+# Name of the state column holding the number of rows of each group
+SIZE_FIELD = '|size'
+
+
+def _state_field(column: str, field: str) -> str:
+    return f'{column}|{field}'
+
+
+class IncrementalAggregator:
+    '''
+    Mergeable per-group state of the statistics of `segment_aggregate` and `category_frequencies`, refreshed with
+    the new rows of a table.
+
+    For each aggregated column the state holds, per group, only what its statistics are derived from: the count of
+    values, their sum and sum of squared deviations from the group mean, the min and max, and the first and last
+    values along with the order value they were found at, plus the counts and sums over each recency window. The
+    number of rows and of each category of the categorical columns give the category frequencies. New rows are
+    reduced on their own, out of a single sort, and their state combined with the state of the groups they belong
+    to, so that an update costs in the size of the new rows rather than in the size of the history.
+
+    `result` returns the same tables as `segment_aggregate` and `category_frequencies` computed on all the rows fed
+    so far, up to the rounding of the float sums. Rows are taken to come after the rows already fed, which decides
+    the "first" and "last" values between rows with the same order value.
+
+    Attributes:
+        key (str): Column to group by.
+        spec (Dict[str, Sequence[str]]): Statistics to compute for each column, see `expand_spec`.
+        exclude (Sequence[str]): Numerical columns left out of the aggregation.
+        order_by (str, optional): Column ordering the rows within each group, see `segment_aggregate`.
+        windows (Dict[str, float]): Lower bound of `order_by` of each recency window, by window label.
+        window_spec (Dict[str, Sequence[str]]): Statistics to compute over each window for each column.
+        state (pd.DataFrame): One row per group, indexed by key, None before the first update.
+        source (dict, optional): Fingerprint of the table the state was computed from, see `utils.fingerprint`,
+            stored along with the state so that it can be told apart from a state of an older table.
+    '''
+
+    # Initial number of groups the state arrays are allocated for, doubled whenever new groups do not fit
+    INITIAL_CAPACITY = 1024
+
+    def __init__(
+        self,
+        key: str,
+        spec: Dict[str, Sequence[str]],
+        exclude: Sequence[str] = (),
+        order_by: Optional[str] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+    ):
+        self.windows, self.window_spec = _check_windows(windows, window_spec, order_by)
+        self.key = key
+        self.spec = {column: list(statistics) for column, statistics in spec.items()}
+        self.exclude = list(exclude)
+        self.order_by = order_by
+        # State fields of the groups, by state column, in arrays with room for more groups, and position of each
+        # group in them by key
+        self.arrays = {}
+        self.keys = None
+        self.positions = {}
+        self.size = 0
+        self.source = None
+        # Resolved on the first rows: statistics of each column, dtypes, and categories of the categorical columns
+        self.expanded = {}
+        self.windowed = {}
+        self.dtypes = {}
+        self.categories = {}
+
+    @property
+    def state(self) -> Optional[pd.DataFrame]:
+        return None if self.keys is None else self._frame(np.arange(self.size))
+
+    @state.setter
+    def state(self, state: pd.DataFrame):
+        capacity = max(len(state), self.INITIAL_CAPACITY)
+        self.keys = self._allocated(state.index.to_numpy(), capacity)
+        self.arrays = {name: self._allocated(state[name].to_numpy(), capacity) for name in state.columns}
+        self.positions = dict(zip(state.index.tolist(), range(len(state))))
+        self.size = len(state)
+
+    @staticmethod
+    def _allocated(values: np.ndarray, capacity: int) -> np.ndarray:
+        array = np.empty(capacity, dtype=values.dtype)
+        array[: len(values)] = values
+        return array
+
+    def _frame(self, positions: np.ndarray) -> pd.DataFrame:
+        # State of the groups at some positions of the arrays
+        return pd.DataFrame(
+            {name: array[positions] for name, array in self.arrays.items()},
+            index=pd.Index(self.keys[positions], name=self.key),
+        )
+
+    def _locate(self, keys: pd.Index) -> np.ndarray:
+        # Positions of the groups of some keys in the arrays, -1 for the groups not in the state yet
+        return np.fromiter((self.positions.get(key, -1) for key in keys.tolist()), dtype=np.int64, count=len(keys))
+
+    def parameters(self) -> dict:
+        '''Return the arguments the aggregator was built with, which the state is only valid for.'''
+        return {
+            'key': self.key,
+            'spec': self.spec,
+            'exclude': self.exclude,
+            'order_by': self.order_by,
+            'windows': self.windows,
+            'window_spec': {column: list(statistics) for column, statistics in self.window_spec.items()},
+        }
+
+    def _fields(self, column: str) -> List[str]:
+        fields = [field for statistic in self.expanded.get(column, ()) for field in STATE_FIELDS[statistic]]
+        fields += [
+            f'{field}_{label}'
+            for label in self.windows
+            for statistic in self.windowed.get(column, ())
+            for field in WINDOW_STATE_FIELDS[statistic]
+        ]
+        return list(dict.fromkeys(fields))
+
+    def _resolve(self, rows: pd.DataFrame):
+        self.expanded = expand_spec(rows, self.spec, self.key, self.exclude)
+        self.windowed = expand_spec(rows, self.window_spec, self.key, self.exclude) if self.windows else {}
+        self.dtypes = {
+            column: rows[column].dtype for column in rows.columns if column in self.expanded or column in self.windowed
+        }
+        self.categories = {
+            column: list(_categorical(rows[column]).categories)
+            for column in rows.select_dtypes(['object', 'category']).columns.drop(self.key, errors='ignore')
+        }
+
+    def _rows_state(self, rows: pd.DataFrame) -> pd.DataFrame:
+        # State of the groups of some rows on their own
+        segments = SortedSegments(rows[self.key], None if self.order_by is None else rows[self.order_by])
+        if self.order_by is None:
+            order = np.zeros(len(segments.permutation))
+        else:
+            order = segments.take(rows[self.order_by].to_numpy(dtype=np.float64, na_value=np.nan))
+            # Rows with a missing order value come last within their group
+            order[np.isnan(order)] = np.inf
+        bounds = {label: segments.window(lower) for label, lower in self.windows.items()} if self.windowed else {}
+
+        state = {}
+        for column, dtype in self.dtypes.items():
+            values = segments.take(rows[column].astype(dtype, copy=False).to_numpy())
+            fields = self._fields(column)
+            statistics = [
+                statistic for statistic in ('count', 'sum', 'min', 'max', 'first', 'last') if statistic in fields
+            ]
+            if 'm2' in fields:
+                statistics.append('var')
+            reduced = segments.reduce(values, statistics)
+            for statistic, result in reduced.items():
+                if statistic == 'var':
+                    # Groups with a single value have no variance, and no deviation from their mean either
+                    state[_state_field(column, 'm2')] = np.nan_to_num(result * (reduced['count'] - 1))
+                else:
+                    state[_state_field(column, statistic)] = result
+            if 'first_order' in fields or 'last_order' in fields:
+                present = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+                found = np.where(present, order, np.nan)
+                if 'first_order' in fields:
+                    state[_state_field(column, 'first_order')] = np.fmin.reduceat(found, segments.starts)
+                if 'last_order' in fields:
+                    state[_state_field(column, 'last_order')] = np.fmax.reduceat(found, segments.starts)
+            if column in self.windowed:
+                window_statistics = [
+                    statistic for statistic in ('count', 'sum') if f'{statistic}_{next(iter(self.windows))}' in fields
+                ]
+                for (label, statistic), result in segments.reduce_windows(values, window_statistics, bounds).items():
+                    state[_state_field(column, f'{statistic}_{label}')] = result
+
+        if self.categories:
+            groups, _ = pd.factorize(rows[self.key], sort=True)
+            state[SIZE_FIELD] = segments.sizes
+            for column, categories in self.categories.items():
+                categorical = _categorical(rows[column])
+                new_categories = [category for category in categorical.categories if category not in categories]
+                if new_categories:
+                    # Kept sorted, like the vocabularies of the schemas
+                    categories[:] = sorted([*categories, *new_categories])
+                codes = pd.Categorical(rows[column], categories=categories).codes
+                counts = _category_counts(groups, len(segments.group_keys), codes, len(categories))
+                for position, category in enumerate(categories):
+                    state[_state_field(column, f'={category}')] = counts[:, position]
+
+        return pd.DataFrame(state, index=segments.group_keys.rename(self.key))
+
+    def _combine(self, partial: pd.DataFrame):
+        # Combine the state of later rows into the current state. Only the groups of the later state are read and
+        # written in the arrays, those already in the state in place and the new ones after the last group, so that
+        # the cost follows the size of the later state rather than the number of groups
+        partial = self._align_categories(partial)
+        for name in partial.columns.difference(list(self.arrays)):
+            # Categories first seen in the later state have no rows in the groups of the current state
+            self.arrays[name] = np.zeros(len(self.keys), dtype=np.int64)
+        partial = partial[list(self.arrays)]
+        positions = self._locate(partial.index)
+        existing = positions >= 0
+        previous = self._frame(positions[existing])
+        later = partial[existing]
+        combined = later.copy()
+        for column in self.dtypes:
+            fields = self._fields(column)
+            for field in fields:
+                name = _state_field(column, field)
+                if field in ('min', 'max'):
+                    combined[name] = (np.fmin if field == 'min' else np.fmax)(previous[name], later[name])
+                elif field.startswith(('count', 'sum')):
+                    combined[name] = previous[name] + later[name]
+            if 'm2' in fields:
+                # Chan et al. pairwise update of the sum of squared deviations
+                count, total = _state_field(column, 'count'), _state_field(column, 'sum')
+                m2 = _state_field(column, 'm2')
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    delta = later[total] / later[count] - previous[total] / previous[count]
+                    correction = delta * delta * previous[count] * later[count] / (previous[count] + later[count])
+                combined[m2] = previous[m2] + later[m2] + correction.fillna(0)
+            for field in ('first', 'last'):
+                if field not in fields:
+                    continue
+                value, order = _state_field(column, field), _state_field(column, f'{field}_order')
+                # Ties go to the earlier rows for the first value, and to the later rows for the last one
+                if field == 'first':
+                    keep = previous[order] <= later[order]
+                else:
+                    keep = previous[order] > later[order]
+                keep |= later[order].isna() & previous[order].notna()
+                combined[value] = previous[value].where(keep, later[value])
+                combined[order] = previous[order].where(keep, later[order])
+        if self.categories:
+            names = [SIZE_FIELD] + [
+                _state_field(column, f'={category}')
+                for column, categories in self.categories.items()
+                for category in categories
+            ]
+            combined[names] = previous[names].to_numpy() + later[names].to_numpy()
+        for name, array in self.arrays.items():
+            array[positions[existing]] = combined[name].to_numpy()
+        if not existing.all():
+            self._append(partial[~existing])
+
+    def _append(self, state: pd.DataFrame):
+        # Add the state of new groups after the last group, growing the arrays geometrically when full
+        size = self.size + len(state)
+        if size > len(self.keys):
+            capacity = max(size, 2 * len(self.keys))
+            self.keys = self._allocated(self.keys[: self.size], capacity)
+            self.arrays = {name: self._allocated(array[: self.size], capacity) for name, array in self.arrays.items()}
+        self.keys[self.size : size] = state.index.to_numpy()
+        for name, array in self.arrays.items():
+            array[self.size : size] = state[name].to_numpy()
+        self.positions.update(zip(state.index.tolist(), range(self.size, size)))
+        self.size = size
+
+    def _align_categories(self, state: pd.DataFrame) -> pd.DataFrame:
+        # Categories first seen after the state was built have no rows in its groups
+        missing = {
+            _state_field(column, f'={category}'): np.zeros(len(state), dtype=np.int64)
+            for column, categories in self.categories.items()
+            for category in categories
+            if _state_field(column, f'={category}') not in state.columns
+        }
+        return state.assign(**missing) if missing else state
+
+    def update(self, rows: pd.DataFrame) -> pd.Index:
+        '''
+        Add new rows of the table to the state.
+
+        Args:
+            rows (pd.DataFrame): New rows, with the columns of the rows fed before. Their numerical columns are cast
+                to the dtypes of the first rows.
+
+        Returns:
+            pd.Index: Sorted keys of the groups of the new rows, whose statistics changed.
+        '''
+        if self.keys is None:
+            self._resolve(rows)
+        partial = self._rows_state(rows)
+        if self.keys is None:
+            self.state = partial
+        else:
+            self._combine(partial)
+        return partial.index
+
+    def merge(self, other: 'IncrementalAggregator') -> 'IncrementalAggregator':
+        '''
+        Combine the state of another aggregator, with the same parameters and fed with later rows of the same
+        table, into this one.
+
+        Args:
+            other (IncrementalAggregator): Aggregator to merge.
+
+        Returns:
+            IncrementalAggregator: The aggregator itself.
+        '''
+        if other.keys is None:
+            return self
+        if self.keys is None:
+            self.expanded, self.windowed, self.dtypes = other.expanded, other.windowed, other.dtypes
+            self.categories = {column: list(categories) for column, categories in other.categories.items()}
+            self.state = other.state
+            return self
+        for column, categories in other.categories.items():
+            self.categories[column] = sorted({*self.categories[column], *categories})
+        self._combine(other.state)
+        return self
+
+    def result(self, keys: Optional[Sequence] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        '''
+        Compute the statistics of the groups from their state.
+
+        Args:
+            keys (Sequence, optional): Keys of the groups to compute, such as the keys returned by `update`.
+                Defaults to all the groups.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: Statistics of the numerical columns, named with `statistic_name`,
+                and frequencies of each category of the categorical columns, both with the group key as their
+                first column and sorted by key.
+        '''
+        if keys is None:
+            positions = np.argsort(self.keys[: self.size], kind='stable')
+        else:
+            keys = pd.Index(keys).sort_values()
+            positions = self._locate(keys)
+            if (positions < 0).any():
+                raise KeyError(f'No rows were fed for the keys {list(keys[positions < 0])}')
+        state = self._frame(positions)
+
+        aggregated = {}
+        for column, dtype in self.dtypes.items():
+
+            def field(name: str) -> np.ndarray:
+                return state[_state_field(column, name)].to_numpy()
+
+            for statistic in self.expanded.get(column, ()):
+                if statistic == 'mean':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        result = field('sum') / field('count')
+                elif statistic in ('var', 'std'):
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        result = field('m2') / (field('count') - 1)
+                    result[field('count') < 2] = np.nan
+                    if statistic == 'std':
+                        result = np.sqrt(result)
+                else:
+                    result = field(statistic)
+                result = result.astype(_statistic_dtype(dtype, statistic), copy=False)
+                if statistic == 'mean' and dtype == np.float16:
+                    result = _narrow_half(result)
+                aggregated[statistic_name(column, statistic)] = result
+            for label in self.windows:
+                for statistic in self.windowed.get(column, ()):
+                    if statistic == 'mean':
+                        with np.errstate(invalid='ignore', divide='ignore'):
+                            result = field(f'sum_{label}') / field(f'count_{label}')
+                    else:
+                        result = field(f'{statistic}_{label}')
+                    aggregated[statistic_name(column, statistic, label)] = result.astype(
+                        _statistic_dtype(dtype, statistic), copy=False
+                    )
+        numerical = pd.DataFrame({self.key: state.index.to_numpy(), **aggregated})
+
+        frequencies = {}
+        if self.categories:
+            sizes = state[SIZE_FIELD].to_numpy()
+            for column, categories in self.categories.items():
+                for category in categories:
+                    frequencies[f'{column}_{category}'] = state[_state_field(column, f'={category}')].to_numpy() / sizes
+        categorical = pd.DataFrame({self.key: state.index.to_numpy(), **frequencies})
+
+        return numerical, categorical
+
+    def save(self, directory: str):
+        '''
+        Store the state in a directory, as a Feather file and a JSON file of the parameters, dtypes and categories.
+
+        Args:
+            directory (str): Directory of the state, created if needed.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        metadata = {
+            'parameters': self.parameters(),
+            'source': self.source,
+            'expanded': self.expanded,
+            'windowed': self.windowed,
+            'dtypes': {column: str(dtype) for column, dtype in self.dtypes.items()},
+            'categories': self.categories,
+        }
+        # Written to temporary files renamed at the end, so that a failed save leaves the previous state
+        state_path, metadata_path = os.path.join(directory, 'state.feather'), os.path.join(directory, 'state.json')
+        self.state.reset_index().to_feather(f'{state_path}.{os.getpid()}.tmp', compression='zstd')
+        with open(f'{metadata_path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(metadata, f, indent=2, default=str)
+        os.replace(f'{state_path}.{os.getpid()}.tmp', state_path)
+        os.replace(f'{metadata_path}.{os.getpid()}.tmp', metadata_path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['IncrementalAggregator']:
+        '''
+        Read a state stored with `save`.
+
+        Args:
+            directory (str): Directory of the state.
+
+        Returns:
+            IncrementalAggregator: The aggregator, or None if the directory holds no state.
+        '''
+        metadata_path = os.path.join(directory, 'state.json')
+        if not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        aggregator = cls(**metadata['parameters'])
+        aggregator.source = metadata.get('source')
+        aggregator.expanded = metadata['expanded']
+        aggregator.windowed = metadata['windowed']
+        aggregator.dtypes = {column: np.dtype(dtype) for column, dtype in metadata['dtypes'].items()}
+        aggregator.categories = metadata['categories']
+        state = pd.read_feather(os.path.join(directory, 'state.feather'))
+        aggregator.state = state.set_index(aggregator.key)
+        return aggregator
@@ -1,8 +1,8 @@
 import os
 import sys
 
-# Add the parent directory to the Python path
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '...')))
+# Add the package directory to the Python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
 from application import *
 from bureau import *
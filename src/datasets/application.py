@@ -4,27 +4,182 @@ import sys
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import pickle
+import json
 from datetime import datetime
-from typing import Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import pandas as pd
 from loguru import logger
 
-from utils import reduce_memory_usage
+from projection import FeatureProjection, table_columns
+from raw_tables import read_raw_table
+from stage_cache import cached_stage, code_version, stage_inputs, stage_parameters
+from utils import fingerprint, source_directory
+
+APPLICATION_ENCODER_FORMAT_VERSION = 1
+
+
+def _vocabulary(column: pd.Series) -> list:
+    '''Categories of a column, in the order `pd.get_dummies` gives their dummies.'''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.categories.tolist()
+    return sorted(column.dropna().unique().tolist())
+
+
+def _same_source(stored: Optional[dict], source: dict) -> bool:
+    '''Whether an encoder fitted from `stored` is the one fitted from `source`, the input files compared by content.'''
+    if stored is None or stored.keys() != source.keys():
+        return False
+    hashes = [{path: file['sha256'] for path, file in inputs['inputs'].items()} for inputs in (stored, source)]
+    return stored['parameters'] == source['parameters'] and stored['code'] == source['code'] and hashes[0] == hashes[1]
+
+
+class ApplicationEncoder:
+    '''
+    One-hot encoding of the application tables, fitted once and persisted, into a fixed column layout.
+
+    `pd.get_dummies` gives one dummy per category found in the table it encodes, so the layouts of train and test
+    differ and a single applicant cannot be encoded. The encoder learns the vocabulary of each categorical column
+    instead, and any batch, down to one row, is then encoded into the same columns: the other columns in order,
+    followed by one boolean dummy per category of the vocabulary, named like `pd.get_dummies` does. Categories
+    outside the vocabulary, and missing values, have no dummy set.
+
+    Attributes:
+        columns (List[str]): Columns kept as they are, in order. TARGET is only encoded when the batch has it.
+        categories (Dict[str, List]): Vocabulary of each categorical column, in the order of its dummies.
+        source (dict, optional): What the encoder was fitted from, stored along with it, see
+            `preprocess_application_train_test.encoder_source`.
+    '''
+
+    def __init__(self, columns: Optional[List[str]] = None, categories: Optional[Dict[str, list]] = None):
+        self.columns = list(columns or [])
+        self.categories = {column: list(vocabulary) for column, vocabulary in (categories or {}).items()}
+        self.source = None
+
+    def fit(self, train: pd.DataFrame, test: Optional[pd.DataFrame] = None) -> 'ApplicationEncoder':
+        '''
+        Learn the layout from the training table.
+
+        Args:
+            train (pd.DataFrame): Training table, the string and categorical columns being one-hot encoded.
+            test (pd.DataFrame, optional): Test table. When given, only the columns and categories it shares with
+                the training table are kept, so that both are encoded into the columns they have in common.
+
+        Returns:
+            ApplicationEncoder: The fitted encoder.
+        '''
+        categorical = [column for column in train.columns if train[column].dtype in ('object', 'category')]
+        self.columns = [column for column in train.columns if column not in categorical]
+        self.categories = {column: _vocabulary(train[column]) for column in categorical}
+        if test is not None:
+            self.columns = [column for column in self.columns if column in test.columns or column == 'TARGET']
+            test_categories = {
+                column: set(_vocabulary(test[column])) for column in self.categories if column in test.columns
+            }
+            self.categories = {
+                column: [category for category in vocabulary if category in test_categories[column]]
+                for column, vocabulary in self.categories.items()
+                if column in test_categories
+            }
+        return self
+
+    @property
+    def feature_names(self) -> List[str]:
+        '''Names of the encoded columns, TARGET included.'''
+        return self.columns + [
+            f'{column}_{category}' for column, vocabulary in self.categories.items() for category in vocabulary
+        ]
+
+    def transform(self, table: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Encode a batch of applications.
+
+        Args:
+            table (pd.DataFrame): Applications, with at least the columns of the layout but TARGET.
+
+        Returns:
+            pd.DataFrame: The applications in the layout of `feature_names`, with the index of the table.
+        '''
+        missing = [
+            column for column in [*self.columns, *self.categories] if column not in table.columns and column != 'TARGET'
+        ]
+        if missing:
+            raise ValueError(f"Columns {missing} are missing from the encoded table.")
+
+        encoded = {column: table[column] for column in self.columns if column in table.columns}
+        for column, vocabulary in self.categories.items():
+            codes = pd.Categorical(table[column], categories=vocabulary).codes
+            for code, category in enumerate(vocabulary):
+                encoded[f'{column}_{category}'] = codes == code
+        return pd.DataFrame(encoded, index=table.index)
+
+    def save(self, path: str):
+        '''
+        Store the encoder as a JSON file.
+
+        Args:
+            path (str): Path of the file, its directory created if needed.
+        '''
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        metadata = {
+            'version': APPLICATION_ENCODER_FORMAT_VERSION,
+            'columns': self.columns,
+            'categories': self.categories,
+            'source': self.source,
+        }
+        # Written to a temporary file renamed at the end, so that a failed save leaves the previous encoder
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(metadata, f, indent=2, default=str)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['ApplicationEncoder']:
+        '''
+        Read an encoder stored with `save`.
+
+        Args:
+            path (str): Path of the file.
+
+        Returns:
+            ApplicationEncoder: The encoder, or None if there is none of the current format at that path.
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            metadata = json.load(f)
+        if metadata.get('version') != APPLICATION_ENCODER_FORMAT_VERSION:
+            return None
+        encoder = cls(metadata['columns'], metadata['categories'])
+        encoder.source = metadata.get('source')
+        return encoder
 
 
 class preprocess_application_train_test:
     '''
     Preprocess the application_train and application_test tables.
-    Contains 4 member functions:
+    Contains 5 member functions:
         1. init method
         2. load_dataframes method
         3. data_cleaning method
-        4. main method
+        4. encoder method
+        5. main method
     '''
 
-    def __init__(self, file_directory1='', file_directory2='', verbose=True, dump_to_pickle=False):
+    # Files read by the class, by attribute holding their directory
+    INPUT_FILES = {'file_directory1': ['cleaned_train_data.csv'], 'file_directory2': ['application_test.csv']}
+
+    def __init__(
+        self,
+        file_directory1='',
+        file_directory2='',
+        verbose=True,
+        stage_cache=True,
+        stage_cache_directory=None,
+        use_cache=True,
+        dtype_policy='compute',
+        features: Optional[Sequence[str]] = None,
+        state_directory: Optional[str] = None,
+    ):
         '''
         Initialize the class members.
 
@@ -32,17 +187,59 @@ class preprocess_application_train_test:
             file_directory1: str, default=''
                 Path where the application_train.csv file exists. Include a '/' at the end.
             file_directory2: str, default=''
-                Path where the application_test.csv file exists. Include a '/' at the end.
+                Path where the application_test.csv file exists. Include a '/' at the end. Can also be the path of
+                the competition zip archive, to read the table without extracting it.
             verbose: bool, default=True
                 Whether to enable verbosity or not.
-            dump_to_pickle: bool, default=False
-                Whether to pickle the final preprocessed tables or not.
+            stage_cache: bool, default=True
+                Whether to serve the tables from the stage cache, keyed by the content of the input files, the
+                parameters and the code version, and to store them there when they are computed.
+            stage_cache_directory: str, default=None
+                Directory of the stage cache. Defaults to a `stage_cache/` folder next to cleaned_train_data.csv.
+            use_cache: bool, default=True
+                Whether to load the raw tables through the columnar cache or not.
+            dtype_policy: str, default='compute'
+                Dtype policy of the loaded raw tables: 'compute' keeps float32 for the feature computations,
+                'storage' allows float16.
+            features: list of str, default=None
+                Features of the merged tables the result is restricted to, e.g. MODEL_PARAMS['features_selected']:
+                only the columns and categories they need are loaded. Defaults to all the features.
+            state_directory: str, default=None
+                Directory of the fitted `ApplicationEncoder`, which encodes the applications scored one by one
+                like the tables. Defaults to a `state/` folder next to cleaned_train_data.csv.
 
         '''
         self.verbose = verbose
-        self.dump_to_pickle = dump_to_pickle
+        self.stage_cache = stage_cache
+        self.stage_cache_directory = stage_cache_directory
+        self.use_cache = use_cache
+        self.dtype_policy = dtype_policy
         self.file_directory1 = file_directory1
         self.file_directory2 = file_directory2
+        self.features = None if features is None else list(features)
+        self.projection = FeatureProjection(self.features)
+        self.state_directory = state_directory
+
+    def resolve_features(self):
+        '''
+        Resolve the columns of each table and the categories of their categorical columns needed for the features.
+
+        Returns:
+            None
+        '''
+        self.usecols, self.projected_categories = {}, {}
+        for directory, file_name in [
+            (self.file_directory1, 'cleaned_train_data.csv'),
+            (self.file_directory2, 'application_test.csv'),
+        ]:
+            file_path = directory + file_name
+            numerical, categorical = table_columns(file_path) if self.features is not None else ([], {})
+            categories = self.projection.categories(categorical)
+            self.projected_categories[file_name] = categories
+            self.usecols[file_name] = self.projection.usecols(
+                file_path,
+                ['SK_ID_CURR', 'TARGET', *filter(self.projection.wants, numerical), *(categories or ())],
+            )
 
     def load_dataframes(self):
         '''
@@ -59,8 +256,18 @@ class preprocess_application_train_test:
             logger.info('#######################################################')
             logger.info("\nLoading the DataFrames into memory...")
 
-        self.application_train = reduce_memory_usage(pd.read_csv(self.file_directory1 + 'cleaned_train_data.csv'))
-        self.application_test = reduce_memory_usage(pd.read_csv(self.file_directory2 + 'application_test.csv'))
+        self.application_train = read_raw_table(
+            self.file_directory1 + 'cleaned_train_data.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols['cleaned_train_data.csv'],
+        )
+        self.application_test = read_raw_table(
+            self.file_directory2 + 'application_test.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols['application_test.csv'],
+        )
         self.initial_train_shape = self.application_train.shape
         self.initial_test_shape = self.application_test.shape
 
@@ -86,12 +293,88 @@ class preprocess_application_train_test:
             'FLAG_DOCUMENT_20',
         ]
 
-        self.application_train.drop(flag_cols_to_drop, axis=1, inplace=True)
-        self.application_test.drop(flag_cols_to_drop, axis=1, inplace=True)
+        self.application_train.drop(flag_cols_to_drop, axis=1, inplace=True, errors='ignore')
+        self.application_test.drop(flag_cols_to_drop, axis=1, inplace=True, errors='ignore')
 
         if self.verbose:
             logger.info("Data Cleaning Done.")
 
+    def encoder_path(self) -> str:
+        '''
+        Path of the fitted encoder of the class.
+
+        Returns:
+            str: Path of the JSON file of the `ApplicationEncoder`.
+        '''
+        state_directory = self.state_directory or os.path.join(
+            source_directory(self.file_directory1 + 'cleaned_train_data.csv'), 'state'
+        )
+        return os.path.join(state_directory, type(self).__name__, 'encoder.json')
+
+    def encoder_source(self, previous: Optional[dict] = None) -> dict:
+        '''
+        What the encoder of the class is fitted from: the parameters of the stage, the fingerprints of its input
+        files and the code version, the same as the key of its stage cache entry.
+
+        Args:
+            previous (dict, optional): Source of a stored encoder, whose fingerprints spare the hashing of the files
+                that did not change, see `utils.fingerprint`.
+
+        Returns:
+            dict: Source of the encoder.
+        '''
+        fingerprints = (previous or {}).get('inputs', {})
+        return {
+            'parameters': stage_parameters(self),
+            'inputs': {path: fingerprint(path, previous=fingerprints.get(path)) for path in stage_inputs(self)},
+            'code': code_version(),
+        }
+
+    def fit_encoder(self) -> ApplicationEncoder:
+        '''
+        Fit the encoder on the loaded tables and store it, along with its source.
+
+        Returns:
+            ApplicationEncoder: Encoder of the columns and categories shared by application_train and
+                application_test.
+        '''
+        # Only the dummies of the categories needed are created
+        for table, categories in [
+            (self.application_train, self.projected_categories['cleaned_train_data.csv']),
+            (self.application_test, self.projected_categories['application_test.csv']),
+        ]:
+            for column, kept in (categories or {}).items():
+                if kept is not None:
+                    table[column] = table[column].astype(pd.CategoricalDtype(kept))
+
+        encoder = ApplicationEncoder().fit(self.application_train, self.application_test)
+        stored = ApplicationEncoder.load(self.encoder_path())
+        encoder.source = self.encoder_source(stored.source if stored is not None else None)
+        encoder.save(self.encoder_path())
+        return encoder
+
+    def encoder(self) -> ApplicationEncoder:
+        '''
+        Return the fitted encoder, read from the state directory, or fitted on the tables and stored there when it
+        is missing or was fitted from other tables, features or code, e.g. by another instance whose tables the
+        stage cache now serves without fitting it again. The scoring of a single application goes through it, e.g.
+        `preprocess_application_train_test(...).encoder().transform(application)`.
+
+        Returns:
+            ApplicationEncoder: Encoder of the application tables, in the layout of the tables of `main`.
+        '''
+        encoder = ApplicationEncoder.load(self.encoder_path())
+        if encoder is not None and not _same_source(encoder.source, self.encoder_source(encoder.source)):
+            logger.warning('The stored encoder was fitted from other tables or features, fitting it again.')
+            encoder = None
+        if encoder is None:
+            self.resolve_features()
+            self.load_dataframes()
+            self.data_cleaning()
+            encoder = self.fit_encoder()
+        return encoder
+
+    @cached_stage
     def main(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
         '''
         Complete preprocessing of application_train and application_test tables.
@@ -100,6 +383,7 @@ class preprocess_application_train_test:
             Tuple[pd.DataFrame, pd.DataFrame]: Final preprocessed application_train and application_test tables.
         '''
         # Load the DataFrames
+        self.resolve_features()
         self.load_dataframes()
 
         # Perform Data Cleaning
@@ -111,17 +395,10 @@ class preprocess_application_train_test:
             logger.info("\nStarting Feature Engineering...")
             logger.info("\nCreating Domain Based Features on Numeric Data")
 
-        cat_col_train = [
-            category
-            for category in self.application_train.columns
-            if self.application_train[category].dtype == 'object'
-        ]
-        cat_col_test = [
-            category for category in self.application_test.columns if self.application_test[category].dtype == 'object'
-        ]
-
-        self.application_train = pd.get_dummies(self.application_train, columns=cat_col_train)
-        self.application_test = pd.get_dummies(self.application_test, columns=cat_col_test)
+        # One-hot encoding of the categorical columns, into the layout the applications are scored in
+        encoder = self.fit_encoder()
+        self.application_train = encoder.transform(self.application_train)
+        self.application_test = encoder.transform(self.application_test)
 
         if self.verbose:
             logger.info("Creating features based on Categorical Interactions on some Numeric Features")
@@ -140,15 +417,6 @@ class preprocess_application_train_test:
             )
             logger.info(f'\nTotal Time Taken = {datetime.now() - self.start}')
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('\nPickling pre-processed application_train and application_test to pickle files.')
-            with open(self.file_directory1 + 'application_train_preprocessed.pkl', 'wb') as f:
-                pickle.dump(self.application_train, f)
-            with open(self.file_directory2 + 'application_test_preprocessed.pkl', 'wb') as f:
-                pickle.dump(self.application_test, f)
-            if self.verbose:
-                logger.info('Pickling Done.')
         if self.verbose:
             logger.info('-' * 100)
 
@@ -1,7 +1,7 @@
 import os
-import pickle
 import sys
 from datetime import datetime
+from typing import Dict, Optional, Sequence
 
 import numpy as np
 import pandas as pd
@@ -10,31 +10,158 @@ from loguru import logger
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from utils import reduce_memory_usage
+from aggregation import IncrementalAggregator
+from engines import get_engine, map_categories, streak_names
+from projection import FeatureProjection, spec_names, table_columns
+from raw_tables import iter_raw_table_chunks
+from stage_cache import cached_stage
+
+
+def dpd_bucket(status: str) -> int:
+    '''
+    Days past due bucket of a STATUS value of bureau_balance.
+
+    Inputs:
+        status: str
+            '0' for no days past due, '1' to '5' for 1-30 up to 120+ days past due, 'C' for closed, 'X' for unknown
+
+    Returns:
+        the bucket number for '1' to '5', 0 for '0', 'C' and 'X'
+    '''
+    return int(status) if status.isdigit() else 0
+
+
+def status_dpd(status: pd.Series) -> np.ndarray:
+    '''
+    Convert the STATUS of bureau_balance to its days past due bucket, from the codes of its categories.
+
+    Inputs:
+        status: Series of the STATUS column
+
+    Returns:
+        float32 array holding the `dpd_bucket` of each value, and NaN for missing values
+    '''
+    return map_categories(status, dpd_bucket)
 
 
 class preprocess_bureau_balance_and_bureau:
     '''
     Preprocess the tables bureau_balance and bureau.
-    Contains 4 member functions:
+    Contains 5 member functions:
         1. init method
         2. preprocess_bureau_balance method
-        3. preprocess_bureau method
-        4. main method
+        3. streaming_bureau_balance method
+        4. preprocess_bureau method
+        5. main method
     '''
 
-    def __init__(self, file_directory: str = '', verbose: bool = True, dump_to_pickle: bool = False):
+    # Files read by the class, by attribute holding their directory
+    INPUT_FILES = {'file_directory': ['bureau.csv', 'bureau_balance.csv']}
+
+    # Statistics computed over SK_ID_BUREAU on bureau_balance, STATUS_DPD being the days past due bucket of STATUS.
+    # The mean keeps the column name, MONTHS_BALANCE being a feature of the model
+    BALANCE_SPEC = {
+        'MONTHS_BALANCE': ['mean', 'min', 'max', 'count'],
+        'STATUS_DPD': ['mean', 'max'],
+    }
+
+    # Recency windows, each keeping the months of bureau_balance with MONTHS_BALANCE at least its bound, and the
+    # statistics computed over each of them per SK_ID_BUREAU out of the same sort as the statistics above
+    WINDOWS = {'3M': -3, '6M': -6, '12M': -12, '24M': -24}
+    WINDOW_SPEC = {
+        'MONTHS_BALANCE': ['count'],
+        'STATUS_DPD': ['mean'],
+    }
+
+    # Statistics computed over SK_ID_CURR on bureau joined with the per-credit bureau_balance features, '*' standing
+    # for the numerical columns not listed
+    AGGREGATION_SPEC = {
+        '*': ['mean'],
+        'DAYS_CREDIT': ['mean', 'min', 'max'],
+        'CREDIT_DAY_OVERDUE': ['mean', 'max'],
+        'DAYS_CREDIT_ENDDATE': ['mean', 'min', 'max'],
+        'AMT_CREDIT_MAX_OVERDUE': ['mean', 'max'],
+        'AMT_CREDIT_SUM': ['mean', 'max'],
+        'AMT_CREDIT_SUM_DEBT': ['mean', 'max'],
+        # Oldest month of history over all the credits of the customer
+        'MONTHS_BALANCE_MIN': ['min'],
+        'MONTHS_BALANCE_COUNT': ['mean', 'sum'],
+        'STATUS_DPD_MAX': ['mean', 'max'],
+        'STATUS_DPD_STREAK_MAX': ['mean', 'max'],
+        'STATUS_DPD_STREAK_LAST': ['mean', 'max'],
+    }
+
+    def __init__(
+        self,
+        file_directory: str = '',
+        verbose: bool = True,
+        stage_cache: bool = True,
+        stage_cache_directory: Optional[str] = None,
+        use_cache: bool = True,
+        dtype_policy: str = 'compute',
+        engine: str = 'pandas',
+        streaming: bool = False,
+        chunksize: Optional[int] = None,
+        memory_limit_mb: Optional[float] = None,
+        aggregation_spec: Optional[Dict[str, Sequence[str]]] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        balance_spec: Optional[Dict[str, Sequence[str]]] = None,
+        features: Optional[Sequence[str]] = None,
+        shard_directory: Optional[str] = None,
+        sparse: bool = False,
+    ):
         '''
         This function is used to initialize the class members
 
         Inputs:
             self
             file_directory: Path, str, default = ''
-                The path where the file exists. Include a '/' at the end of the path in input
+                The path where the file exists. Include a '/' at the end of the path in input. Can also be the path
+                of the competition zip archive, to read the tables without extracting them
             verbose: bool, default = True
                 Whether to enable verbosity or not
-            dump_to_pickle: bool, default = False
-                Whether to pickle the final preprocessed table or not
+            stage_cache: bool, default = True
+                Whether to serve the result from the stage cache, keyed by the content of the input files, the
+                parameters and the code version, and to store it there when it is computed
+            stage_cache_directory: str, default = None
+                Directory of the stage cache. Defaults to a `stage_cache/` folder next to the input files
+            use_cache: bool, default = True
+                Whether to load the raw tables through the columnar cache or not
+            dtype_policy: str, default = 'compute'
+                Dtype policy of the loaded raw tables: 'compute' keeps float32 for the aggregations, 'storage'
+                allows float16
+            engine: str, default = 'pandas'
+                DataFrame engine loading and aggregating the tables, see engines.ENGINES. 'polars' runs lazy
+                multi-threaded queries over the columnar cache. The streaming mode always reads pandas chunks
+            streaming: bool, default = False
+                Whether to aggregate bureau_balance chunk by chunk instead of loading it in memory. The streaks of
+                months past due cannot be streamed, they must be left out of the features
+            chunksize: int, default = None
+                Number of rows of bureau_balance per chunk in streaming mode
+            memory_limit_mb: float, default = None
+                Memory budget for parsing one chunk in streaming mode, in MB. Only used when chunksize is not set
+            aggregation_spec: dict, default = None
+                Statistics computed over SK_ID_CURR for each numerical column of bureau joined with the per-credit
+                bureau_balance features, see aggregation.expand_spec. Defaults to AGGREGATION_SPEC
+            windows: dict, default = None
+                Lower bound of MONTHS_BALANCE of each recency window of bureau_balance, by label. Defaults to WINDOWS
+            window_spec: dict, default = None
+                Statistics computed per SK_ID_BUREAU over each recency window for each column of bureau_balance.
+                Defaults to WINDOW_SPEC, an empty dict disables the windows
+            balance_spec: dict, default = None
+                Statistics computed over SK_ID_BUREAU for each numerical column of bureau_balance. Defaults to
+                BALANCE_SPEC
+            features: list of str, default = None
+                Features of the merged tables the result is restricted to, e.g. MODEL_PARAMS['features_selected']:
+                only the raw columns, categories and statistics they need are loaded and computed, and
+                bureau_balance is not read at all when none of them comes from it. Defaults to all the features
+            shard_directory: str, default = None
+                Directory of the shard of the raw tables to read instead of the whole tables, see
+                pipeline.run_sharded_stage. Defaults to the whole tables
+            sparse: bool, default = False
+                Whether to return the category frequencies of bureau as sparse columns, 0 being implicit, see
+                aggregation.category_frequencies
 
         Returns:
             None
@@ -42,21 +169,104 @@ class preprocess_bureau_balance_and_bureau:
 
         self.file_directory = file_directory
         self.verbose = verbose
-        self.dump_to_pickle = dump_to_pickle
+        self.stage_cache = stage_cache
+        self.stage_cache_directory = stage_cache_directory
+        self.use_cache = use_cache
+        self.dtype_policy = dtype_policy
+        self.engine = engine
+        self.shard_directory = shard_directory
+        self.backend = get_engine(engine, shard_directory)
+        self.sparse = sparse
+        self.streaming = streaming
+        self.chunksize = chunksize
+        self.memory_limit_mb = memory_limit_mb
+        self.aggregation_spec = aggregation_spec or self.AGGREGATION_SPEC
+        self.windows = self.WINDOWS if windows is None else windows
+        self.window_spec = self.WINDOW_SPEC if window_spec is None else window_spec
+        self.balance_spec = balance_spec or self.BALANCE_SPEC
+        self.features = None if features is None else list(features)
+        # The numerical features are prefixed twice, the category frequencies once
+        self.projection = FeatureProjection(self.features, prefix='BUREAU_BUREAU_')
+        self.categorical_projection = FeatureProjection(self.features, prefix='BUREAU_')
         self.start = datetime.now()
         logger.info('Preprocessing class initialized.')
 
-    def preprocess_bureau_balance(self):
+    def resolve_features(self):
+        '''
+        Function to resolve the raw columns, categories and statistics of bureau and bureau_balance needed for the
+        features. The per-credit features of bureau_balance needed are those the statistics of bureau are
+        computed from
+
+        Inputs:
+            self
+
+        Returns:
+            None
+        '''
+        bureau_path = self.file_directory + 'bureau.csv'
+        balance_path = self.file_directory + 'bureau_balance.csv'
+        bureau_numerical, bureau_categorical, balance_numerical, balance_categorical = [], {}, [], {}
+        balance_names = []
+        if self.features is not None:
+            bureau_numerical, bureau_categorical = table_columns(bureau_path)
+            bureau_numerical = [column for column in bureau_numerical if column not in ('SK_ID_CURR', 'SK_ID_BUREAU')]
+        # bureau_balance is not even scanned when the statistics of bureau itself are all the features needed
+        if self.features is not None and not self.projection.covers(
+            spec_names(bureau_numerical, self.aggregation_spec)
+        ):
+            balance_numerical, balance_categorical = table_columns(balance_path)
+            balance_numerical = [column for column in balance_numerical if column != 'SK_ID_BUREAU'] + ['STATUS_DPD']
+            # Names of the per-credit features of bureau_balance
+            balance_names = spec_names(balance_numerical, self.balance_spec, self.windows, self.window_spec)
+            balance_names.extend(streak_names('STATUS_DPD'))
+            balance_names.extend(
+                f'{column}_{category}'
+                for column, vocabulary in balance_categorical.items()
+                for category in vocabulary or ()
+            )
+
+        self.projected_spec, _, _ = self.projection.spec(bureau_numerical + balance_names, self.aggregation_spec)
+        self.projected_categories = self.categorical_projection.categories(bureau_categorical)
+        self.usecols = self.projection.usecols(
+            bureau_path, ['SK_ID_CURR', 'SK_ID_BUREAU', *self.projected_spec, *(self.projected_categories or ())]
+        )
+
+        balance_projection = self.projection.within(name for name in self.projected_spec if name in balance_names)
+        self.balance_needed = self.features is None or bool(balance_projection.features)
+        if not self.balance_needed:
+            return
+        self.projected_balance_spec, self.projected_windows, self.projected_window_spec = balance_projection.spec(
+            balance_numerical, self.balance_spec, self.windows, self.window_spec
+        )
+        self.projected_streaks = [
+            column for column in ['STATUS_DPD'] if any(map(balance_projection.wants, streak_names(column)))
+        ]
+        self.projected_balance_categories = balance_projection.categories(balance_categorical)
+        # STATUS is always read, STATUS_DPD being derived from it
+        self.balance_usecols = balance_projection.usecols(
+            balance_path,
+            [
+                'SK_ID_BUREAU',
+                'MONTHS_BALANCE',
+                'STATUS',
+                *self.projected_balance_spec,
+                *self.projected_window_spec,
+                *(self.projected_balance_categories or ()),
+            ],
+        )
+
+    def preprocess_bureau_balance(self) -> pd.DataFrame:
         '''
         Function to preprocess bureau_balance table.
-        This function first loads the table into memory, does some feature engineering, and finally
-        aggregates the data over SK_ID_BUREAU
+        This function first loads the table into memory, derives the days past due bucket of STATUS, and finally
+        aggregates the data over SK_ID_BUREAU: months of history, STATUS frequencies, streaks of months past due and
+        the statistics of the recency windows, all out of a single sort of the table by SK_ID_BUREAU and month
 
         Inputs:
             self
 
         Returns:
-            preprocessed and aggregated bureau_balance table.
+            preprocessed and aggregated bureau_balance table, with one row per SK_ID_BUREAU.
         '''
 
         if self.verbose:
@@ -65,49 +275,115 @@ class preprocess_bureau_balance_and_bureau:
             logger.info('#######################################################')
             logger.info("\nLoading the DataFrame, bureau_balance.csv, into memory...")
 
-        bureau_balance = reduce_memory_usage(pd.read_csv(self.file_directory + 'bureau_balance.csv'))
+        bureau_balance = self.backend.read(
+            self.file_directory + 'bureau_balance.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.balance_usecols,
+        )
+        initial_size = self.backend.shape(bureau_balance)
 
         if self.verbose:
             logger.info("Loaded bureau_balance.csv")
             logger.info(f"Time Taken to load = {datetime.now() - self.start}")
             logger.info("\nStarting Data Cleaning and Feature Engineering...")
 
-        # # Encode STATUS labels
-        # dict_for_status = {'C': 0, '0': 1, '1': 2, '2': 3, 'X': 4, '3': 5, '4': 6, '5': 7}
-        # bureau_balance['STATUS'] = bureau_balance['STATUS'].map(dict_for_status)
-
-        # if self.verbose:
-        #     logger.info("Halfway through. A little bit more patience...")
-        #     logger.info(f"Total Time Elapsed = {datetime.now() - self.start}")
+        bureau_balance = self.backend.map_categories(bureau_balance, 'STATUS', 'STATUS_DPD', dpd_bucket)
 
-        # # Aggregating over whole dataset
-        # aggregated_bureau_balance = bureau_balance.groupby(['SK_ID_BUREAU']).mean().reset_index()
+        if self.verbose:
+            logger.info("Halfway through. A little bit more patience...")
+            logger.info(f"Total Time Elapsed = {datetime.now() - self.start}")
+
+        # Aggregating over SK_ID_BUREAU, with the months of each credit in chronological order
+        aggregated_bureau_balance = self.backend.aggregate(
+            bureau_balance,
+            'SK_ID_BUREAU',
+            self.projected_balance_spec,
+            order_by='MONTHS_BALANCE',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
+            streaks=self.projected_streaks,
+        )
+        aggregated_bureau_balance = aggregated_bureau_balance.merge(
+            self.backend.category_frequencies(bureau_balance, 'SK_ID_BUREAU', self.projected_balance_categories),
+            on='SK_ID_BUREAU',
+        )
 
         if self.verbose:
             logger.info('Done preprocessing bureau_balance.')
-            logger.info(f"\nInitial Size of bureau_balance: {bureau_balance.shape}")
+            logger.info(f"\nInitial Size of bureau_balance: {initial_size}")
             logger.info(
-                f'Size of bureau_balance after Pre-Processing, Feature Engineering and Aggregation: {bureau_balance.shape}'
+                f'Size of bureau_balance after Pre-Processing, Feature Engineering and Aggregation: {aggregated_bureau_balance.shape}'
             )
             logger.info(f'\nTotal Time Taken = {datetime.now() - self.start}')
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('\nPickling pre-processed bureau_balance to bureau_balance_preprocessed.pkl')
-            with open(self.file_directory + 'bureau_balance_preprocessed.pkl', 'wb') as f:
-                pickle.dump(bureau_balance, f)
-            if self.verbose:
-                logger.info('Done.')
+        return aggregated_bureau_balance
 
-        return bureau_balance
+    def streaming_bureau_balance(self) -> pd.DataFrame:
+        '''
+        Function to aggregate bureau_balance over SK_ID_BUREAU chunk by chunk, without loading the table into memory.
+        The state of the aggregation of each chunk is merged into the state of the credits, see
+        aggregation.IncrementalAggregator, which gives the same statistics, windows and STATUS frequencies as the
+        aggregation of the whole table. The streaks of months past due need all the months of a credit in order,
+        they cannot be streamed
 
-    def preprocess_bureau(self, aggregated_bureau_balance):
+        Inputs:
+            self
+
+        Returns:
+            aggregated bureau_balance table, with one row per SK_ID_BUREAU
+        '''
+
+        if self.verbose:
+            logger.info("Streaming the DataFrame, bureau_balance.csv, chunk by chunk...")
+
+        if self.projected_streaks:
+            raise ValueError(
+                'The streaks of months past due of bureau_balance cannot be streamed, leave the '
+                f'{streak_names("STATUS_DPD")} statistics out of the features to stream bureau_balance.'
+            )
+        aggregator = IncrementalAggregator(
+            'SK_ID_BUREAU',
+            self.projected_balance_spec,
+            order_by='MONTHS_BALANCE',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
+        )
+        for chunk in iter_raw_table_chunks(
+            self.file_directory + 'bureau_balance.csv',
+            chunksize=self.chunksize,
+            memory_limit_mb=self.memory_limit_mb,
+            usecols=self.balance_usecols,
+            dtype_policy=self.dtype_policy,
+        ):
+            chunk['STATUS_DPD'] = status_dpd(chunk['STATUS'])
+            aggregator.update(chunk)
+
+        numerical, categorical = aggregator.result()
+        wanted = self.projected_balance_categories
+        if wanted is not None:
+            # STATUS is always read, only the frequencies of the categories of the features are kept
+            categorical = categorical[
+                [
+                    'SK_ID_BUREAU',
+                    *(
+                        f'{column}_{category}'
+                        for column in wanted
+                        for category in aggregator.categories.get(column, ())
+                        if wanted[column] is None or category in wanted[column]
+                    ),
+                ]
+            ]
+        return numerical.merge(categorical, on='SK_ID_BUREAU')
+
+    def preprocess_bureau(self, aggregated_bureau_balance: Optional[pd.DataFrame]):
         '''
         Function to preprocess the bureau table and merge it with the aggregated bureau_balance table.
 
         Inputs:
             self
-            aggregated_bureau_balance: DataFrame of aggregated bureau_balance table
+            aggregated_bureau_balance: DataFrame of aggregated bureau_balance table, with one row per SK_ID_BUREAU,
+                or None when none of its features is needed
 
         Returns:
             Final preprocessed, merged and aggregated bureau table
@@ -123,32 +399,40 @@ class preprocess_bureau_balance_and_bureau:
                 logger.info('Starting preprocessing of bureau.csv')
             logger.info("\nLoading the DataFrame, bureau.csv, into memory...")
 
-        bureau = reduce_memory_usage(pd.read_csv(self.file_directory + 'bureau.csv'))
+        bureau = self.backend.read(
+            self.file_directory + 'bureau.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols,
+        )
 
         if self.verbose:
             logger.info("Loaded bureau.csv")
             logger.info(f"Time Taken to load = {datetime.now() - start2}")
             logger.info("\nStarting Data Cleaning and Feature Engineering...")
-        # Merge with aggregated_bureau_balance
-        bureau_merged = bureau.merge(aggregated_bureau_balance, on=['SK_ID_BUREAU'], how='right').drop(
-            'SK_ID_BUREAU', axis=1
-        )
+
+        # Merge with aggregated_bureau_balance, one row per credit on both sides. Credits without any month of
+        # history keep their row, with missing bureau_balance features
+        if aggregated_bureau_balance is None:
+            bureau_merged = bureau
+        else:
+            bureau_merged = self.backend.join(bureau, aggregated_bureau_balance, 'SK_ID_BUREAU')
         # Combine numerical features
-        bureau_numerical_aggregated = (
-            bureau_merged.select_dtypes(include=[np.number]).groupby(['SK_ID_CURR']).mean().reset_index()
+        bureau_numerical_aggregated = self.backend.aggregate(
+            bureau_merged, 'SK_ID_CURR', self.projected_spec, exclude=['SK_ID_BUREAU']
+        )
+
+        # Combine categorical features
+        bureau_categorical_aggregated = self.backend.category_frequencies(
+            bureau_merged, 'SK_ID_CURR', self.projected_categories, sparse=self.sparse
         )
+
         bureau_numerical_aggregated.columns = [
             'BUREAU_' + column if column != 'SK_ID_CURR' else column for column in bureau_numerical_aggregated.columns
         ]
 
-        # Combine categorical features
-        bureau_categorical = pd.get_dummies(bureau_merged.select_dtypes('object'))
-        bureau_categorical['SK_ID_CURR'] = bureau['SK_ID_CURR']
-        bureau_categorical_aggregated = bureau_categorical.groupby(['SK_ID_CURR']).mean().reset_index()
-
         # Merge numerical and categorical features
         bureau_merged_aggregated = bureau_numerical_aggregated.merge(bureau_categorical_aggregated, on='SK_ID_CURR')
-        bureau_merged_aggregated.update(bureau_merged_aggregated.fillna(0))
         bureau_merged_aggregated.columns = [
             'BUREAU_' + column if column != 'SK_ID_CURR' else column for column in bureau_merged_aggregated.columns
         ]
@@ -157,22 +441,16 @@ class preprocess_bureau_balance_and_bureau:
 
         if self.verbose:
             logger.info('Preprocessing of bureau completed.')
-            logger.info('Initial Size of bureau: {}', bureau.shape)
+            logger.info('Initial Size of bureau: {}', self.backend.shape(bureau))
             logger.info('Size after merging, preprocessing, and aggregation: {}', bureau_merged_aggregated.shape)
             logger.info('Total Time Taken: {}', datetime.now() - self.start)
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('Pickling pre-processed bureau and bureau_balance to bureau_merged_preprocessed.pkl')
-            with open(self.file_directory + 'bureau_merged_preprocessed.pkl', 'wb') as f:
-                pickle.dump(bureau_merged_aggregated, f)
-            if self.verbose:
-                logger.info('Pickling completed.')
         if self.verbose:
             logger.info('-' * 100)
 
         return bureau_merged_aggregated
 
+    @cached_stage
     def main(self) -> pd.DataFrame:
         '''
         Function to be called for complete preprocessing and aggregation of the bureau and bureau_balance tables.
@@ -184,10 +462,21 @@ class preprocess_bureau_balance_and_bureau:
             pd.DataFrame: The final preprocessed and merged `bureau` and `bureau_balance` tables.
         '''
 
-        # Preprocess the bureau_balance first
-        aggregated_bureau_balance = self.preprocess_bureau_balance()
+        # Resolve what the features need
+        self.resolve_features()
+
+        # Preprocess the bureau_balance first, reducing it to one row per credit
+        if not self.balance_needed:
+            aggregated_bureau_balance = None
+        elif self.streaming:
+            aggregated_bureau_balance = self.streaming_bureau_balance()
+        else:
+            aggregated_bureau_balance = self.preprocess_bureau_balance()
 
         # Preprocess the bureau table next, by combining it with the aggregated bureau_balance
         bureau_merged_aggregated = self.preprocess_bureau(aggregated_bureau_balance)
 
+        # Keep only the features
+        bureau_merged_aggregated = self.projection.select(bureau_merged_aggregated)
+
         return bureau_merged_aggregated
@@ -4,14 +4,17 @@ import sys
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import pickle
 from datetime import datetime
+from typing import Dict, Optional, Sequence, Tuple
 
-import numpy as np
 import pandas as pd
 from loguru import logger
 
-from utils import reduce_memory_usage
+from aggregation import IncrementalAggregator
+from engines import get_engine
+from projection import FeatureProjection, table_columns
+from raw_tables import iter_raw_table_chunks
+from stage_cache import cached_stage
 
 
 class preprocess_credit_card_balance:
@@ -22,22 +25,164 @@ class preprocess_credit_card_balance:
 
     '''
 
-    def __init__(self, file_directory: str = '', verbose: bool = True, dump_to_pickle: bool = False):
+    # Files read by the class, by attribute holding their directory
+    INPUT_FILES = {'file_directory': ['credit_card_balance.csv']}
+
+    # Statistics computed over SK_ID_CURR, '*' standing for the numerical columns not listed
+    AGGREGATION_SPEC = {
+        '*': ['mean'],
+        'MONTHS_BALANCE': ['mean', 'min', 'count'],
+        'AMT_BALANCE': ['mean', 'min', 'max', 'std', 'last'],
+        'AMT_CREDIT_LIMIT_ACTUAL': ['mean', 'max', 'last'],
+        'AMT_DRAWINGS_ATM_CURRENT': ['mean', 'max', 'sum'],
+        'AMT_DRAWINGS_CURRENT': ['mean', 'max', 'sum'],
+        'AMT_PAYMENT_TOTAL_CURRENT': ['mean', 'sum'],
+        'CNT_DRAWINGS_CURRENT': ['mean', 'max', 'sum'],
+        'SK_DPD': ['mean', 'max', 'sum'],
+        'SK_DPD_DEF': ['mean', 'max', 'sum'],
+    }
+
+    # Recency windows, each keeping the rows with MONTHS_BALANCE at least its bound, and the statistics computed
+    # over each of them out of the same sort as the statistics above
+    WINDOWS = {'3M': -3, '6M': -6, '12M': -12, '24M': -24}
+    WINDOW_SPEC = {
+        'MONTHS_BALANCE': ['count'],
+        'AMT_BALANCE': ['mean'],
+        'AMT_DRAWINGS_CURRENT': ['mean', 'sum'],
+        'AMT_PAYMENT_TOTAL_CURRENT': ['mean', 'sum'],
+        'CNT_DRAWINGS_CURRENT': ['sum'],
+        'SK_DPD': ['mean', 'sum'],
+    }
+
+    # Statistics computed over SK_ID_CURR for each per-loan statistic in hierarchical mode, '*' standing for all
+    CUSTOMER_SPEC = {'*': ['mean', 'max']}
+
+    def __init__(
+        self,
+        file_directory: str = '',
+        verbose: bool = True,
+        stage_cache: bool = True,
+        stage_cache_directory: Optional[str] = None,
+        use_cache: bool = True,
+        dtype_policy: str = 'compute',
+        engine: str = 'pandas',
+        streaming: bool = False,
+        chunksize: Optional[int] = None,
+        memory_limit_mb: Optional[float] = None,
+        aggregation_spec: Optional[Dict[str, Sequence[str]]] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        hierarchical: bool = False,
+        customer_spec: Optional[Dict[str, Sequence[str]]] = None,
+        features: Optional[Sequence[str]] = None,
+        shard_directory: Optional[str] = None,
+        sparse: bool = False,
+    ):
         '''
         Initializes the preprocess_credit_card_balance class.
 
         Args:
-            file_directory (str): Path to the directory where the files are located.
+            file_directory (str): Path to the directory where the files are located, or to the competition zip
+                archive (e.g. 'data/home-credit-default-risk.zip/'), to read the tables without extracting them.
             verbose (bool): Whether to enable verbose logging.
-            dump_to_pickle (bool): Whether to pickle the final preprocessed table.
+            stage_cache (bool): Whether to serve the result from the stage cache, keyed by the content of the input
+                files, the parameters and the code version, and to store it there when it is computed.
+            stage_cache_directory (str, optional): Directory of the stage cache. Defaults to a `stage_cache/` folder
+                next to the input files.
+            use_cache (bool): Whether to load the raw table through the columnar cache.
+            dtype_policy (str): Dtype policy of the loaded raw table: 'compute' (default) keeps float32 for the
+                aggregations, 'storage' allows float16.
+            engine (str): DataFrame engine loading and aggregating the table, see `engines.ENGINES`. 'polars' runs
+                lazy multi-threaded queries over the columnar cache. The streaming mode always reads pandas chunks.
+            streaming (bool): Whether to aggregate the raw table chunk by chunk instead of loading it in memory.
+                Not available in hierarchical mode.
+            chunksize (int, optional): Number of rows per chunk in streaming mode.
+            memory_limit_mb (float, optional): Memory budget for parsing one chunk in streaming mode, in MB. Only
+                used when `chunksize` is not set.
+            aggregation_spec (Dict[str, Sequence[str]], optional): Statistics computed over SK_ID_CURR for each
+                numerical column, see `aggregation.expand_spec`. Defaults to `AGGREGATION_SPEC`.
+            windows (Dict[str, float], optional): Lower bound of MONTHS_BALANCE of each recency window, by label.
+                Defaults to `WINDOWS`.
+            window_spec (Dict[str, Sequence[str]], optional): Statistics computed over each recency window for each
+                column. Defaults to `WINDOW_SPEC`, an empty dict disables the windows.
+            hierarchical (bool): Whether to aggregate the numerical columns first per loan (SK_ID_PREV), with the
+                aggregation spec and the windows, and then the per-loan statistics per customer with `customer_spec`.
+            customer_spec (Dict[str, Sequence[str]], optional): Statistics computed over SK_ID_CURR for each per-loan
+                statistic in hierarchical mode. Defaults to `CUSTOMER_SPEC`.
+            features (Sequence[str], optional): Features of the merged tables the result of `main` is restricted
+                to, e.g. `MODEL_PARAMS['features_selected']`: only the raw columns, categories and statistics they
+                need are loaded and computed. Defaults to all the features.
+            shard_directory (str, optional): Directory of the shard of the raw tables to read instead of the
+                whole tables, see `pipeline.run_sharded_stage`. Defaults to the whole tables.
+            sparse (bool): Whether to return the category frequencies as sparse columns, 0 being implicit, see
+                `aggregation.category_frequencies`. The streaming mode keeps them dense.
 
         '''
         self.file_directory = file_directory
         self.verbose = verbose
-        self.dump_to_pickle = dump_to_pickle
+        self.stage_cache = stage_cache
+        self.stage_cache_directory = stage_cache_directory
+        self.use_cache = use_cache
+        self.dtype_policy = dtype_policy
+        self.engine = engine
+        self.shard_directory = shard_directory
+        self.backend = get_engine(engine, shard_directory)
+        self.sparse = sparse
+        if streaming and hierarchical:
+            raise ValueError(
+                'The hierarchical aggregation needs all the rows of each loan at once, it cannot be streamed.'
+            )
+        self.streaming = streaming
+        self.chunksize = chunksize
+        self.memory_limit_mb = memory_limit_mb
+        self.aggregation_spec = aggregation_spec or self.AGGREGATION_SPEC
+        self.windows = self.WINDOWS if windows is None else windows
+        self.window_spec = self.WINDOW_SPEC if window_spec is None else window_spec
+        self.hierarchical = hierarchical
+        self.customer_spec = customer_spec or self.CUSTOMER_SPEC
+        self.features = None if features is None else list(features)
+        self.projection = FeatureProjection(self.features, prefix='CC_')
         self.start = datetime.now()
         logger.info('Preprocessing class initialized.')
 
+    def resolve_features(self):
+        '''
+        Resolves the raw columns, categories and statistics needed for the features.
+
+        Returns:
+            None
+        '''
+        numerical, categorical = [], {}
+        if self.features is not None:
+            numerical, categorical = table_columns(self.file_directory + 'credit_card_balance.csv')
+            numerical = [column for column in numerical if column not in ('SK_ID_CURR', 'SK_ID_PREV')]
+        if self.hierarchical:
+            (
+                self.projected_spec,
+                self.projected_customer_spec,
+                self.projected_windows,
+                self.projected_window_spec,
+            ) = self.projection.hierarchical_spec(
+                numerical, self.aggregation_spec, self.customer_spec, self.windows, self.window_spec
+            )
+        else:
+            self.projected_spec, self.projected_windows, self.projected_window_spec = self.projection.spec(
+                numerical, self.aggregation_spec, self.windows, self.window_spec
+            )
+            self.projected_customer_spec = self.customer_spec
+        self.projected_categories = self.projection.categories(categorical)
+        self.usecols = self.projection.usecols(
+            self.file_directory + 'credit_card_balance.csv',
+            [
+                'SK_ID_CURR',
+                *(['SK_ID_PREV'] if self.hierarchical else []),
+                'MONTHS_BALANCE',
+                *self.projected_spec,
+                *self.projected_window_spec,
+                *(self.projected_categories or ()),
+            ],
+        )
+
     def load_dataframe(self):
         '''
         Loads the `credit_card_balance.csv` DataFrame into memory.
@@ -51,8 +196,13 @@ class preprocess_credit_card_balance:
             logger.info('#########################################################')
             logger.info("Loading the DataFrame, credit_card_balance.csv, into memory...")
 
-        self.cc_balance = reduce_memory_usage(pd.read_csv(self.file_directory + 'credit_card_balance.csv'))
-        self.initial_size = self.cc_balance.shape
+        self.cc_balance = self.backend.read(
+            self.file_directory + 'credit_card_balance.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols,
+        )
+        self.initial_size = self.backend.shape(self.cc_balance)
 
         if self.verbose:
             logger.info("Loaded credit_card_balance.csv")
@@ -76,29 +226,88 @@ class preprocess_credit_card_balance:
             logger.info("Data Pre-processing and Feature Engineering Done.")
             logger.info('Time Taken: {}', datetime.now() - start)
 
-    def aggregations(self) -> pd.DataFrame:
+    def streaming_aggregations(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
         '''
-        Aggregates the `credit_card_balance` table first over `SK_ID_PREV`, and then over `SK_ID_CURR`.
+        Computes the statistics, the windows and the category frequencies over SK_ID_CURR chunk by chunk, without
+        loading the `credit_card_balance.csv` table into memory. The state of the aggregation of each chunk is merged into
+        the state of the customers, see `aggregation.IncrementalAggregator`, which gives the same features as the
+        aggregation of the whole table.
 
         Returns:
-            pd.DataFrame: Aggregated `credit_card_balance` table.
+            Tuple[pd.DataFrame, pd.DataFrame]: Aggregated numerical and categorical features.
         '''
         if self.verbose:
-            logger.info("Aggregating the DataFrame, first over SK_ID_PREV, then over SK_ID_CURR")
-
-        # Combining numerical features
-        cc_numerical_aggregated = (
-            self.cc_balance.select_dtypes(include=[np.number])
-            .drop('SK_ID_PREV', axis=1)
-            .groupby(by=['SK_ID_CURR'])
-            .mean()
-            .reset_index()
+            logger.info('#########################################################')
+            logger.info('#        Pre-processing credit_card_balance.csv         #')
+            logger.info('#########################################################')
+            logger.info("Streaming the DataFrame, credit_card_balance.csv, chunk by chunk...")
+
+        aggregator = IncrementalAggregator(
+            'SK_ID_CURR',
+            self.projected_spec,
+            exclude=['SK_ID_PREV'],
+            order_by='MONTHS_BALANCE',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
         )
+        n_rows = 0
+        for chunk in iter_raw_table_chunks(
+            self.file_directory + 'credit_card_balance.csv',
+            chunksize=self.chunksize,
+            memory_limit_mb=self.memory_limit_mb,
+            usecols=self.usecols,
+            dtype_policy=self.dtype_policy,
+        ):
+            aggregator.update(chunk)
+            n_rows += len(chunk)
+        self.initial_size = (n_rows, chunk.shape[1])
+
+        return aggregator.result()
 
-        # Combining categorical features
-        cc_categorical = pd.get_dummies(self.cc_balance.select_dtypes('object'))
-        cc_categorical['SK_ID_CURR'] = self.cc_balance['SK_ID_CURR']
-        cc_categorical_aggregated = cc_categorical.groupby('SK_ID_CURR').mean().reset_index()
+    def aggregations(self) -> pd.DataFrame:
+        '''
+        Aggregates the `credit_card_balance` table over `SK_ID_CURR`, or in hierarchical mode first over
+        `SK_ID_PREV`, and then over `SK_ID_CURR`. Categorical columns are always averaged over `SK_ID_CURR`.
+
+        Returns:
+            pd.DataFrame: Aggregated `credit_card_balance` table.
+        '''
+        if self.verbose:
+            if self.hierarchical:
+                logger.info("Aggregating the DataFrame, first over SK_ID_PREV, then over SK_ID_CURR")
+            else:
+                logger.info("Aggregating the DataFrame over SK_ID_CURR")
+
+        if self.streaming:
+            cc_numerical_aggregated, cc_categorical_aggregated = self.streaming_aggregations()
+        else:
+            # Combining numerical features
+            if self.hierarchical:
+                cc_numerical_aggregated = self.backend.hierarchical_aggregate(
+                    self.cc_balance,
+                    'SK_ID_CURR',
+                    'SK_ID_PREV',
+                    self.projected_spec,
+                    self.projected_customer_spec,
+                    order_by='MONTHS_BALANCE',
+                    windows=self.projected_windows,
+                    window_spec=self.projected_window_spec,
+                )
+            else:
+                cc_numerical_aggregated = self.backend.aggregate(
+                    self.cc_balance,
+                    'SK_ID_CURR',
+                    self.projected_spec,
+                    exclude=['SK_ID_PREV'],
+                    order_by='MONTHS_BALANCE',
+                    windows=self.projected_windows,
+                    window_spec=self.projected_window_spec,
+                )
+
+            # Combining categorical features
+            cc_categorical_aggregated = self.backend.category_frequencies(
+                self.cc_balance, 'SK_ID_CURR', self.projected_categories, sparse=self.sparse
+            )
 
         # Merge numerical and categorical features
         cc_aggregated = cc_numerical_aggregated.merge(cc_categorical_aggregated, on='SK_ID_CURR')
@@ -113,6 +322,7 @@ class preprocess_credit_card_balance:
 
         return cc_aggregated
 
+    @cached_stage
     def main(self) -> pd.DataFrame:
         '''
         Performs complete preprocessing and aggregation of the `credit_card_balance` table.
@@ -120,15 +330,22 @@ class preprocess_credit_card_balance:
         Returns:
             pd.DataFrame: Final preprocessed and aggregated `credit_card_balance` table.
         '''
-        # Loading the DataFrame
-        self.load_dataframe()
+        # Resolving what the features need
+        self.resolve_features()
 
-        # Performing preprocessing and feature engineering
-        self.data_preprocessing_and_feature_engineering()
+        if not self.streaming:
+            # Loading the DataFrame
+            self.load_dataframe()
+
+            # Performing preprocessing and feature engineering
+            self.data_preprocessing_and_feature_engineering()
 
         # Aggregating the `credit_card_balance` over SK_ID_PREV and SK_ID_CURR
         cc_aggregated = self.aggregations()
 
+        # Keeping only the features
+        cc_aggregated = self.projection.select(cc_aggregated)
+
         if self.verbose:
             logger.info('Done preprocessing credit_card_balance.')
             logger.info('Initial Size of credit_card_balance: {}', self.initial_size)
@@ -138,12 +355,4 @@ class preprocess_credit_card_balance:
             )
             logger.info('Total Time Taken: {}', datetime.now() - self.start)
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('Pickling pre-processed credit_card_balance to credit_card_balance_preprocessed.pkl')
-            with open(self.file_directory + 'credit_card_balance_preprocessed.pkl', 'wb') as f:
-                pickle.dump(cc_aggregated, f)
-            if self.verbose:
-                logger.info('Pickling completed.')
-
         return cc_aggregated
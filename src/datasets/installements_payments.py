@@ -5,15 +5,19 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import os
-import pickle
 import sys
 from datetime import datetime
+from typing import Dict, Optional, Sequence
 
-import numpy as np
 import pandas as pd
 from loguru import logger
 
-from utils import reduce_memory_usage
+from aggregation import IncrementalAggregator
+from engines import get_engine
+from projection import FeatureProjection, table_columns
+from raw_tables import iter_raw_table_chunks, shard_path
+from stage_cache import cached_stage
+from utils import fingerprint, source_directory
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -27,21 +31,123 @@ class preprocess_installments_payments:
 
     '''
 
-    def __init__(self, file_directory: str = '', verbose: bool = True, dump_to_pickle: bool = False):
+    # Files read by the class, by attribute holding their directory
+    INPUT_FILES = {'file_directory': ['installments_payments.csv']}
+
+    # Statistics computed over SK_ID_CURR, '*' standing for the numerical columns not listed
+    AGGREGATION_SPEC = {
+        '*': ['mean'],
+        'NUM_INSTALMENT_VERSION': ['mean', 'max'],
+        'NUM_INSTALMENT_NUMBER': ['mean', 'max', 'count'],
+        'DAYS_INSTALMENT': ['mean', 'min', 'max'],
+        'DAYS_ENTRY_PAYMENT': ['mean', 'min', 'max'],
+        'AMT_INSTALMENT': ['mean', 'max', 'sum'],
+        'AMT_PAYMENT': ['mean', 'min', 'max', 'sum'],
+    }
+
+    # Recency windows, each keeping the installments with DAYS_INSTALMENT at least its bound, and the statistics
+    # computed over each of them out of the same sort as the statistics above
+    WINDOWS = {'90D': -90, '180D': -180, '365D': -365, '730D': -730}
+    WINDOW_SPEC = {
+        'NUM_INSTALMENT_NUMBER': ['count'],
+        'DAYS_ENTRY_PAYMENT': ['mean'],
+        'AMT_INSTALMENT': ['mean', 'sum'],
+        'AMT_PAYMENT': ['mean', 'sum'],
+    }
+
+    def __init__(
+        self,
+        file_directory: str = '',
+        verbose: bool = True,
+        stage_cache: bool = True,
+        stage_cache_directory: Optional[str] = None,
+        state_directory: Optional[str] = None,
+        use_cache: bool = True,
+        dtype_policy: str = 'compute',
+        engine: str = 'pandas',
+        streaming: bool = False,
+        chunksize: Optional[int] = None,
+        memory_limit_mb: Optional[float] = None,
+        aggregation_spec: Optional[Dict[str, Sequence[str]]] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        features: Optional[Sequence[str]] = None,
+        shard_directory: Optional[str] = None,
+    ):
         '''
         Initializes the preprocess_installments_payments class.
 
         Args:
-            file_directory (str): Path to the directory where the files are located.
+            file_directory (str): Path to the directory where the files are located, or to the competition zip
+                archive (e.g. 'data/home-credit-default-risk.zip/'), to read the tables without extracting them.
             verbose (bool): Whether to enable verbose logging.
-            dump_to_pickle (bool): Whether to pickle the final preprocessed table.
+            stage_cache (bool): Whether to serve the result from the stage cache, keyed by the content of the input
+                files, the parameters and the code version, and to store it there when it is computed.
+            stage_cache_directory (str, optional): Directory of the stage cache. Defaults to a `stage_cache/` folder
+                next to the input files.
+            state_directory (str, optional): Directory of the per-customer aggregation state kept by `update`.
+                Defaults to a `state/` folder next to the input files.
+            use_cache (bool): Whether to load the raw table through the columnar cache.
+            dtype_policy (str): Dtype policy of the loaded raw table: 'compute' (default) keeps float32 for the
+                aggregations, 'storage' allows float16.
+            engine (str): DataFrame engine loading and aggregating the table, see `engines.ENGINES`. 'polars' runs
+                lazy multi-threaded queries over the columnar cache. The streaming mode always reads pandas chunks.
+            streaming (bool): Whether to aggregate the raw table chunk by chunk instead of loading it in memory.
+            chunksize (int, optional): Number of rows per chunk in streaming mode.
+            memory_limit_mb (float, optional): Memory budget for parsing one chunk in streaming mode, in MB. Only
+                used when `chunksize` is not set.
+            aggregation_spec (Dict[str, Sequence[str]], optional): Statistics computed over SK_ID_CURR for each
+                numerical column, see `aggregation.expand_spec`. Defaults to `AGGREGATION_SPEC`.
+            windows (Dict[str, float], optional): Lower bound of DAYS_INSTALMENT of each recency window, by label.
+                Defaults to `WINDOWS`.
+            window_spec (Dict[str, Sequence[str]], optional): Statistics computed over each recency window for each
+                column. Defaults to `WINDOW_SPEC`, an empty dict disables the windows.
+            features (Sequence[str], optional): Features of the merged tables the result of `main` is restricted
+                to, e.g. `MODEL_PARAMS['features_selected']`: only the raw columns and statistics they need are
+                loaded and computed. Defaults to all the features.
+            shard_directory (str, optional): Directory of the shard of the raw tables to read instead of the
+                whole tables, see `pipeline.run_sharded_stage`. Defaults to the whole tables.
         '''
         self.file_directory = file_directory
         self.verbose = verbose
-        self.dump_to_pickle = dump_to_pickle
+        self.stage_cache = stage_cache
+        self.stage_cache_directory = stage_cache_directory
+        self.state_directory = state_directory
+        self.use_cache = use_cache
+        self.dtype_policy = dtype_policy
+        self.engine = engine
+        self.shard_directory = shard_directory
+        self.backend = get_engine(engine, shard_directory)
+        self.streaming = streaming
+        self.chunksize = chunksize
+        self.memory_limit_mb = memory_limit_mb
+        self.aggregation_spec = aggregation_spec or self.AGGREGATION_SPEC
+        self.windows = self.WINDOWS if windows is None else windows
+        self.window_spec = self.WINDOW_SPEC if window_spec is None else window_spec
+        self.features = None if features is None else list(features)
+        self.projection = FeatureProjection(self.features, prefix='INSTA_')
         self.start = datetime.now()
         logger.info('Preprocessing class initialized.')
 
+    def resolve_features(self):
+        '''
+        Resolves the raw columns and statistics needed for the features.
+
+        Returns:
+            None
+        '''
+        numerical = []
+        if self.features is not None:
+            numerical, _ = table_columns(self.file_directory + 'installments_payments.csv')
+            numerical = [column for column in numerical if column not in ('SK_ID_CURR', 'SK_ID_PREV')]
+        self.projected_spec, self.projected_windows, self.projected_window_spec = self.projection.spec(
+            numerical, self.aggregation_spec, self.windows, self.window_spec
+        )
+        self.usecols = self.projection.usecols(
+            self.file_directory + 'installments_payments.csv',
+            ['SK_ID_CURR', 'DAYS_INSTALMENT', *self.projected_spec, *self.projected_window_spec],
+        )
+
     def load_dataframe(self):
         '''
         Loads the `installments_payments.csv` DataFrame into memory.
@@ -55,8 +161,13 @@ class preprocess_installments_payments:
             logger.info('##########################################################')
             logger.info("Loading the DataFrame, installments_payments.csv, into memory...")
 
-        self.installments_payments = reduce_memory_usage(pd.read_csv(self.file_directory + 'installments_payments.csv'))
-        self.initial_shape = self.installments_payments.shape
+        self.installments_payments = self.backend.read(
+            self.file_directory + 'installments_payments.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols,
+        )
+        self.initial_shape = self.backend.shape(self.installments_payments)
 
         if self.verbose:
             logger.info("Loaded installments_payments.csv")
@@ -80,6 +191,45 @@ class preprocess_installments_payments:
             logger.info("Data Pre-processing and Feature Engineering Done.")
             logger.info('Time Taken: {}', datetime.now() - start)
 
+    def streaming_aggregations(self) -> pd.DataFrame:
+        '''
+        Computes the statistics and the windows over SK_ID_CURR chunk by chunk, without loading the
+        `installments_payments.csv` table into memory. The state of the aggregation of each chunk is merged into the
+        state of the customers, see `aggregation.IncrementalAggregator`, which gives the same features as the
+        aggregation of the whole table.
+
+        Returns:
+            pd.DataFrame: Aggregated numerical features.
+        '''
+        if self.verbose:
+            logger.info('##########################################################')
+            logger.info('#        Pre-processing installments_payments.csv        #')
+            logger.info('##########################################################')
+            logger.info("Streaming the DataFrame, installments_payments.csv, chunk by chunk...")
+
+        aggregator = IncrementalAggregator(
+            'SK_ID_CURR',
+            self.projected_spec,
+            exclude=['SK_ID_PREV'],
+            order_by='DAYS_INSTALMENT',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
+        )
+        n_rows = 0
+        for chunk in iter_raw_table_chunks(
+            self.file_directory + 'installments_payments.csv',
+            chunksize=self.chunksize,
+            memory_limit_mb=self.memory_limit_mb,
+            usecols=self.usecols,
+            dtype_policy=self.dtype_policy,
+        ):
+            aggregator.update(chunk)
+            n_rows += len(chunk)
+        self.initial_shape = (n_rows, chunk.shape[1])
+
+        installments_payments_numerical_aggregated, _ = aggregator.result()
+        return installments_payments_numerical_aggregated
+
     def aggregations_sk_id_curr(self) -> pd.DataFrame:
         '''
         Aggregates the installments payments on previous loans over SK_ID_CURR.
@@ -90,26 +240,133 @@ class preprocess_installments_payments:
         if self.verbose:
             logger.info("Aggregating installments payments over SK_ID_CURR...")
 
-        # Combining numerical features (only numerical features)
-        installments_payments_aggregated = (
-            self.installments_payments.select_dtypes(include=[np.number])
-            .drop('SK_ID_PREV', axis=1)
-            .groupby(by=['SK_ID_CURR'])
-            .mean()
-            .reset_index()
-        )
+        if self.streaming:
+            installments_payments_aggregated = self.streaming_aggregations()
+        else:
+            # Combining numerical features (only numerical features)
+            installments_payments_aggregated = self.backend.aggregate(
+                self.installments_payments,
+                'SK_ID_CURR',
+                self.projected_spec,
+                exclude=['SK_ID_PREV'],
+                order_by='DAYS_INSTALMENT',
+                windows=self.projected_windows,
+                window_spec=self.projected_window_spec,
+            )
+        installments_payments_aggregated = self.rename_aggregations(installments_payments_aggregated)
+
+        if self.verbose:
+            logger.info('Aggregation Done.')
+            logger.info('Size after aggregation: {}', installments_payments_aggregated.shape)
+
+        return installments_payments_aggregated
+
+    def rename_aggregations(self, installments_payments_aggregated: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Prefixes the columns of the aggregated features and fills their missing values.
+
+        Args:
+            installments_payments_aggregated (pd.DataFrame): Aggregated numerical features.
+
+        Returns:
+            pd.DataFrame: Installments payments aggregated over SK_ID_CURR.
+        '''
         installments_payments_aggregated.columns = [
             'INSTA_' + column if column != 'SK_ID_CURR' else column
             for column in installments_payments_aggregated.columns
         ]
         installments_payments_aggregated.fillna(0, inplace=True)
+        return installments_payments_aggregated
+
+    def incremental_aggregator(self) -> IncrementalAggregator:
+        '''
+        Returns the per-customer aggregation state of the table, read from the state directory, or computed over the
+        whole `installments_payments.csv` table, or its shard, and stored there when it is missing, was computed
+        with other parameters or from another version of the table.
+
+        Returns:
+            IncrementalAggregator: Aggregation state of the table.
+        '''
+        self.resolve_features()
+        aggregator = IncrementalAggregator(
+            'SK_ID_CURR',
+            self.projected_spec,
+            exclude=['SK_ID_PREV'],
+            order_by='DAYS_INSTALMENT',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
+        )
+        file_path = self.file_directory + 'installments_payments.csv'
+        stored = IncrementalAggregator.load(self.state_path())
+        source = fingerprint(
+            file_path if self.shard_directory is None else shard_path(self.shard_directory, file_path),
+            previous=stored.source if stored is not None else None,
+        )
+        if stored is not None and stored.parameters() == aggregator.parameters():
+            if stored.source is not None and stored.source['sha256'] == source['sha256']:
+                return stored
+            logger.warning(
+                'installments_payments.csv changed since the aggregation state was stored, computing it again.'
+            )
+        elif stored is not None:
+            logger.warning('The stored aggregation state was computed with other parameters, computing it again.')
+
+        aggregator.update(
+            get_engine('pandas', self.shard_directory).read(
+                file_path, use_cache=self.use_cache, dtype_policy=self.dtype_policy, usecols=self.usecols
+            )
+        )
+        aggregator.source = source
+        aggregator.save(self.state_path())
+        return aggregator
+
+    def state_path(self) -> str:
+        '''Returns the directory of the per-customer aggregation state of the class, within the shard if any.'''
+        if self.shard_directory is not None:
+            return os.path.join(self.shard_directory, 'state', type(self).__name__)
+        state_directory = self.state_directory or os.path.join(
+            source_directory(self.file_directory + 'installments_payments.csv'), 'state'
+        )
+        return os.path.join(state_directory, type(self).__name__)
+
+    def update(self, new_rows: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Refreshes the aggregated features of the customers of new installments payments, without going through the
+        history again.
+
+        The new rows are added to the per-customer aggregation state, computed over the whole table on the first
+        call, and the state is stored back. `installments_payments.csv` itself is not modified: the new rows must
+        not be part of it, nor of a previous update. The state is computed again, without the previous updates, once
+        the table changes. With a shard directory, the state is the one of the shard and the new rows must be those
+        of its customers, see `raw_tables.shard_ids`.
+
+        Args:
+            new_rows (pd.DataFrame): New rows of the installments_payments table, with all its columns.
+
+        Returns:
+            pd.DataFrame: Aggregated features of the customers of the new rows, with the columns of `main`, to
+                replace their rows in the aggregated table.
+        '''
+        start = datetime.now()
+        aggregator = self.incremental_aggregator()
+        customers = aggregator.update(new_rows if self.usecols is None else new_rows[self.usecols])
+        aggregator.save(self.state_path())
+        installments_payments_aggregated, _ = aggregator.result(customers)
+        installments_payments_aggregated = self.projection.select(
+            self.rename_aggregations(installments_payments_aggregated)
+        )
 
         if self.verbose:
-            logger.info('Aggregation Done.')
-            logger.info('Size after aggregation: {}', installments_payments_aggregated.shape)
+            logger.info(
+                'Updated the installments_payments features of {} customers from {} new rows in {}',
+                len(customers),
+                len(new_rows),
+                datetime.now() - start,
+            )
 
         return installments_payments_aggregated
 
+    @cached_stage
     def main(self) -> pd.DataFrame:
         '''
         Performs complete preprocessing and aggregation of the `installments_payments` table.
@@ -117,15 +374,22 @@ class preprocess_installments_payments:
         Returns:
             pd.DataFrame: Final preprocessed and aggregated `installments_payments` table.
         '''
-        # Loading the DataFrame
-        self.load_dataframe()
+        # Resolving what the features need
+        self.resolve_features()
+
+        if not self.streaming:
+            # Loading the DataFrame
+            self.load_dataframe()
 
-        # Performing preprocessing and feature engineering
-        self.data_preprocessing_and_feature_engineering()
+            # Performing preprocessing and feature engineering
+            self.data_preprocessing_and_feature_engineering()
 
         # Aggregating the installments payments over SK_ID_CURR
         installments_payments_aggregated = self.aggregations_sk_id_curr()
 
+        # Keeping only the features
+        installments_payments_aggregated = self.projection.select(installments_payments_aggregated)
+
         if self.verbose:
             logger.info('Done preprocessing installments_payments.')
             logger.info('Initial Size of installments_payments: {}', self.initial_shape)
@@ -135,12 +399,4 @@ class preprocess_installments_payments:
             )
             logger.info('Total Time Taken: {}', datetime.now() - self.start)
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('Pickling pre-processed installments_payments to installments_payments_preprocessed.pkl')
-            with open(self.file_directory + 'installments_payments_preprocessed.pkl', 'wb') as f:
-                pickle.dump(installments_payments_aggregated, f)
-            if self.verbose:
-                logger.info('Pickling completed.')
-
         return installments_payments_aggregated
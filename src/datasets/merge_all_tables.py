@@ -4,11 +4,244 @@ import sys
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import re
-
+import numpy as np
+import pandas as pd
 from loguru import logger
 
-from utils import reduce_memory_usage
+from engines import get_engine
+from utils import clean_column_name, downcast_dtype, reduce_memory_usage
+
+
+def fill_missing_with_zero(table):
+    '''
+    Function to fill the missing values of a table or a column with 0, without the downcasting of the object columns
+    by `fillna`, deprecated by pandas: they are filled through their values and their dtype is inferred afterwards,
+    which gives the same dtypes, e.g. int64 for integers with missing values.
+
+    Inputs:
+        table: DataFrame or Series
+            Table or column to fill
+
+    Returns:
+        The filled table or column
+    '''
+    if isinstance(table, pd.Series):
+        if table.dtype != object:
+            return table.fillna(0)
+        values = table.to_numpy(copy=True)
+        values[pd.isna(values)] = 0
+        return pd.Series(values, index=table.index, name=table.name).infer_objects()
+
+    objects = [column for column, dtype in table.dtypes.items() if dtype == object]
+    if not objects:
+        return table.fillna(0)
+    table = table.fillna({column: 0 for column in table.columns if column not in objects})
+    for column in objects:
+        table[column] = fill_missing_with_zero(table[column])
+    return table
+
+
+def assemble_merged_table(
+    application, aggregated_tables, dropped_columns=(), on='SK_ID_CURR', policy='storage', features=None
+):
+    '''
+    Function to left join an application table with the aggregated tables on SK_ID_CURR in a single pass, filling
+    the missing values with 0, cleaning the column names and reducing the dtypes on the way.
+
+    Each aggregated table is indexed by the key once, and the row of each applicant in it is looked up with
+    `get_indexer`. Every column is then gathered straight into a block preallocated for its final dtype, so the merged
+    table is written once instead of being copied by each merge, the filling, the renaming and `reduce_memory_usage`.
+    Sparse columns, such as sparse category frequencies, are gathered sparse: the applicants missing from their table
+    get the implicit 0, and their values are reduced to float32 at the least, the smallest float LightGBM takes.
+
+    Inputs:
+        application: DataFrame
+            Application table, with the key column
+        aggregated_tables: list of DataFrames
+            Tables joined, one row per key each
+        dropped_columns: collection of str, default = ()
+            Cleaned column names left out of the result, on top of the key
+        on: str, default = 'SK_ID_CURR'
+            Key column
+        policy: str, default = 'storage'
+            Dtype policy of `reduce_memory_usage`
+        features: collection of str, default = None
+            Cleaned names of the only columns kept, on top of TARGET. Defaults to all the columns
+
+    Returns:
+        The same table as the chained merges followed by `fillna(0)`, the renaming, the drop of the columns and
+        `reduce_memory_usage`
+    '''
+    keys = application[on].to_numpy()
+    n_rows = len(application)
+
+    # Source of each column of the result: the column and the positions of the applicants in its table, None for
+    # the columns of the application table itself
+    sources = [(name, application.iloc[:, i], None) for i, name in enumerate(application.columns)]
+    for table in aggregated_tables:
+        index = pd.Index(table[on])
+        if not index.is_unique:
+            raise ValueError(f"The aggregated tables must have one row per {on}.")
+        positions = index.get_indexer(keys)
+        sources.extend((name, table.iloc[:, i], positions) for i, name in enumerate(table.columns) if name != on)
+    dropped_columns = set(dropped_columns) | {on}
+    kept_columns = None if features is None else set(features) | {'TARGET'}
+    sources = [
+        (clean_column_name(name), column, positions)
+        for name, column, positions in sources
+        if clean_column_name(name) not in dropped_columns
+        and (kept_columns is None or clean_column_name(name) in kept_columns)
+    ]
+
+    # Target dtype of each column: its dtype after the merge, downcast to the range of its values once the missing
+    # ones are filled with 0. The range only covers the rows of the aggregated table some applicant matches
+    missing_rows, matched_rows = {}, {}
+    targets, plain_positions, sparse_positions = {}, [], []
+    for position, (name, column, positions) in enumerate(sources):
+        dtype, has_missing = column.dtype, False
+        if isinstance(dtype, pd.SparseDtype):
+            sparse_positions.append(position)
+            continue
+        if positions is not None:
+            if id(positions) not in missing_rows:
+                missing_rows[id(positions)] = positions < 0
+                matched = np.zeros(len(column), dtype=bool)
+                matched[positions[positions >= 0]] = True
+                matched_rows[id(positions)] = matched
+            has_missing = missing_rows[id(positions)].any()
+        if not isinstance(dtype, np.dtype) or dtype.kind not in 'iuf' + ('' if has_missing else 'b'):
+            # Other columns, such as strings or booleans with missing rows, go through a plain reindex
+            plain_positions.append(position)
+            continue
+        values = column.to_numpy()
+        if positions is not None and not matched_rows[id(positions)].all():
+            values = values[matched_rows[id(positions)]]
+        c_min, c_max = (np.fmin.reduce(values), np.fmax.reduce(values)) if len(values) else (np.nan, np.nan)
+        if has_missing or (dtype.kind == 'f' and np.isnan(values).any()):
+            c_min, c_max = np.fmin(c_min, 0), np.fmax(c_max, 0)
+        if has_missing and dtype.kind in 'iu':
+            dtype = np.dtype(np.float64)
+        targets.setdefault(np.dtype(downcast_dtype(dtype, c_min, c_max, policy) or dtype), []).append(position)
+
+    # Gather the columns of each target dtype into a single preallocated block, the missing values set to 0
+    columns = {}
+    for target_type, target_positions in targets.items():
+        block = np.empty((len(target_positions), n_rows), dtype=target_type)
+        for row, position in zip(block, target_positions):
+            _, column, positions = sources[position]
+            values = column.to_numpy()
+            if positions is None:
+                row[:] = values
+            else:
+                missing = missing_rows[id(positions)]
+                row[:] = values.take(np.where(missing, 0, positions)) if len(values) else 0
+                row[missing] = 0
+            if target_type.kind == 'f':
+                row[np.isnan(row)] = 0
+            columns[position] = row
+    for position in plain_positions:
+        _, column, positions = sources[position]
+        column = column.reset_index(drop=True)
+        if positions is not None:
+            # Positions of -1 are not in the index of the column, so they come out missing as after a left merge
+            column = column.reindex(positions).reset_index(drop=True)
+        column = fill_missing_with_zero(column)
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind in 'biuf':
+            # The filling infers a numerical dtype for the booleans with missing rows, reduced like the others
+            values = column.to_numpy()
+            c_min, c_max = (np.fmin.reduce(values), np.fmax.reduce(values)) if len(values) else (np.nan, np.nan)
+            column = column.astype(downcast_dtype(column.dtype, c_min, c_max, policy) or column.dtype)
+        columns[position] = column
+    for position in sparse_positions:
+        _, column, positions = sources[position]
+        values = column.array
+        if positions is not None:
+            values = values.take(positions, allow_fill=True, fill_value=0)
+        values = values.fillna(0)
+        stored = values.sp_values
+        c_min, c_max = (np.fmin.reduce(stored), np.fmax.reduce(stored)) if len(stored) else (0, 0)
+        subtype = values.dtype.subtype
+        subtype = downcast_dtype(subtype, min(c_min, 0), max(c_max, 0), 'compute') or subtype
+        columns[position] = pd.Series(values.astype(pd.SparseDtype(subtype, 0)), index=pd.RangeIndex(n_rows))
+
+    merged = pd.DataFrame(
+        {position: columns[position] for position in range(len(sources))}, index=pd.RangeIndex(n_rows), copy=False
+    )
+    merged.columns = [name for name, _, _ in sources]
+    logger.info('Memory usage of the merged table is {:.2f} MB'.format(merged.memory_usage().sum() / 1024**2))
+    return merged
+
+
+def warn_missing_features(merged, features):
+    '''
+    Function to report the features a merged table does not have, e.g. selected features the preprocessing no longer
+    produces.
+
+    Inputs:
+        merged: DataFrame
+            Merged table
+        features: list of str or None
+            Cleaned names of the features, None for all the columns
+
+    Returns:
+        None
+    '''
+    missing = [feature for feature in features or () if feature not in merged.columns]
+    if missing:
+        logger.warning(f"{len(missing)} features are not produced by any table and are left out: {missing}")
+
+
+def combine_applications(application_train, application_test):
+    '''
+    Function to stack application_train and application_test into one table, for merging both at once.
+
+    The rows of application_train come first, so the split marker is their number: each split is then a slice of
+    the rows of the merged table. The TARGET of the rows of application_test is set to 0, in the dtype of the
+    TARGET of application_train.
+
+    Inputs:
+        application_train: DataFrame
+            Training application table, with TARGET
+        application_test: DataFrame
+            Test application table, with the same columns but TARGET, e.g. as encoded by `ApplicationEncoder`
+
+    Returns:
+        The combined table and the number of training rows
+    '''
+    differing = (set(application_train.columns) ^ set(application_test.columns)) - {'TARGET'}
+    if differing:
+        raise ValueError(
+            f"Columns {sorted(differing)} are not in both application tables, they must share their layout to be "
+            "merged at once."
+        )
+    if 'TARGET' in application_train.columns:
+        target = np.zeros(len(application_test), dtype=application_train['TARGET'].dtype)
+        application_test = application_test.assign(TARGET=target)
+    application = pd.concat([application_train, application_test[application_train.columns]], ignore_index=True)
+    return application, len(application_train)
+
+
+def split_merged_table(merged, n_train):
+    '''
+    Function to split a table merged from `combine_applications` into the training and test tables, as slices
+    sharing its memory.
+
+    Inputs:
+        merged: DataFrame
+            Merged table, the training rows first
+        n_train: int
+            Number of training rows
+
+    Returns:
+        The training table, and the test table without TARGET, both indexed from 0
+    '''
+    app_train_merged = merged.iloc[:n_train]
+    # A shallow copy, so that removing TARGET and resetting the index do not copy the columns
+    app_test_merged = merged.iloc[n_train:].copy(deep=False)
+    if 'TARGET' in app_test_merged.columns:
+        del app_test_merged['TARGET']
+    app_test_merged.index = pd.RangeIndex(len(app_test_merged))
+    return app_train_merged, app_test_merged
 
 
 def merge_all_tables(
@@ -19,6 +252,9 @@ def merge_all_tables(
     installments_aggregated,
     pos_aggregated,
     cc_aggregated,
+    engine='pandas',
+    features=None,
+    combined=False,
 ):
     '''
     Function to merge all the tables together with the application_train and application_test tables
@@ -26,6 +262,17 @@ def merge_all_tables(
 
     Inputs:
         All the previously pre-processed Tables.
+        engine: str, default = 'pandas'
+            DataFrame engine running the joins, see engines.ENGINES. 'pandas' assembles each merged table in a single
+            pass with `assemble_merged_table`, 'polars' runs the joins in one lazy query
+        features: list of str, default = None
+            Features the merged tables are restricted to, on top of TARGET, e.g. MODEL_PARAMS['features_selected'].
+            The features none of the tables has are reported. Defaults to all the columns
+        combined: bool, default = False
+            Whether to merge application_train and application_test at once, stacked with `combine_applications`,
+            instead of one after the other. The joins, the filling and the reduction are done once, over the
+            customers of both, and the tables are returned as slices of the result, so both have the same dtypes.
+            The application tables must have the same columns but TARGET
 
     Returns:
         Single merged tables, one for training data and one for test data
@@ -33,38 +280,75 @@ def merge_all_tables(
 
     logger.info("Merging application_train and application_test with aggregated tables.")
 
-    # merging application_train and application_test with Aggregated bureau table
-    app_train_merged = application_train.merge(bureau_aggregated, on='SK_ID_CURR', how='left')
-    app_test_merged = application_test.merge(bureau_aggregated, on='SK_ID_CURR', how='left')
-    logger.info("Merged with bureau_aggregated.")
-
-    # merging with aggregated previous_applications
-    app_train_merged = app_train_merged.merge(previous_aggregated, on='SK_ID_CURR', how='left')
-    app_test_merged = app_test_merged.merge(previous_aggregated, on='SK_ID_CURR', how='left')
-    logger.info("Merged with previous_aggregated.")
+    aggregated_tables = [
+        bureau_aggregated,
+        previous_aggregated,
+        installments_aggregated,
+        pos_aggregated,
+        cc_aggregated,
+    ]
+    kept_columns = None if features is None else [clean_column_name(feature) for feature in features]
+    if engine != 'pandas' and any(
+        isinstance(dtype, pd.SparseDtype) for table in aggregated_tables for dtype in table.dtypes
+    ):
+        raise ValueError("Sparse columns are only merged by the 'pandas' engine.")
 
-    # merging with aggregated installments tables
-    app_train_merged = app_train_merged.merge(installments_aggregated, on='SK_ID_CURR', how='left')
-    app_test_merged = app_test_merged.merge(installments_aggregated, on='SK_ID_CURR', how='left')
-    logger.info("Merged with installments_aggregated.")
+    if combined:
+        application, n_train = combine_applications(application_train, application_test)
+        if engine == 'pandas':
+            merged = assemble_merged_table(application, aggregated_tables, features=kept_columns)
+        else:
+            merged = get_engine(engine).merge(application, aggregated_tables, on='SK_ID_CURR')
+            merged = fill_missing_with_zero(merged).rename(columns=clean_column_name).drop(['SK_ID_CURR'], axis=1)
+            if kept_columns is not None:
+                merged = merged[[c for c in merged.columns if c in {*kept_columns, 'TARGET'}]]
+            merged = reduce_memory_usage(merged, policy='storage')
+        logger.info(
+            "Merged the combined application tables with bureau_aggregated, previous_aggregated, "
+            "installments_aggregated, pos_aggregated and cc_aggregated, filled missing values with 0, cleaned column "
+            "names and reduced memory usage."
+        )
+        warn_missing_features(merged, kept_columns)
+        return split_merged_table(merged, n_train)
 
-    # merging with aggregated POS_Cash balance table
-    app_train_merged = app_train_merged.merge(pos_aggregated, on='SK_ID_CURR', how='left')
-    app_test_merged = app_test_merged.merge(pos_aggregated, on='SK_ID_CURR', how='left')
-    logger.info("Merged with pos_aggregated.")
+    if engine == 'pandas':
+        # Columns present in only one of train and test are left out, except TARGET; the aggregated tables are
+        # shared, so only the application columns can differ
+        train_cols = {clean_column_name(column) for column in application_train.columns}
+        test_cols = {clean_column_name(column) for column in application_test.columns}
+        app_train_merged = assemble_merged_table(
+            application_train,
+            aggregated_tables,
+            dropped_columns=train_cols - test_cols - {'TARGET'},
+            features=kept_columns,
+        )
+        app_test_merged = assemble_merged_table(
+            application_test, aggregated_tables, dropped_columns=test_cols - train_cols, features=kept_columns
+        )
+        logger.info(
+            "Merged with bureau_aggregated, previous_aggregated, installments_aggregated, pos_aggregated and "
+            "cc_aggregated, filled missing values with 0, cleaned column names and reduced memory usage."
+        )
+        warn_missing_features(app_test_merged, kept_columns)
+        return app_train_merged, app_test_merged
 
-    # merging with aggregated credit card table
-    app_train_merged = app_train_merged.merge(cc_aggregated, on='SK_ID_CURR', how='left')
-    app_test_merged = app_test_merged.merge(cc_aggregated, on='SK_ID_CURR', how='left')
+    # merging application_train and application_test with the aggregated tables, in turn
+    backend = get_engine(engine)
+    app_train_merged = backend.merge(application_train, aggregated_tables, on='SK_ID_CURR')
+    app_test_merged = backend.merge(application_test, aggregated_tables, on='SK_ID_CURR')
+    logger.info(
+        "Merged with bureau_aggregated, previous_aggregated, installments_aggregated, pos_aggregated and "
+        "cc_aggregated."
+    )
 
     # Filling missing values with 0
-    app_train_merged = app_train_merged.fillna(0)
-    app_test_merged = app_test_merged.fillna(0)
+    app_train_merged = fill_missing_with_zero(app_train_merged)
+    app_test_merged = fill_missing_with_zero(app_test_merged)
     logger.info("Filled missing values with 0.")
 
     # Clean column names to remove non-alphanumeric characters
-    app_train_merged = app_train_merged.rename(columns=lambda x: re.sub('[^A-Za-z0-9_]+', '', x))
-    app_test_merged = app_test_merged.rename(columns=lambda x: re.sub('[^A-Za-z0-9_]+', '', x))
+    app_train_merged = app_train_merged.rename(columns=clean_column_name)
+    app_test_merged = app_test_merged.rename(columns=clean_column_name)
     logger.info("Cleaned column names.")
 
     # Ensure the columns are the same for train and test data
@@ -86,9 +370,15 @@ def merge_all_tables(
     app_test_merged = app_test_merged.drop(['SK_ID_CURR'], axis=1)
     logger.info("Removed SK_ID_CURR from the data.")
 
-    # Reduce memory usage
-    app_train_merged = reduce_memory_usage(app_train_merged)
-    app_test_merged = reduce_memory_usage(app_test_merged)
+    if kept_columns is not None:
+        # Keeping only the features
+        app_train_merged = app_train_merged[[c for c in app_train_merged.columns if c in {*kept_columns, 'TARGET'}]]
+        app_test_merged = app_test_merged[[c for c in app_test_merged.columns if c in kept_columns]]
+        warn_missing_features(app_test_merged, kept_columns)
+
+    # Reduce memory usage: the merged tables are final artifacts, so float16 is allowed
+    app_train_merged = reduce_memory_usage(app_train_merged, policy='storage')
+    app_test_merged = reduce_memory_usage(app_test_merged, policy='storage')
     logger.info("Reduced memory usage of the merged tables.")
 
     return app_train_merged, app_test_merged
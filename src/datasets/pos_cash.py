@@ -4,14 +4,18 @@ import sys
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import pickle
 from datetime import datetime
+from typing import Dict, Optional, Sequence, Tuple
 
-import numpy as np
 import pandas as pd
 from loguru import logger
 
-from utils import reduce_memory_usage
+from aggregation import IncrementalAggregator
+from engines import get_engine
+from projection import FeatureProjection, table_columns
+from raw_tables import iter_raw_table_chunks, shard_path
+from stage_cache import cached_stage
+from utils import fingerprint, source_directory
 
 
 class preprocess_POS_CASH_balance:
@@ -23,21 +27,157 @@ class preprocess_POS_CASH_balance:
 
     '''
 
-    def __init__(self, file_directory: str = '', verbose: bool = True, dump_to_pickle: bool = False):
+    # Files read by the class, by attribute holding their directory
+    INPUT_FILES = {'file_directory': ['POS_CASH_balance.csv']}
+
+    # Statistics computed over SK_ID_CURR, '*' standing for the numerical columns not listed
+    AGGREGATION_SPEC = {
+        '*': ['mean'],
+        'MONTHS_BALANCE': ['mean', 'min', 'max', 'count'],
+        'CNT_INSTALMENT': ['mean', 'max'],
+        'CNT_INSTALMENT_FUTURE': ['mean', 'last'],
+        'SK_DPD': ['mean', 'max', 'sum'],
+        'SK_DPD_DEF': ['mean', 'max', 'sum'],
+    }
+
+    # Recency windows, each keeping the rows with MONTHS_BALANCE at least its bound, and the statistics computed
+    # over each of them out of the same sort as the statistics above
+    WINDOWS = {'3M': -3, '6M': -6, '12M': -12, '24M': -24}
+    WINDOW_SPEC = {
+        'MONTHS_BALANCE': ['count'],
+        'CNT_INSTALMENT_FUTURE': ['mean'],
+        'SK_DPD': ['mean', 'sum'],
+        'SK_DPD_DEF': ['mean', 'sum'],
+    }
+
+    # Statistics computed over SK_ID_CURR for each per-loan statistic in hierarchical mode, '*' standing for all
+    CUSTOMER_SPEC = {'*': ['mean', 'max']}
+
+    def __init__(
+        self,
+        file_directory: str = '',
+        verbose: bool = True,
+        stage_cache: bool = True,
+        stage_cache_directory: Optional[str] = None,
+        state_directory: Optional[str] = None,
+        use_cache: bool = True,
+        dtype_policy: str = 'compute',
+        engine: str = 'pandas',
+        streaming: bool = False,
+        chunksize: Optional[int] = None,
+        memory_limit_mb: Optional[float] = None,
+        aggregation_spec: Optional[Dict[str, Sequence[str]]] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        hierarchical: bool = False,
+        customer_spec: Optional[Dict[str, Sequence[str]]] = None,
+        features: Optional[Sequence[str]] = None,
+        shard_directory: Optional[str] = None,
+    ):
         '''
         Initializes the preprocess_POS_CASH_balance class.
 
         Args:
-            file_directory (str): Path to the directory where the files are located.
+            file_directory (str): Path to the directory where the files are located, or to the competition zip
+                archive (e.g. 'data/home-credit-default-risk.zip/'), to read the tables without extracting them.
             verbose (bool): Whether to enable verbose logging.
-            dump_to_pickle (bool): Whether to pickle the final preprocessed table.
+            stage_cache (bool): Whether to serve the result from the stage cache, keyed by the content of the input
+                files, the parameters and the code version, and to store it there when it is computed.
+            stage_cache_directory (str, optional): Directory of the stage cache. Defaults to a `stage_cache/` folder
+                next to the input files.
+            state_directory (str, optional): Directory of the per-customer aggregation state kept by `update`.
+                Defaults to a `state/` folder next to the input files.
+            use_cache (bool): Whether to load the raw table through the columnar cache.
+            dtype_policy (str): Dtype policy of the loaded raw table: 'compute' (default) keeps float32 for the
+                aggregations, 'storage' allows float16.
+            engine (str): DataFrame engine loading and aggregating the table, see `engines.ENGINES`. 'polars' runs
+                lazy multi-threaded queries over the columnar cache. The streaming mode always reads pandas chunks.
+            streaming (bool): Whether to aggregate the raw table chunk by chunk instead of loading it in memory.
+                Not available in hierarchical mode.
+            chunksize (int, optional): Number of rows per chunk in streaming mode.
+            memory_limit_mb (float, optional): Memory budget for parsing one chunk in streaming mode, in MB. Only
+                used when `chunksize` is not set.
+            aggregation_spec (Dict[str, Sequence[str]], optional): Statistics computed over SK_ID_CURR for each
+                numerical column, see `aggregation.expand_spec`. Defaults to `AGGREGATION_SPEC`.
+            windows (Dict[str, float], optional): Lower bound of MONTHS_BALANCE of each recency window, by label.
+                Defaults to `WINDOWS`.
+            window_spec (Dict[str, Sequence[str]], optional): Statistics computed over each recency window for each
+                column. Defaults to `WINDOW_SPEC`, an empty dict disables the windows.
+            hierarchical (bool): Whether to aggregate the numerical columns first per loan (SK_ID_PREV), with the
+                aggregation spec and the windows, and then the per-loan statistics per customer with `customer_spec`.
+            customer_spec (Dict[str, Sequence[str]], optional): Statistics computed over SK_ID_CURR for each per-loan
+                statistic in hierarchical mode. Defaults to `CUSTOMER_SPEC`.
+            features (Sequence[str], optional): Features of the merged tables the result of `main` is restricted
+                to, e.g. `MODEL_PARAMS['features_selected']`: only the raw columns, categories and statistics they
+                need are loaded and computed. Defaults to all the features.
+            shard_directory (str, optional): Directory of the shard of the raw tables to read instead of the
+                whole tables, see `pipeline.run_sharded_stage`. Defaults to the whole tables.
         '''
         self.file_directory = file_directory
         self.verbose = verbose
-        self.dump_to_pickle = dump_to_pickle
+        self.stage_cache = stage_cache
+        self.stage_cache_directory = stage_cache_directory
+        self.state_directory = state_directory
+        self.use_cache = use_cache
+        self.dtype_policy = dtype_policy
+        self.engine = engine
+        self.shard_directory = shard_directory
+        self.backend = get_engine(engine, shard_directory)
+        if streaming and hierarchical:
+            raise ValueError(
+                'The hierarchical aggregation needs all the rows of each loan at once, it cannot be streamed.'
+            )
+        self.streaming = streaming
+        self.chunksize = chunksize
+        self.memory_limit_mb = memory_limit_mb
+        self.aggregation_spec = aggregation_spec or self.AGGREGATION_SPEC
+        self.windows = self.WINDOWS if windows is None else windows
+        self.window_spec = self.WINDOW_SPEC if window_spec is None else window_spec
+        self.hierarchical = hierarchical
+        self.customer_spec = customer_spec or self.CUSTOMER_SPEC
+        self.features = None if features is None else list(features)
+        self.projection = FeatureProjection(self.features, prefix='POS_')
         self.start = datetime.now()
         logger.info('Preprocessing class initialized.')
 
+    def resolve_features(self):
+        '''
+        Resolves the raw columns, categories and statistics needed for the features.
+
+        Returns:
+            None
+        '''
+        numerical, categorical = [], {}
+        if self.features is not None:
+            numerical, categorical = table_columns(self.file_directory + 'POS_CASH_balance.csv')
+            numerical = [column for column in numerical if column not in ('SK_ID_CURR', 'SK_ID_PREV')]
+        if self.hierarchical:
+            (
+                self.projected_spec,
+                self.projected_customer_spec,
+                self.projected_windows,
+                self.projected_window_spec,
+            ) = self.projection.hierarchical_spec(
+                numerical, self.aggregation_spec, self.customer_spec, self.windows, self.window_spec
+            )
+        else:
+            self.projected_spec, self.projected_windows, self.projected_window_spec = self.projection.spec(
+                numerical, self.aggregation_spec, self.windows, self.window_spec
+            )
+            self.projected_customer_spec = self.customer_spec
+        self.projected_categories = self.projection.categories(categorical)
+        self.usecols = self.projection.usecols(
+            self.file_directory + 'POS_CASH_balance.csv',
+            [
+                'SK_ID_CURR',
+                *(['SK_ID_PREV'] if self.hierarchical else []),
+                'MONTHS_BALANCE',
+                *self.projected_spec,
+                *self.projected_window_spec,
+                *(self.projected_categories or ()),
+            ],
+        )
+
     def load_dataframe(self):
         '''
         Loads the `POS_CASH_balance.csv` DataFrame into memory.
@@ -51,8 +191,13 @@ class preprocess_POS_CASH_balance:
             logger.info('#########################################################')
             logger.info("Loading the DataFrame, POS_CASH_balance.csv, into memory...")
 
-        self.pos_cash = reduce_memory_usage(pd.read_csv(self.file_directory + 'POS_CASH_balance.csv'))
-        self.initial_size = self.pos_cash.shape
+        self.pos_cash = self.backend.read(
+            self.file_directory + 'POS_CASH_balance.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols,
+        )
+        self.initial_size = self.backend.shape(self.pos_cash)
 
         if self.verbose:
             logger.info("Loaded POS_CASH_balance.csv")
@@ -76,9 +221,48 @@ class preprocess_POS_CASH_balance:
             logger.info("Data Pre-processing and Feature Engineering Done.")
             logger.info('Time Taken: {}', datetime.now() - start)
 
+    def streaming_aggregations(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        '''
+        Computes the statistics, the windows and the category frequencies over SK_ID_CURR chunk by chunk, without
+        loading the `POS_CASH_balance.csv` table into memory. The state of the aggregation of each chunk is merged into
+        the state of the customers, see `aggregation.IncrementalAggregator`, which gives the same features as the
+        aggregation of the whole table.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: Aggregated numerical and categorical features.
+        '''
+        if self.verbose:
+            logger.info('#########################################################')
+            logger.info('#          Pre-processing POS_CASH_balance.csv          #')
+            logger.info('#########################################################')
+            logger.info("Streaming the DataFrame, POS_CASH_balance.csv, chunk by chunk...")
+
+        aggregator = IncrementalAggregator(
+            'SK_ID_CURR',
+            self.projected_spec,
+            exclude=['SK_ID_PREV'],
+            order_by='MONTHS_BALANCE',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
+        )
+        n_rows = 0
+        for chunk in iter_raw_table_chunks(
+            self.file_directory + 'POS_CASH_balance.csv',
+            chunksize=self.chunksize,
+            memory_limit_mb=self.memory_limit_mb,
+            usecols=self.usecols,
+            dtype_policy=self.dtype_policy,
+        ):
+            aggregator.update(chunk)
+            n_rows += len(chunk)
+        self.initial_size = (n_rows, chunk.shape[1])
+
+        return aggregator.result()
+
     def aggregations_sk_id_curr(self) -> pd.DataFrame:
         '''
-        Aggregates the POS_CASH_balance table over SK_ID_CURR.
+        Aggregates the POS_CASH_balance table over SK_ID_CURR, or in hierarchical mode first over SK_ID_PREV, and
+        then over SK_ID_CURR. Categorical columns are always averaged over SK_ID_CURR.
 
         Returns:
             pd.DataFrame: POS_CASH_balance table aggregated over SK_ID_CURR.
@@ -86,33 +270,149 @@ class preprocess_POS_CASH_balance:
         if self.verbose:
             logger.info("Aggregating POS_CASH_balance over SK_ID_CURR...")
 
-        # Combining numerical features
-        pos_cash_numerical_aggregated = (
-            self.pos_cash.select_dtypes(include=[np.number])
-            .drop('SK_ID_PREV', axis=1)
-            .groupby(by=['SK_ID_CURR'])
-            .mean()
-            .reset_index()
-        )
+        if self.streaming:
+            pos_cash_numerical_aggregated, pos_cash_categorical_aggregated = self.streaming_aggregations()
+        else:
+            # Combining numerical features
+            if self.hierarchical:
+                pos_cash_numerical_aggregated = self.backend.hierarchical_aggregate(
+                    self.pos_cash,
+                    'SK_ID_CURR',
+                    'SK_ID_PREV',
+                    self.projected_spec,
+                    self.projected_customer_spec,
+                    order_by='MONTHS_BALANCE',
+                    windows=self.projected_windows,
+                    window_spec=self.projected_window_spec,
+                )
+            else:
+                pos_cash_numerical_aggregated = self.backend.aggregate(
+                    self.pos_cash,
+                    'SK_ID_CURR',
+                    self.projected_spec,
+                    exclude=['SK_ID_PREV'],
+                    order_by='MONTHS_BALANCE',
+                    windows=self.projected_windows,
+                    window_spec=self.projected_window_spec,
+                )
+
+            # Combining categorical features
+            pos_cash_categorical_aggregated = self.backend.category_frequencies(
+                self.pos_cash, 'SK_ID_CURR', self.projected_categories
+            )
+
+        pos_cash_aggregated = self.combine_aggregations(pos_cash_numerical_aggregated, pos_cash_categorical_aggregated)
+
+        if self.verbose:
+            logger.info('Aggregation Done.')
+            logger.info('Size after aggregation: {}', pos_cash_aggregated.shape)
+
+        return pos_cash_aggregated
+
+    def combine_aggregations(self, numerical: pd.DataFrame, categorical: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Merges the numerical and categorical aggregations, prefixes their columns and fills the missing values.
 
-        # Combining categorical features
-        pos_cash_categorical = pd.get_dummies(self.pos_cash.select_dtypes('object'))
-        pos_cash_categorical['SK_ID_CURR'] = self.pos_cash['SK_ID_CURR']
-        pos_cash_categorical_aggregated = pos_cash_categorical.groupby('SK_ID_CURR').mean().reset_index()
+        Args:
+            numerical (pd.DataFrame): Aggregated numerical features.
+            categorical (pd.DataFrame): Aggregated categorical features.
 
-        # Merge numerical and categorical features
-        pos_cash_aggregated = pos_cash_numerical_aggregated.merge(pos_cash_categorical_aggregated, on='SK_ID_CURR')
+        Returns:
+            pd.DataFrame: POS_CASH_balance table aggregated over SK_ID_CURR.
+        '''
+        pos_cash_aggregated = numerical.merge(categorical, on='SK_ID_CURR')
         pos_cash_aggregated.columns = [
             'POS_' + column if column != 'SK_ID_CURR' else column for column in pos_cash_aggregated.columns
         ]
         pos_cash_aggregated.fillna(0, inplace=True)
+        return pos_cash_aggregated
+
+    def incremental_aggregator(self) -> IncrementalAggregator:
+        '''
+        Returns the per-customer aggregation state of the table, read from the state directory, or computed over the
+        whole `POS_CASH_balance.csv` table, or its shard, and stored there when it is missing, was computed with other
+        parameters or from another version of the table.
+
+        Returns:
+            IncrementalAggregator: Aggregation state of the table.
+        '''
+        if self.hierarchical:
+            raise ValueError('Incremental updates are only available for the aggregation over SK_ID_CURR.')
+        self.resolve_features()
+        aggregator = IncrementalAggregator(
+            'SK_ID_CURR',
+            self.projected_spec,
+            exclude=['SK_ID_PREV'],
+            order_by='MONTHS_BALANCE',
+            windows=self.projected_windows,
+            window_spec=self.projected_window_spec,
+        )
+        file_path = self.file_directory + 'POS_CASH_balance.csv'
+        stored = IncrementalAggregator.load(self.state_path())
+        source = fingerprint(
+            file_path if self.shard_directory is None else shard_path(self.shard_directory, file_path),
+            previous=stored.source if stored is not None else None,
+        )
+        if stored is not None and stored.parameters() == aggregator.parameters():
+            if stored.source is not None and stored.source['sha256'] == source['sha256']:
+                return stored
+            logger.warning('POS_CASH_balance.csv changed since the aggregation state was stored, computing it again.')
+        elif stored is not None:
+            logger.warning('The stored aggregation state was computed with other parameters, computing it again.')
+
+        aggregator.update(
+            get_engine('pandas', self.shard_directory).read(
+                file_path, use_cache=self.use_cache, dtype_policy=self.dtype_policy, usecols=self.usecols
+            )
+        )
+        aggregator.source = source
+        aggregator.save(self.state_path())
+        return aggregator
+
+    def state_path(self) -> str:
+        '''Returns the directory of the per-customer aggregation state of the class, within the shard if any.'''
+        if self.shard_directory is not None:
+            return os.path.join(self.shard_directory, 'state', type(self).__name__)
+        state_directory = self.state_directory or os.path.join(
+            source_directory(self.file_directory + 'POS_CASH_balance.csv'), 'state'
+        )
+        return os.path.join(state_directory, type(self).__name__)
+
+    def update(self, new_rows: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Refreshes the aggregated features of the customers of new POS_CASH_balance months, without going through the
+        history again.
+
+        The new rows are added to the per-customer aggregation state, computed over the whole table on the first
+        call, and the state is stored back. `POS_CASH_balance.csv` itself is not modified: the new rows must not be
+        part of it, nor of a previous update. The state is computed again, without the previous updates, once the
+        table changes. With a shard directory, the state is the one of the shard and the new rows must be those of
+        its customers, see `raw_tables.shard_ids`.
+
+        Args:
+            new_rows (pd.DataFrame): New rows of the POS_CASH_balance table, with all its columns.
+
+        Returns:
+            pd.DataFrame: Aggregated features of the customers of the new rows, with the columns of `main`, to
+                replace their rows in the aggregated table.
+        '''
+        start = datetime.now()
+        aggregator = self.incremental_aggregator()
+        customers = aggregator.update(new_rows if self.usecols is None else new_rows[self.usecols])
+        aggregator.save(self.state_path())
+        pos_cash_aggregated = self.projection.select(self.combine_aggregations(*aggregator.result(customers)))
 
         if self.verbose:
-            logger.info('Aggregation Done.')
-            logger.info('Size after aggregation: {}', pos_cash_aggregated.shape)
+            logger.info(
+                'Updated the POS_CASH_balance features of {} customers from {} new rows in {}',
+                len(customers),
+                len(new_rows),
+                datetime.now() - start,
+            )
 
         return pos_cash_aggregated
 
+    @cached_stage
     def main(self) -> pd.DataFrame:
         '''
         Performs complete preprocessing and aggregation of the `POS_CASH_balance` table.
@@ -120,15 +420,22 @@ class preprocess_POS_CASH_balance:
         Returns:
             pd.DataFrame: Final preprocessed and aggregated `POS_CASH_balance` table.
         '''
-        # Loading the DataFrame
-        self.load_dataframe()
+        # Resolving what the features need
+        self.resolve_features()
 
-        # Performing preprocessing and feature engineering
-        self.data_preprocessing_and_feature_engineering()
+        if not self.streaming:
+            # Loading the DataFrame
+            self.load_dataframe()
+
+            # Performing preprocessing and feature engineering
+            self.data_preprocessing_and_feature_engineering()
 
         # Aggregating the POS_CASH_balance over SK_ID_CURR
         pos_cash_aggregated = self.aggregations_sk_id_curr()
 
+        # Keeping only the features
+        pos_cash_aggregated = self.projection.select(pos_cash_aggregated)
+
         if self.verbose:
             logger.info('Done preprocessing POS_CASH_balance.')
             logger.info('Initial Size of POS_CASH_balance: {}', self.initial_size)
@@ -138,12 +445,4 @@ class preprocess_POS_CASH_balance:
             )
             logger.info('Total Time Taken: {}', datetime.now() - self.start)
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('Pickling pre-processed POS_CASH_balance to POS_CASH_balance_preprocessed.pkl')
-            with open(self.file_directory + 'POS_CASH_balance_preprocessed.pkl', 'wb') as f:
-                pickle.dump(pos_cash_aggregated, f)
-            if self.verbose:
-                logger.info('Pickling completed.')
-
         return pos_cash_aggregated
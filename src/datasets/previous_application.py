@@ -4,14 +4,15 @@ import sys
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-import pickle
 from datetime import datetime
+from typing import Dict, Optional, Sequence
 
-import numpy as np
 import pandas as pd
 from loguru import logger
 
-from utils import reduce_memory_usage
+from engines import get_engine
+from projection import FeatureProjection, table_columns
+from stage_cache import cached_stage
 
 
 class preprocess_previous_application:
@@ -23,25 +24,106 @@ class preprocess_previous_application:
     Attributes:
         file_directory (str): Path to the directory containing the data files.
         verbose (bool): Whether to enable verbose logging.
-        dump_to_pickle (bool): Whether to pickle the final preprocessed table.
+        stage_cache (bool): Whether to serve the result from the stage cache.
+        stage_cache_directory (str, optional): Directory of the stage cache.
+        use_cache (bool): Whether to load the raw table through the columnar cache.
+        dtype_policy (str): Dtype policy of the loaded raw table, 'compute' or 'storage'.
+        engine (str): DataFrame engine loading and aggregating the table, 'pandas' or 'polars'.
+        aggregation_spec (Dict[str, Sequence[str]]): Statistics computed over SK_ID_CURR for each numerical column.
+        features (List[str], optional): Features of the merged tables the result is restricted to.
     '''
 
-    def __init__(self, file_directory: str = '', verbose: bool = True, dump_to_pickle: bool = False):
+    # Files read by the class, by attribute holding their directory
+    INPUT_FILES = {'file_directory': ['previous_application.csv']}
+
+    # Statistics computed over SK_ID_CURR, '*' standing for the numerical columns not listed
+    AGGREGATION_SPEC = {
+        '*': ['mean'],
+        'AMT_ANNUITY': ['mean', 'min', 'max'],
+        'AMT_APPLICATION': ['mean', 'min', 'max'],
+        'AMT_CREDIT': ['mean', 'min', 'max', 'sum'],
+        'AMT_DOWN_PAYMENT': ['mean', 'max'],
+        'RATE_DOWN_PAYMENT': ['mean', 'max'],
+        'DAYS_DECISION': ['mean', 'min', 'max'],
+        'CNT_PAYMENT': ['mean', 'sum'],
+    }
+
+    def __init__(
+        self,
+        file_directory: str = '',
+        verbose: bool = True,
+        stage_cache: bool = True,
+        stage_cache_directory: Optional[str] = None,
+        use_cache: bool = True,
+        dtype_policy: str = 'compute',
+        engine: str = 'pandas',
+        aggregation_spec: Optional[Dict[str, Sequence[str]]] = None,
+        features: Optional[Sequence[str]] = None,
+        shard_directory: Optional[str] = None,
+        sparse: bool = False,
+    ):
         '''
         Initializes the preprocess_previous_application class.
 
         Args:
-            file_directory (str): Path to the directory where the files are located.
+            file_directory (str): Path to the directory where the files are located, or to the competition zip
+                archive (e.g. 'data/home-credit-default-risk.zip/'), to read the tables without extracting them.
             verbose (bool): Whether to enable verbose logging.
-            dump_to_pickle (bool): Whether to pickle the final preprocessed table.
+            stage_cache (bool): Whether to serve the result from the stage cache, keyed by the content of the input
+                files, the parameters and the code version, and to store it there when it is computed.
+            stage_cache_directory (str, optional): Directory of the stage cache. Defaults to a `stage_cache/` folder
+                next to the input files.
+            use_cache (bool): Whether to load the raw table through the columnar cache.
+            dtype_policy (str): Dtype policy of the loaded raw table: 'compute' (default) keeps float32 for the
+                aggregations, 'storage' allows float16.
+            engine (str): DataFrame engine loading and aggregating the table, see `engines.ENGINES`. 'polars' runs
+                lazy multi-threaded queries over the columnar cache.
+            aggregation_spec (Dict[str, Sequence[str]], optional): Statistics computed over SK_ID_CURR for each
+                numerical column, see `aggregation.expand_spec`. Defaults to `AGGREGATION_SPEC`.
+            features (Sequence[str], optional): Features of the merged tables the result is restricted to, e.g.
+                `MODEL_PARAMS['features_selected']`: only the raw columns, categories and statistics they need are
+                loaded and computed. Defaults to all the features.
+            shard_directory (str, optional): Directory of the shard of the raw tables to read instead of the
+                whole tables, see `pipeline.run_sharded_stage`. Defaults to the whole tables.
+            sparse (bool): Whether to return the category frequencies as sparse columns, 0 being implicit, see
+                `aggregation.category_frequencies`.
         '''
         self.file_directory = file_directory
         self.verbose = verbose
-        self.dump_to_pickle = dump_to_pickle
+        self.stage_cache = stage_cache
+        self.stage_cache_directory = stage_cache_directory
+        self.use_cache = use_cache
+        self.dtype_policy = dtype_policy
+        self.engine = engine
+        self.shard_directory = shard_directory
+        self.backend = get_engine(engine, shard_directory)
+        self.sparse = sparse
+        self.aggregation_spec = aggregation_spec or self.AGGREGATION_SPEC
+        self.features = None if features is None else list(features)
+        self.projection = FeatureProjection(self.features, prefix='PREV_')
 
         self.start = datetime.now()
         logger.info('Preprocessing class initialized.')
 
+    def resolve_features(self):
+        '''
+        Resolves the raw columns, categories and statistics needed for the features.
+
+        Returns:
+            None
+        '''
+        numerical, categorical = [], {}
+        if self.features is not None:
+            numerical, categorical = table_columns(self.file_directory + 'previous_application.csv')
+            numerical = [column for column in numerical if column not in ('SK_ID_CURR', 'SK_ID_PREV')]
+        self.projected_spec, _, _ = self.projection.spec(numerical + ['PREV_APP_COUNT'], self.aggregation_spec)
+        self.projected_categories = self.projection.categories(categorical)
+        # SK_ID_PREV is always counted, so that the rows are ordered the same way whatever the features
+        self.usecols = self.projection.usecols(
+            self.file_directory + 'previous_application.csv',
+            ['SK_ID_CURR', 'SK_ID_PREV', 'DAYS_DECISION', *self.projected_spec, *(self.projected_categories or ())],
+        )
+
     def load_dataframe(self):
         '''
         Loads the `previous_application.csv` DataFrame into memory.
@@ -56,8 +138,13 @@ class preprocess_previous_application:
             logger.info("Loading the DataFrame, previous_application.csv, into memory...")
 
         # Loading the DataFrame into memory
-        self.previous_application = reduce_memory_usage(pd.read_csv(self.file_directory + 'previous_application.csv'))
-        self.initial_shape = self.previous_application.shape
+        self.previous_application = self.backend.read(
+            self.file_directory + 'previous_application.csv',
+            use_cache=self.use_cache,
+            dtype_policy=self.dtype_policy,
+            usecols=self.usecols,
+        )
+        self.initial_shape = self.backend.shape(self.previous_application)
 
         if self.verbose:
             logger.info("Loaded previous_application.csv")
@@ -110,28 +197,23 @@ class preprocess_previous_application:
             logger.info("Aggregating previous applications over SK_ID_CURR...")
 
         # Number of previous applications per customer
-        grp = (
-            self.previous_application[['SK_ID_CURR', 'SK_ID_PREV']]
-            .groupby(by=['SK_ID_CURR'])['SK_ID_PREV']
-            .count()
-            .reset_index()
-            .rename(columns={'SK_ID_PREV': 'PREV_APP_COUNT'})
+        self.previous_application = self.backend.add_group_count(
+            self.previous_application, 'SK_ID_CURR', 'SK_ID_PREV', 'PREV_APP_COUNT'
         )
-        self.previous_application = self.previous_application.merge(grp, on=['SK_ID_CURR'], how='right')
 
         # Combining numerical features
-        previous_numerical_aggregated = (
-            self.previous_application.select_dtypes(include=[np.number])
-            .drop('SK_ID_PREV', axis=1)
-            .groupby(by=['SK_ID_CURR'])
-            .mean()
-            .reset_index()
+        previous_numerical_aggregated = self.backend.aggregate(
+            self.previous_application,
+            'SK_ID_CURR',
+            self.projected_spec,
+            exclude=['SK_ID_PREV'],
+            order_by='DAYS_DECISION',
         )
 
         # Combining categorical features
-        previous_categorical = pd.get_dummies(self.previous_application.select_dtypes('object'))
-        previous_categorical['SK_ID_CURR'] = self.previous_application['SK_ID_CURR']
-        previous_categorical_aggregated = previous_categorical.groupby('SK_ID_CURR').mean().reset_index()
+        previous_categorical_aggregated = self.backend.category_frequencies(
+            self.previous_application, 'SK_ID_CURR', self.projected_categories, sparse=self.sparse
+        )
 
         # Merge numerical and categorical features
         previous_aggregated = previous_numerical_aggregated.merge(previous_categorical_aggregated, on='SK_ID_CURR')
@@ -146,6 +228,7 @@ class preprocess_previous_application:
 
         return previous_aggregated
 
+    @cached_stage
     def main(self) -> pd.DataFrame:
         '''
         Performs complete preprocessing and aggregation of the `previous_application` table.
@@ -153,6 +236,9 @@ class preprocess_previous_application:
         Returns:
             pd.DataFrame: Final preprocessed and aggregated `previous_application` table.
         '''
+        # Resolving what the features need
+        self.resolve_features()
+
         # Loading the DataFrame
         self.load_dataframe()
 
@@ -165,6 +251,9 @@ class preprocess_previous_application:
         # Aggregating data over SK_ID_CURR and merging with application_bureau
         previous_aggregated = self.aggregations()
 
+        # Keeping only the features
+        previous_aggregated = self.projection.select(previous_aggregated)
+
         if self.verbose:
             logger.info('Done aggregations.')
             logger.info('Initial Size of previous_application: {}', self.initial_shape)
@@ -174,12 +263,4 @@ class preprocess_previous_application:
             )
             logger.info('Total Time Taken: {}', datetime.now() - self.start)
 
-        if self.dump_to_pickle:
-            if self.verbose:
-                logger.info('Pickling pre-processed previous_application to previous_application_preprocessed.pkl')
-            with open(self.file_directory + 'previous_application_preprocessed.pkl', 'wb') as f:
-                pickle.dump(previous_aggregated, f)
-            if self.verbose:
-                logger.info('Pickling completed.')
-
         return previous_aggregated
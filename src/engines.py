@@ -0,0 +1,565 @@
+"""DataFrame engines the preprocess_* classes and `merge_all_tables` load, aggregate and join their tables with."""
+
+import os
+import sys
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset
+
+try:
+    import polars as pl
+except ImportError:
+    # Optional dependency, only needed by the polars engine
+    pl = None
+
+# Add the current directory to the Python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from aggregation import (
+    SortedSegments,
+    _check_windows,
+    _narrow_half,
+    _statistic_dtype,
+    category_frequencies,
+    expand_spec,
+    hierarchical_aggregate,
+    segment_aggregate,
+    statistic_name,
+)
+from raw_tables import columnar_cache_path, read_raw_table, read_shard, shard_path
+from schemas import load_schema
+from utils import open_source, policy_dtype, split_archive_path
+
+ENGINES = ('pandas', 'polars')
+
+
+def map_categories(values: pd.Series, function: Callable[[str], float]) -> np.ndarray:
+    '''
+    Map the values of a categorical column to numbers, calling `function` once per category rather than per row.
+
+    Args:
+        values (pd.Series): Values of the column.
+        function (Callable[[str], float]): Number of a category.
+
+    Returns:
+        np.ndarray: float32 array of the number of each value, NaN for missing values.
+    '''
+    values = values.astype('category')
+    numbers = np.array([function(category) for category in values.cat.categories.astype(str)], dtype=np.float32)
+    codes = values.cat.codes.to_numpy()
+    return np.where(codes >= 0, numbers[codes], np.nan).astype(np.float32)
+
+
+def streak_names(column: str) -> Tuple[str, str]:
+    '''Names of the longest and of the last run of positive values of a column, see `PandasEngine.aggregate`.'''
+    return f'{column}_STREAK_MAX', f'{column}_STREAK_LAST'
+
+
+class PandasEngine:
+    '''
+    Eager engine: tables are pandas DataFrames held in memory, aggregated with the sort-based kernels of
+    `aggregation`.
+
+    Attributes:
+        shard_directory (str, optional): Directory of the shard of the raw tables read instead of the whole tables,
+            see `pipeline.run_sharded_stage`.
+    '''
+
+    name = 'pandas'
+
+    def __init__(self, shard_directory: Optional[str] = None):
+        self.shard_directory = shard_directory
+
+    def read(
+        self,
+        file_path: str,
+        use_cache: bool = True,
+        dtype_policy: str = 'storage',
+        usecols: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        '''
+        Load a raw CSV table, see `raw_tables.read_raw_table`.
+
+        Args:
+            file_path (str): Path of the CSV file.
+            use_cache (bool): Whether to go through the columnar cache.
+            dtype_policy (str): "storage" or "compute".
+            usecols (List[str], optional): Subset of columns to load. Defaults to all the columns of the table.
+
+        Returns:
+            pd.DataFrame: The table, or its rows in the shard of the engine.
+        '''
+        if self.shard_directory is not None:
+            return read_shard(self.shard_directory, file_path, usecols=usecols)
+        return read_raw_table(file_path, use_cache=use_cache, usecols=usecols, dtype_policy=dtype_policy)
+
+    def shape(self, table: pd.DataFrame) -> Tuple[int, int]:
+        '''Return the number of rows and columns of a table.'''
+        return table.shape
+
+    def map_categories(
+        self, table: pd.DataFrame, column: str, name: str, function: Callable[[str], float]
+    ) -> pd.DataFrame:
+        '''
+        Add a float32 column holding a number computed from the category of another column, see `map_categories`.
+
+        Args:
+            table (pd.DataFrame): Rows of the table.
+            column (str): Categorical column.
+            name (str): Name of the new column.
+            function (Callable[[str], float]): Number of a category.
+
+        Returns:
+            pd.DataFrame: The table with the new column.
+        '''
+        table[name] = map_categories(table[column], function)
+        return table
+
+    def add_group_count(self, table: pd.DataFrame, key: str, column: str, name: str) -> pd.DataFrame:
+        '''
+        Add the number of non-missing values of a column within the group of each row. Rows with a missing key are
+        dropped.
+
+        Args:
+            table (pd.DataFrame): Rows of the table.
+            key (str): Column to group by.
+            column (str): Column whose values are counted.
+            name (str): Name of the new column.
+
+        Returns:
+            pd.DataFrame: The table with the new column.
+        '''
+        counts = table[[key, column]].groupby(by=[key])[column].count().reset_index().rename(columns={column: name})
+        return table.merge(counts, on=[key], how='right')
+
+    def join(self, table: pd.DataFrame, other: pd.DataFrame, on: str) -> pd.DataFrame:
+        '''
+        Left join a table with another one holding at most one row per key, such as an aggregated table.
+
+        Args:
+            table (pd.DataFrame): Rows of the table, at most one per key.
+            other (pd.DataFrame): Table joined, at most one row per key.
+            on (str): Key column.
+
+        Returns:
+            pd.DataFrame: The joined table, in the order of `table`.
+        '''
+        return table.merge(other, on=[on], how='left', validate='one_to_one')
+
+    def aggregate(
+        self,
+        table: pd.DataFrame,
+        key: str,
+        spec: Dict[str, Sequence[str]],
+        exclude: Sequence[str] = (),
+        order_by: Optional[str] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        streaks: Sequence[str] = (),
+    ) -> pd.DataFrame:
+        '''
+        Compute statistics of the numerical columns of a table per group, see `aggregation.segment_aggregate`.
+
+        Args:
+            table (pd.DataFrame): Rows of the table.
+            key (str): Column to group by.
+            spec (Dict[str, Sequence[str]]): Statistics to compute for each column, see `aggregation.expand_spec`.
+            exclude (Sequence[str]): Numerical columns left out of the aggregation.
+            order_by (str, optional): Column ordering the rows within each group.
+            windows (Dict[str, float], optional): Lower bound of `order_by` of each recency window, by label.
+            window_spec (Dict[str, Sequence[str]], optional): Statistics to compute over each window.
+            streaks (Sequence[str]): Columns whose runs of consecutive positive values within each group, in the
+                order of `order_by`, are measured: the longest and the one ending on the last row, named with
+                `streak_names`.
+
+        Returns:
+            pd.DataFrame: One row per group sorted by key, with the key as first column.
+        '''
+        segments = SortedSegments(table[key], None if order_by is None else table[order_by])
+        aggregated = segment_aggregate(
+            table, key, spec, exclude, order_by=order_by, windows=windows, window_spec=window_spec, segments=segments
+        )
+        for column in streaks:
+            longest, last = segments.streaks(segments.take(table[column].to_numpy() > 0))
+            longest_name, last_name = streak_names(column)
+            aggregated[longest_name] = longest
+            aggregated[last_name] = last
+        return aggregated
+
+    def hierarchical_aggregate(
+        self,
+        table: pd.DataFrame,
+        key: str,
+        inner_key: str,
+        inner_spec: Dict[str, Sequence[str]],
+        spec: Dict[str, Sequence[str]],
+        exclude: Sequence[str] = (),
+        order_by: Optional[str] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+    ) -> pd.DataFrame:
+        '''Aggregate a table over two nested levels, see `aggregation.hierarchical_aggregate`.'''
+        return hierarchical_aggregate(
+            table,
+            key,
+            inner_key,
+            inner_spec,
+            spec,
+            exclude,
+            order_by=order_by,
+            windows=windows,
+            window_spec=window_spec,
+        )
+
+    def category_frequencies(
+        self,
+        table: pd.DataFrame,
+        key: str,
+        categories: Optional[Dict[str, Optional[Sequence[str]]]] = None,
+        sparse: bool = False,
+    ) -> pd.DataFrame:
+        '''Compute the frequency of each category within each group, see `aggregation.category_frequencies`.'''
+        return category_frequencies(table, key, categories, sparse=sparse)
+
+    def merge(self, table: pd.DataFrame, others: Sequence[pd.DataFrame], on: str) -> pd.DataFrame:
+        '''
+        Left join a table with several aggregated tables in turn.
+
+        Args:
+            table (pd.DataFrame): Left table.
+            others (Sequence[pd.DataFrame]): Tables joined, one row per key each.
+            on (str): Key column.
+
+        Returns:
+            pd.DataFrame: The joined table, in the order of `table`.
+        '''
+        for other in others:
+            table = table.merge(other, on=on, how='left')
+        return table
+
+
+def _polars_dtype(dtype) -> 'pl.DataType':
+    # Polars type of the Series built from a NumPy array of that dtype
+    return pl.Series(np.empty(0, dtype=dtype)).dtype
+
+
+class PolarsEngine:
+    '''
+    Lazy engine: tables are polars LazyFrames scanning the columnar cache, or the CSV file, and every aggregation is
+    a query run by the multi-threaded streaming executor of polars.
+
+    The table is never materialized as a whole: only the columns an aggregation uses are read from the scan, the
+    filters of the recency windows are evaluated within the group-by, and only the aggregated rows are collected.
+    They are converted to pandas with the column names, the column order and the dtypes of the pandas engine, and
+    the same values up to the rounding of the float sums.
+    '''
+
+    name = 'polars'
+
+    def __init__(self, shard_directory: Optional[str] = None):
+        if pl is None:
+            raise ImportError("The polars engine needs the polars package, install it with `pip install polars`.")
+        self.shard_directory = shard_directory
+
+    def read(
+        self,
+        file_path: str,
+        use_cache: bool = True,
+        dtype_policy: str = 'storage',
+        usecols: Optional[List[str]] = None,
+    ) -> 'pl.LazyFrame':
+        '''
+        Scan a raw CSV table lazily, with the dtypes of its schema. See `PandasEngine.read`.
+
+        With the cache, the Feather file of the columnar cache is scanned, after building it if needed. Without it,
+        the CSV file is scanned with the schema dtypes, or parsed at once when it is a member of a zip archive. The
+        engine of a shard scans the Feather file of the shard instead.
+        Categorical columns get the vocabulary of the schema as an Enum, so that unobserved categories are kept
+        like with the pandas engine.
+        '''
+        schema = load_schema(file_path)
+        if self.shard_directory is not None:
+            dataset = pyarrow.dataset.dataset(shard_path(self.shard_directory, file_path), format='feather')
+            table = pl.scan_pyarrow_dataset(dataset)
+        elif use_cache:
+            # Scanned through a pyarrow dataset, which still pushes the projections and filters down: the IPC reader
+            # of polars rejects the categorical columns pandas writes with missing values
+            dataset = pyarrow.dataset.dataset(
+                columnar_cache_path(file_path, dtype_policy=dtype_policy), format='feather'
+            )
+            table = pl.scan_pyarrow_dataset(dataset)
+        else:
+            table = self._scan_csv(file_path, schema, dtype_policy)
+        if usecols is not None:
+            table = table.select(column for column in table.collect_schema().names() if column in usecols)
+        columns = table.collect_schema().names()
+        return table.with_columns(
+            pl.col(column).cast(pl.String).cast(pl.Enum(categories))
+            for column, categories in schema['categories'].items()
+            if column in columns
+        )
+
+    def _scan_csv(self, file_path: str, schema: dict, dtype_policy: str) -> 'pl.LazyFrame':
+        dtypes, casts = {}, []
+        for column, dtype in schema['columns'].items():
+            if column in schema['categories'] or dtype == 'category':
+                dtypes[column] = pl.String
+            elif dtype.startswith('float'):
+                # Parsed as float64 and rounded to float32, then to float16, like the pandas parser does
+                dtypes[column] = pl.Float64
+                dtype = policy_dtype(dtype, dtype_policy)
+                if dtype != 'float64':
+                    casts.append(pl.col(column).cast(pl.Float32).cast(_polars_dtype(dtype)))
+            else:
+                dtypes[column] = _polars_dtype(dtype)
+
+        archive_path, _ = split_archive_path(file_path)
+        if archive_path is None:
+            table = pl.scan_csv(file_path, schema_overrides=dtypes)
+        else:
+            # Members of an archive cannot be scanned, they are decompressed and parsed at once
+            with open_source(file_path) as f:
+                table = pl.read_csv(f, schema_overrides=dtypes).lazy()
+        return table.with_columns(casts)
+
+    def shape(self, table: 'pl.LazyFrame') -> Tuple[int, int]:
+        '''Return the number of rows and columns of a table, counting the rows of the scan.'''
+        return table.select(pl.len()).collect().item(), len(table.collect_schema())
+
+    def _categories(self, table: 'pl.LazyFrame', column: str) -> List[str]:
+        dtype = table.collect_schema()[column]
+        if isinstance(dtype, pl.Enum):
+            return dtype.categories.to_list()
+        # Columns without vocabulary get their sorted values as categories, like pd.Categorical does
+        values = table.select(pl.col(column).cast(pl.String).drop_nulls().unique().sort()).collect()
+        return values.to_series().to_list()
+
+    def map_categories(
+        self, table: 'pl.LazyFrame', column: str, name: str, function: Callable[[str], float]
+    ) -> 'pl.LazyFrame':
+        '''See `PandasEngine.map_categories`.'''
+        categories = self._categories(table, column)
+        numbers = [function(category) for category in categories]
+        return table.with_columns(
+            pl.col(column).cast(pl.String).replace_strict(categories, numbers, return_dtype=pl.Float32).alias(name)
+        )
+
+    def add_group_count(self, table: 'pl.LazyFrame', key: str, column: str, name: str) -> 'pl.LazyFrame':
+        '''See `PandasEngine.add_group_count`.'''
+        return table.filter(pl.col(key).is_not_null()).with_columns(
+            pl.col(column).count().over(key).cast(pl.Int64).alias(name)
+        )
+
+    def join(self, table: 'pl.LazyFrame', other: pd.DataFrame, on: str) -> 'pl.LazyFrame':
+        '''See `PandasEngine.join`.'''
+        keys = pl.from_pandas(other[[on]]).lazy().with_columns(pl.col(on).cast(table.collect_schema()[on]))
+        if table.join(keys, on=on, how='anti').select(pl.len()).collect().item():
+            # Rows without a match turn the integer columns of `other` into float64 in a pandas merge: they are
+            # converted the same way, so that both engines aggregate the same dtypes
+            other = other.astype(
+                {
+                    column: np.float64
+                    for column, dtype in other.dtypes.items()
+                    if column != on and pd.api.types.is_integer_dtype(dtype)
+                }
+            )
+        other = pl.from_pandas(other).lazy().with_columns(pl.col(on).cast(table.collect_schema()[on]))
+        return table.join(other, on=on, how='left', validate='1:1', maintain_order='left')
+
+    def _frame(self, table: 'pl.LazyFrame') -> pd.DataFrame:
+        # Empty pandas frame with the columns and dtypes the table has once converted, to resolve the specs with
+        return table.clear().collect().to_pandas()
+
+    def _ordered(self, values: 'pl.Expr', order_by: Optional[str]) -> 'pl.Expr':
+        # Values of a group in the order of the order column, with its missing values last and ties keeping the
+        # table order. Only the columns needing an order are sorted, within each group
+        if order_by is None:
+            return values
+        return values.sort_by(order_by, nulls_last=True, maintain_order=True)
+
+    def _statistic(self, values: 'pl.Expr', statistic: str, dtype: np.dtype, order_by: Optional[str]) -> 'pl.Expr':
+        if statistic == 'count':
+            return values.count()
+        if statistic in ('min', 'max'):
+            return getattr(values, statistic)()
+        if statistic in ('first', 'last'):
+            return getattr(self._ordered(values, order_by).drop_nulls(), statistic)()
+        if statistic == 'sum' and not pd.api.types.is_float_dtype(dtype):
+            return values.cast(pl.Int64).sum()
+        # Sums, means and variances are computed in float64 whatever the dtype of the values
+        values = values.cast(pl.Float64)
+        if statistic in ('std', 'var'):
+            return getattr(values, statistic)(ddof=1)
+        return getattr(values, statistic)()
+
+    def _expressions(
+        self,
+        frame: pd.DataFrame,
+        spec: Dict[str, Sequence[str]],
+        key: str,
+        exclude: Sequence[str],
+        order_by: Optional[str],
+        windows: Dict[str, float],
+        window_spec: Dict[str, Sequence[str]],
+        name: Callable[..., str] = statistic_name,
+    ) -> Dict[str, Tuple['pl.Expr', np.dtype]]:
+        # Expression and result dtype of each statistic, in the column order of `segment_aggregate`
+        expanded = expand_spec(frame, spec, key, exclude)
+        windowed = expand_spec(frame, window_spec, key, exclude) if windows else {}
+        expressions = {}
+        for column in frame.columns:
+            dtype = frame[column].dtype
+            for statistic in expanded.get(column, []):
+                expression = self._statistic(pl.col(column), statistic, dtype, order_by)
+                expressions[name(column, statistic)] = expression, _statistic_dtype(dtype, statistic)
+            for label, lower in windows.items() if column in windowed else ():
+                values = pl.col(column).filter(pl.col(order_by) >= lower)
+                for statistic in windowed[column]:
+                    expression = self._statistic(values, statistic, dtype, order_by)
+                    expressions[name(column, statistic, label)] = expression, _statistic_dtype(dtype, statistic)
+        return expressions
+
+    def _reduce(
+        self,
+        table: 'pl.LazyFrame',
+        key: str,
+        expressions: Dict[str, Tuple['pl.Expr', np.dtype]],
+        half_columns: Sequence[str] = (),
+    ) -> pd.DataFrame:
+        aggregated = (
+            table.filter(pl.col(key).is_not_null())
+            .group_by(key)
+            .agg(expression.alias(name) for name, (expression, _) in expressions.items())
+            .sort(key)
+            .collect(engine='streaming')
+            .to_pandas()
+        )
+        aggregated = aggregated.astype({name: dtype for name, (_, dtype) in expressions.items()})
+        for column in half_columns:
+            aggregated[column] = _narrow_half(aggregated[column].to_numpy())
+        return aggregated
+
+    def _half_means(self, frame: pd.DataFrame, expressions: dict, name: Callable[..., str] = statistic_name):
+        # Means of float16 columns, narrowed back to float16 when lossless like with `groupby().mean()`
+        return [
+            name(column, 'mean')
+            for column, dtype in frame.dtypes.items()
+            if dtype == np.float16 and name(column, 'mean') in expressions
+        ]
+
+    def aggregate(
+        self,
+        table: 'pl.LazyFrame',
+        key: str,
+        spec: Dict[str, Sequence[str]],
+        exclude: Sequence[str] = (),
+        order_by: Optional[str] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        streaks: Sequence[str] = (),
+    ) -> pd.DataFrame:
+        '''See `PandasEngine.aggregate`.'''
+        windows, window_spec = _check_windows(windows, window_spec, order_by)
+        frame = self._frame(table)
+        expressions = self._expressions(frame, spec, key, exclude, order_by, windows, window_spec)
+        for column in streaks:
+            flags = self._ordered((pl.col(column) > 0).fill_null(False), order_by)
+            runs = flags.rle()
+            longest_name, last_name = streak_names(column)
+            longest = runs.filter(runs.struct.field('value')).struct.field('len').max().fill_null(0)
+            last = pl.when(flags.last()).then(runs.struct.field('len').last()).otherwise(0)
+            expressions[longest_name] = longest, np.dtype(np.int64)
+            expressions[last_name] = last, np.dtype(np.int64)
+        return self._reduce(table, key, expressions, self._half_means(frame, expressions))
+
+    def hierarchical_aggregate(
+        self,
+        table: 'pl.LazyFrame',
+        key: str,
+        inner_key: str,
+        inner_spec: Dict[str, Sequence[str]],
+        spec: Dict[str, Sequence[str]],
+        exclude: Sequence[str] = (),
+        order_by: Optional[str] = None,
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+    ) -> pd.DataFrame:
+        '''See `PandasEngine.hierarchical_aggregate`.'''
+        windows, window_spec = _check_windows(windows, window_spec, order_by)
+        frame = self._frame(table)
+        expressions = self._expressions(frame, inner_spec, inner_key, [key, *exclude], order_by, windows, window_spec)
+        # The outer key of each inner group, read on its first row
+        outer_key = {key: (self._ordered(pl.col(key), order_by).first(), frame[key].dtype)}
+        half_columns = self._half_means(frame, expressions)
+        inner = self._reduce(table, inner_key, {**outer_key, **expressions}, half_columns).drop(columns=inner_key)
+
+        def name(column: str, statistic: str) -> str:
+            return f'{column}_{statistic.upper()}'
+
+        outer_expressions = {statistic_name(inner_key, 'count'): (pl.len(), np.dtype(np.int64))}
+        outer_expressions.update(self._expressions(inner.iloc[:0], spec, key, (), None, {}, {}, name=name))
+        return self._reduce(
+            pl.from_pandas(inner).lazy(), key, outer_expressions, self._half_means(inner, outer_expressions, name)
+        )
+
+    def category_frequencies(
+        self,
+        table: 'pl.LazyFrame',
+        key: str,
+        categories: Optional[Dict[str, Optional[Sequence[str]]]] = None,
+        sparse: bool = False,
+    ) -> pd.DataFrame:
+        '''See `PandasEngine.category_frequencies`. Sparse frequencies are computed dense, then converted.'''
+        frame = self._frame(table)
+        expressions = {}
+        for column in frame.select_dtypes(['object', 'category']).columns.drop(key, errors='ignore'):
+            if categories is not None and column not in categories:
+                continue
+            kept = None if categories is None or categories[column] is None else set(categories[column])
+            column_categories = self._categories(table, column)
+            if isinstance(table.collect_schema()[column], pl.Enum):
+                # Compared on the category codes
+                values, categories_values = pl.col(column).to_physical(), range(len(column_categories))
+            else:
+                values, categories_values = pl.col(column).cast(pl.String), column_categories
+            for category, value in zip(column_categories, categories_values):
+                if kept is not None and category not in kept:
+                    continue
+                frequency = (values == value).sum() / pl.len()
+                expressions[f'{column}_{category}'] = frequency, np.dtype(np.float64)
+        frequencies = self._reduce(table, key, expressions)
+        if sparse:
+            frequencies = frequencies.astype({name: pd.SparseDtype(np.float64, 0) for name in expressions})
+        return frequencies
+
+    def merge(self, table: pd.DataFrame, others: Sequence[pd.DataFrame], on: str) -> pd.DataFrame:
+        '''See `PandasEngine.merge`. The joins run in a single lazy query.'''
+        merged = pl.from_pandas(table).lazy()
+        key_dtype = merged.collect_schema()[on]
+        for other in others:
+            other = pl.from_pandas(other).lazy().with_columns(pl.col(on).cast(key_dtype))
+            merged = merged.join(other, on=on, how='left', maintain_order='left')
+        # Converted back to pandas before any filling: integer columns with missing values become float64 and
+        # boolean ones object, like after a pandas merge
+        return merged.collect(engine='streaming').to_pandas()
+
+
+def get_engine(name: str, shard_directory: Optional[str] = None) -> Union[PandasEngine, PolarsEngine]:
+    '''
+    Return the DataFrame engine of a name.
+
+    Args:
+        name (str): One of `ENGINES`.
+        shard_directory (str, optional): Directory of the shard of the raw tables the engine reads, see
+            `raw_tables.write_shards`. Defaults to the whole tables.
+
+    Returns:
+        Union[PandasEngine, PolarsEngine]: The engine.
+    '''
+    if name == 'pandas':
+        return PandasEngine(shard_directory)
+    if name == 'polars':
+        return PolarsEngine(shard_directory)
+    raise ValueError(f"Unknown engine {name!r}, expected one of {list(ENGINES)}")
@@ -0,0 +1,236 @@
+"""On-disk feature matrix of the customers, memory-mapped by training, notebooks and the scoring apps."""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from settings.params import MODEL_PARAMS
+
+FEATURE_MATRIX_FORMAT_VERSION = 1
+DEFAULT_BATCH_SIZE = 50_000
+
+
+class FeatureMatrix:
+    '''
+    Feature matrix of the customers stored as a directory of NumPy files, opened without being read.
+
+    The features are a contiguous float32 array of one row per customer, in the order of `features`, next to the
+    SK_ID_CURR of each row, the permutation sorting them, the TARGET of the training rows and a JSON manifest.
+    Opening the matrix only maps the files: the rows and columns used are paged in from the disk on first access,
+    and the processes mapping the same matrix share the same physical pages. A customer is found by a binary
+    search of the sorted identifiers, so no index is built when opening the matrix.
+
+    `features`, `get`, `get_frame`, `__len__` and `__contains__` are those of `FeatureStore`, so that the scoring
+    apps can read from either.
+
+    Attributes:
+        path (str): Directory of the matrix.
+        features (List[str]): Names of the columns of the matrix.
+        values (np.ndarray): Read-only float32 array of shape (rows, features), memory-mapped.
+        customer_ids (np.ndarray): SK_ID_CURR of each row, memory-mapped.
+        target (np.ndarray): TARGET of each row, memory-mapped, or None for a matrix without target.
+    '''
+
+    def __init__(self, path: str):
+        '''
+        Opens a feature matrix written by `write`.
+
+        Args:
+            path (str): Directory of the matrix.
+        '''
+        manifest_path = os.path.join(path, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            raise FileNotFoundError(f'No feature matrix at {path}, write it first.')
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != FEATURE_MATRIX_FORMAT_VERSION:
+            raise ValueError(f'The feature matrix at {path} has another format, write it again.')
+
+        self.path = path
+        self.features = manifest['features']
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.customer_ids = np.load(os.path.join(path, 'customer_ids.npy'), mmap_mode='r')
+        self._order = np.load(os.path.join(path, 'customer_order.npy'), mmap_mode='r')
+        self.target = np.load(os.path.join(path, 'target.npy'), mmap_mode='r') if manifest['target'] else None
+        self._columns = {feature: position for position, feature in enumerate(self.features)}
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        table: pd.DataFrame,
+        customer_ids: Optional[Sequence[int]] = None,
+        features: Optional[Sequence[str]] = None,
+        target: str = 'TARGET',
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> 'FeatureMatrix':
+        '''
+        Writes the feature matrix of a table of customers, such as an output of `merge_all_tables`, replacing any
+        matrix at that path.
+
+        The matrix is written to a new directory swapped in at the end: the processes that mapped the previous
+        matrix keep reading it until they open the new one.
+
+        Args:
+            path (str): Directory of the matrix.
+            table (pd.DataFrame): One row per customer, with at least the columns of the features.
+            customer_ids (Sequence[int], optional): SK_ID_CURR of each row. Defaults to the SK_ID_CURR column of the
+                table.
+            features (Sequence[str], optional): Columns of the matrix, in order. Defaults to
+                `MODEL_PARAMS['features_selected']`, the features of the model, like `FeatureStore.publish`.
+            target (str): Column of the target, stored apart from the features when the table has it.
+            batch_size (int): Number of rows converted to float32 at a time.
+
+        Returns:
+            FeatureMatrix: The matrix, opened.
+        '''
+        start = datetime.now()
+        features = list(MODEL_PARAMS['features_selected'] if features is None else features)
+        missing = [feature for feature in features if feature not in table.columns]
+        if missing:
+            raise ValueError(f"Features {missing} are missing from the table.")
+        if customer_ids is None:
+            customer_ids = table['SK_ID_CURR']
+        customer_ids = np.asarray(customer_ids, dtype=np.int64)
+        if len(customer_ids) != len(table):
+            raise ValueError('There must be one SK_ID_CURR per row of the table.')
+        order = np.argsort(customer_ids, kind='stable')
+        if (np.diff(customer_ids[order]) == 0).any():
+            raise ValueError('The customers of a feature matrix must be unique.')
+
+        path = os.path.abspath(path)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        values = np.lib.format.open_memmap(
+            os.path.join(tmp_path, 'values.npy'), mode='w+', dtype=np.float32, shape=(len(table), len(features))
+        )
+        # Converted batch by batch, so that the float32 copy of the whole table is never held in memory
+        for begin in range(0, len(table), batch_size):
+            values[begin : begin + batch_size] = table.iloc[begin : begin + batch_size][features].to_numpy(np.float32)
+        values.flush()
+        del values
+        np.save(os.path.join(tmp_path, 'customer_ids.npy'), customer_ids)
+        np.save(os.path.join(tmp_path, 'customer_order.npy'), order)
+        has_target = target in table.columns
+        if has_target:
+            np.save(os.path.join(tmp_path, 'target.npy'), table[target].to_numpy())
+        manifest = {
+            'version': FEATURE_MATRIX_FORMAT_VERSION,
+            'rows': len(table),
+            'features': features,
+            'target': has_target,
+            'written': datetime.now().isoformat(),
+        }
+        with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        # A directory cannot replace another one at once: the previous matrix is moved aside first
+        previous_path = f'{path}.{os.getpid()}.previous'
+        if os.path.exists(path):
+            os.replace(path, previous_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(previous_path, ignore_errors=True)
+
+        logger.info(
+            'Wrote the {} x {} feature matrix {} in {}', len(table), len(features), path, datetime.now() - start
+        )
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.customer_ids)
+
+    def __contains__(self, customer_id: int) -> bool:
+        return self.position(customer_id) is not None
+
+    def position(self, customer_id: int) -> Optional[int]:
+        '''
+        Finds the row of a customer.
+
+        Args:
+            customer_id (int): SK_ID_CURR of the customer.
+
+        Returns:
+            int: Row of the customer in the matrix, or None if the customer is not in it.
+        '''
+        rank = np.searchsorted(self.customer_ids, customer_id, sorter=self._order)
+        if rank < len(self._order) and self.customer_ids[self._order[rank]] == customer_id:
+            return int(self._order[rank])
+        return None
+
+    def get(self, customer_id: int) -> Optional[np.ndarray]:
+        '''
+        Reads the feature vector of a customer.
+
+        Args:
+            customer_id (int): SK_ID_CURR of the customer.
+
+        Returns:
+            np.ndarray: float32 vector in the order of `features`, or None if the customer is not in the matrix.
+        '''
+        position = self.position(customer_id)
+        return None if position is None else np.array(self.values[position])
+
+    def get_frame(self, customer_ids: Sequence[int]) -> pd.DataFrame:
+        '''
+        Reads the feature vectors of some customers into a table, as the model expects them.
+
+        Args:
+            customer_ids (Sequence[int]): SK_ID_CURR of the customers.
+
+        Returns:
+            pd.DataFrame: SK_ID_CURR and the features of the customers found in the matrix, in the given order.
+        '''
+        found = [(customer_id, self.position(customer_id)) for customer_id in customer_ids]
+        found = [(customer_id, position) for customer_id, position in found if position is not None]
+        frame = pd.DataFrame(self.values[[position for _, position in found]], columns=self.features)
+        frame.insert(0, 'SK_ID_CURR', np.array([customer_id for customer_id, _ in found], dtype=np.int64))
+        return frame
+
+    def to_frame(self, features: Optional[List[str]] = None, target: bool = True) -> pd.DataFrame:
+        '''
+        Reads some columns of all the rows into a table, e.g. the training data of `Trainer`.
+
+        Args:
+            features (List[str], optional): Columns to read. Defaults to all the features.
+            target (bool): Whether to add the TARGET column, when the matrix has it.
+
+        Returns:
+            pd.DataFrame: float32 features in the order of the rows, followed by TARGET.
+        '''
+        if features is None:
+            frame = pd.DataFrame(np.array(self.values), columns=self.features)
+        else:
+            frame = pd.DataFrame(
+                {feature: np.array(self.values[:, self._columns[feature]]) for feature in features}, copy=False
+            )
+        if target and self.target is not None:
+            frame['TARGET'] = np.array(self.target)
+        return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a table of customer features as a feature matrix.')
+    parser.add_argument('table', help='CSV or Feather file with a SK_ID_CURR column, e.g. test_data_final.csv')
+    parser.add_argument('matrix', help='Directory of the feature matrix')
+    args = parser.parse_args()
+
+    if args.table.endswith('.feather'):
+        table = pd.read_feather(args.table)
+    else:
+        table = pd.read_csv(args.table, index_col=0)
+    FeatureMatrix.write(args.matrix, table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""Online store of the per-customer feature vectors served to the scoring API and dashboard."""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from settings.params import MODEL_PARAMS
+
+FEATURE_STORE_FORMAT_VERSION = 1
+DEFAULT_BATCH_SIZE = 10_000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS feature_vectors (SK_ID_CURR INTEGER PRIMARY KEY, vector BLOB NOT NULL);
+'''
+
+
+class FeatureStore:
+    '''
+    Embedded key-value store of the feature vectors of the customers, keyed by SK_ID_CURR.
+
+    The vectors are packed float32 arrays in a fixed feature order, by default `MODEL_PARAMS['features_selected']`,
+    stored in a SQLite file. A lookup is a single primary key read, so serving one customer neither loads the dataset
+    nor depends on its size. `publish` writes its rows in batches within a single transaction: readers keep seeing
+    the previous vectors until it commits, then see all the new ones, without reopening the store.
+
+    Attributes:
+        path (str): Path of the SQLite file.
+        read_only (bool): Whether the store was opened for reading only.
+    '''
+
+    def __init__(self, path: str, read_only: bool = False):
+        '''
+        Opens a feature store, creating it if needed.
+
+        Args:
+            path (str): Path of the SQLite file.
+            read_only (bool): Whether to open an existing store for reading only, as the serving apps do.
+        '''
+        self.path = path
+        self.read_only = read_only
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f'No feature store at {path}, publish the features first.')
+            self._connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            # Write-ahead logging lets the readers go on while a publication is being written
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(_SCHEMA)
+        # One connection shared by the threads of the app
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._features = None
+
+    def close(self):
+        '''Closes the connection to the store.'''
+        self._connection.close()
+
+    def __enter__(self) -> 'FeatureStore':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _metadata(self) -> dict:
+        return dict(self._connection.execute('SELECT name, value FROM metadata'))
+
+    @property
+    def features(self) -> Optional[List[str]]:
+        '''Names of the features, in the order of the vectors, or None before the first publication.'''
+        with self._lock:
+            # Read again once another connection committed, so that a republished layout is picked up
+            data_version = self._connection.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                features = self._metadata().get('features')
+                self._features = None if features is None else json.loads(features)
+                self._data_version = data_version
+            return self._features
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM feature_vectors').fetchone()[0]
+
+    def __contains__(self, customer_id: int) -> bool:
+        return self.get(customer_id) is not None
+
+    def publish(
+        self,
+        table: pd.DataFrame,
+        customer_ids: Optional[Sequence[int]] = None,
+        features: Optional[Sequence[str]] = None,
+        replace: bool = False,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> int:
+        '''
+        Writes the feature vectors of a table of customers, such as the output of `merge_all_tables`, in a single
+        transaction.
+
+        Args:
+            table (pd.DataFrame): One row per customer, with at least the columns of the features.
+            customer_ids (Sequence[int], optional): SK_ID_CURR of each row. Defaults to the SK_ID_CURR column of the
+                table.
+            features (Sequence[str], optional): Features of the vectors, in order. Defaults to the features of the
+                store once published, and to `MODEL_PARAMS['features_selected']` for a new store.
+            replace (bool): Whether to replace all the vectors of the store, and its feature layout. Otherwise the
+                vectors of the given customers are inserted or replaced, with the layout of the store.
+            batch_size (int): Number of rows written per batch.
+
+        Returns:
+            int: Number of vectors written.
+        '''
+        if self.read_only:
+            raise ValueError('The feature store was opened for reading only.')
+        start = datetime.now()
+        current = self.features
+        if features is None:
+            features = current if current is not None and not replace else MODEL_PARAMS['features_selected']
+        features = list(features)
+        if current is not None and not replace and features != current:
+            raise ValueError('The features differ from the layout of the store, publish them with replace=True.')
+        missing = [feature for feature in features if feature not in table.columns]
+        if missing:
+            raise ValueError(f"Features {missing} are missing from the published table.")
+
+        if customer_ids is None:
+            customer_ids = table['SK_ID_CURR']
+        customer_ids = np.asarray(customer_ids, dtype=np.int64)
+        vectors = np.ascontiguousarray(table[features].to_numpy(dtype=np.float32))
+
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                if replace:
+                    self._connection.execute('DELETE FROM feature_vectors')
+                for begin in range(0, len(vectors), batch_size):
+                    self._connection.executemany(
+                        'INSERT OR REPLACE INTO feature_vectors (SK_ID_CURR, vector) VALUES (?, ?)',
+                        zip(
+                            customer_ids[begin : begin + batch_size].tolist(),
+                            map(np.ndarray.tobytes, vectors[begin : begin + batch_size]),
+                        ),
+                    )
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                    [
+                        ('version', str(FEATURE_STORE_FORMAT_VERSION)),
+                        ('features', json.dumps(features)),
+                        ('published', datetime.now().isoformat()),
+                    ],
+                )
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        logger.info('Published {} feature vectors to {} in {}', len(vectors), self.path, datetime.now() - start)
+        return len(vectors)
+
+    def get(self, customer_id: int) -> Optional[np.ndarray]:
+        '''
+        Reads the feature vector of a customer.
+
+        Args:
+            customer_id (int): SK_ID_CURR of the customer.
+
+        Returns:
+            np.ndarray: float32 vector in the order of `features`, or None if the customer is not in the store.
+        '''
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT vector FROM feature_vectors WHERE SK_ID_CURR = ?', (int(customer_id),)
+            ).fetchone()
+        return None if row is None else np.frombuffer(row[0], dtype=np.float32)
+
+    def get_frame(self, customer_ids: Sequence[int]) -> pd.DataFrame:
+        '''
+        Reads the feature vectors of some customers into a table, as the model expects them.
+
+        Args:
+            customer_ids (Sequence[int]): SK_ID_CURR of the customers.
+
+        Returns:
+            pd.DataFrame: SK_ID_CURR and the features of the customers found in the store, in the given order.
+        '''
+        features = self.features or []
+        found = [(customer_id, self.get(customer_id)) for customer_id in customer_ids]
+        found = [(customer_id, vector) for customer_id, vector in found if vector is not None]
+        vectors = np.vstack([vector for _, vector in found]) if found else np.empty((0, len(features)), np.float32)
+        frame = pd.DataFrame(vectors, columns=features)
+        frame.insert(0, 'SK_ID_CURR', np.array([customer_id for customer_id, _ in found], dtype=np.int64))
+        return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish a table of customer features to a feature store.')
+    parser.add_argument('table', help='CSV or Feather file with a SK_ID_CURR column, e.g. test_data_final.csv')
+    parser.add_argument('store', help='Path of the SQLite feature store')
+    parser.add_argument('--append', action='store_true', help='Upsert the rows instead of replacing the store')
+    args = parser.parse_args()
+
+    if args.table.endswith('.feather'):
+        table = pd.read_feather(args.table)
+    else:
+        table = pd.read_csv(args.table, index_col=0)
+    with FeatureStore(args.store) as store:
+        store.publish(table, replace=not args.append)
+
+
+if __name__ == '__main__':
+    main()
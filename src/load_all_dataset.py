@@ -2,24 +2,35 @@ import os
 import sys
 import zipfile
 
-from kaggle.api.kaggle_api_extended import KaggleApi
 from loguru import logger
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from settings.params import PARAMS
+from src.acquisition import ChecksumError, acquire, make_source
 
 
-def load_all_dataset(competition='home-credit-default-risk', directory=PARAMS['file_directory']):
+def load_all_dataset(
+    competition='home-credit-default-risk',
+    directory=PARAMS['file_directory'],
+    source=PARAMS['dataset_mirror'],
+    workers=None,
+):
     """
-    Download the specified Kaggle competition data into the specified directory.
+    Acquire all the files of the specified Kaggle competition into the specified directory.
+
+    The files are extracted in parallel and verified against the checksums of their source. Files that are already
+    present and unchanged are skipped, so an interrupted acquisition resumes where it stopped.
 
     Args:
         competition (str): The name of the Kaggle competition. Default is 'home-credit-default-risk'.
         directory (str): The directory where the data will be downloaded. Default is 'data/home-credit-default-risk'.
+        source (str, optional): Zip mirror or local directory to acquire the files from instead of the Kaggle API.
+            Default is the 'dataset_mirror' parameter.
+        workers (int, optional): Number of files extracted concurrently. Default is the number of CPUs.
 
     Returns:
-        None
+        List[str]: Paths of the acquired files, or None if the acquisition failed.
     """
     # Create the directory if it does not exist
     if not os.path.exists(directory):
@@ -28,30 +39,20 @@ def load_all_dataset(competition='home-credit-default-risk', directory=PARAMS['f
     else:
         logger.info(f"Directory already exists: {directory}")
 
-    api = KaggleApi()
-    api.authenticate()
-
     try:
-        logger.info(f"Downloading data for into directory: {directory}")
-        api.competition_download_files(competition, path=directory, quiet=False)
-        logger.info("Download successful.")
+        file_paths = acquire(make_source(source, competition, directory), directory, workers=workers)
+    except (ChecksumError, zipfile.BadZipFile) as e:
+        logger.error(f"Error during file extraction: {e}")
+        return
     except Exception as e:
         logger.error(f"Error during data download: {e}")
         return
-
-    # Extract the downloaded ZIP files
-    zip_path = os.path.join(directory, f"{competition}.zip")
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(directory)
-        logger.info(f"Files successfully extracted into directory: {directory}")
-    except zipfile.BadZipFile as e:
-        logger.error(f"Error during file extraction: {e}")
-        return
+    logger.info(f"Files successfully extracted into directory: {directory}")
 
     # List the extracted files
     extracted_files = os.listdir(directory)
     logger.info(f"Extracted files: {extracted_files}")
+    return file_paths
 
 
 # Example usage
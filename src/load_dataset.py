@@ -2,24 +2,32 @@ import os
 import sys
 import zipfile
 
-from kaggle.api.kaggle_api_extended import KaggleApi
 from loguru import logger
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from settings.params import PARAMS
+from src.acquisition import ChecksumError, acquire, make_source
 
 
-def load_dataset(filename, competition='home-credit-default-risk', directory=PARAMS['file_directory']):
+def load_dataset(
+    filename,
+    competition='home-credit-default-risk',
+    directory=PARAMS['file_directory'],
+    source=PARAMS['dataset_mirror'],
+):
     """
-    Download the specified Kaggle competition data into the specified directory.
+    Acquire a single file of the specified Kaggle competition into the specified directory.
 
     Args:
+        filename (str): The name of the file to acquire, e.g. 'bureau.csv'.
         competition (str): The name of the Kaggle competition. Default is 'home-credit-default-risk'.
         directory (str): The directory where the data will be downloaded. Default is 'data/home-credit-default-risk'.
+        source (str, optional): Zip mirror or local directory to acquire the file from instead of the Kaggle API.
+            Default is the 'dataset_mirror' parameter.
 
     Returns:
-        None
+        str: Path of the acquired file, or None if the acquisition failed.
     """
     # Create the directory if it does not exist
     if not os.path.exists(directory):
@@ -28,28 +36,18 @@ def load_dataset(filename, competition='home-credit-default-risk', directory=PAR
     else:
         logger.info(f"Directory already exists: {directory}")
 
-    api = KaggleApi()
-    api.authenticate()
     try:
-        logger.info(f"Downloading data for into directory: {directory}")
-        api.competition_download_file(
-            competition='home-credit-default-risk', file_name=filename, path=directory, quiet=False
-        )
-        logger.info("Download successful.")
+        (file_path,) = acquire(make_source(source, competition, directory, file_name=filename), directory, [filename])
+    except (ChecksumError, zipfile.BadZipFile) as e:
+        logger.error(f"Error during file extraction: {e}")
+        return
     except Exception as e:
         logger.error(f"Error during data download: {e}")
+        return
+    logger.info(f"File successfully extracted into directory: {directory}")
+    return file_path
 
-    if filename != 'HomeCredit_columns_description.csv':
-        # Extract the downloaded ZIP files
-        zip_path = f"{directory}/{filename}.zip"
-        print(zip_path)
-        try:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(directory)
-            logger.info(f"File successfully extracted into directory: {directory}")
-        except zipfile.BadZipFile as e:
-            logger.error(f"Error during file extraction: {e}")
-            return
 
-
-load_dataset('bureau.csv')
+# Example usage
+if __name__ == "__main__":
+    load_dataset('bureau.csv')
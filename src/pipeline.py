@@ -0,0 +1,527 @@
+"""Runner executing the independent table preprocessors in a pool of processes before merging their results."""
+
+import inspect
+import multiprocessing
+import os
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import (
+    merge_all_tables,
+    preprocess_application_train_test,
+    preprocess_bureau_balance_and_bureau,
+    preprocess_credit_card_balance,
+    preprocess_installments_payments,
+    preprocess_POS_CASH_balance,
+    preprocess_previous_application,
+)
+from src.feature_matrix import FeatureMatrix
+from src.feature_store import FeatureStore
+from src.raw_tables import read_raw_table, shard_ids, write_shards
+from src.utils import read_feather, source_stat, write_feather
+
+# Preprocessing stages, which only depend on each other through `merge_all_tables`
+STAGES = {
+    'bureau': preprocess_bureau_balance_and_bureau,
+    'previous_application': preprocess_previous_application,
+    'installments_payments': preprocess_installments_payments,
+    'pos_cash': preprocess_POS_CASH_balance,
+    'credit_card_balance': preprocess_credit_card_balance,
+    'application': preprocess_application_train_test,
+}
+
+# Stages aggregating their tables per customer, which can run shard by shard
+SHARDED_STAGES = tuple(stage for stage in STAGES if stage != 'application')
+# Raw tables without SK_ID_CURR, sharded with the rows of another table they refer to: that table and the key
+SHARD_LINKS = {'bureau_balance.csv': ('bureau.csv', 'SK_ID_BUREAU')}
+
+
+def _stage_outputs(stage: str) -> List[str]:
+    return ['application_train', 'application_test'] if stage == 'application' else [stage]
+
+
+def _stage_directories(stage: str, file_directory: str, cleaned_data_directory: str) -> Dict[str, str]:
+    # The cleaned application_train and previous_application tables are read from the cleaned data directory
+    if stage == 'application':
+        return {'file_directory1': cleaned_data_directory, 'file_directory2': file_directory}
+    if stage == 'previous_application':
+        return {'file_directory': cleaned_data_directory}
+    return {'file_directory': file_directory}
+
+
+def _stage_size(stage: str, file_directory: str, cleaned_data_directory: str) -> int:
+    directories = _stage_directories(stage, file_directory, cleaned_data_directory)
+    size = 0
+    for attribute, file_names in STAGES[stage].INPUT_FILES.items():
+        for file_name in file_names:
+            try:
+                size += source_stat(directories[attribute] + file_name)[0]
+            except (OSError, KeyError):
+                pass
+    return size
+
+
+def available_memory_mb() -> float:
+    '''Return the memory available for new processes, in MB, as reported by the system.'''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024**2
+
+
+def _peak_memory_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_stage(
+    stage: str,
+    file_directory: str,
+    cleaned_data_directory: str,
+    output_directory: str,
+    memory_limit_mb: Optional[float] = None,
+    **kwargs,
+) -> Dict[str, str]:
+    '''
+    Run one preprocessing stage and write its results to Feather files.
+
+    Args:
+        stage (str): Name of the stage, one of `STAGES`.
+        file_directory (str): Directory of the raw competition tables, with a trailing '/'.
+        cleaned_data_directory (str): Directory of the cleaned application_train and previous_application tables.
+        output_directory (str): Where the results are written, as `<output name>.feather`.
+        memory_limit_mb (float, optional): Memory budget of the stage, in MB. Passed on to the stages reading their
+            table chunk by chunk, and compared with the peak memory of the process once the stage is done.
+        **kwargs: Extra arguments of the preprocessing class of the stage.
+
+    Returns:
+        Dict[str, str]: Path of the Feather file of each output of the stage.
+    '''
+    start = datetime.now()
+    preprocess = STAGES[stage]
+    if memory_limit_mb is not None and 'memory_limit_mb' in inspect.signature(preprocess).parameters:
+        kwargs.setdefault('memory_limit_mb', memory_limit_mb)
+    results = preprocess(**_stage_directories(stage, file_directory, cleaned_data_directory), **kwargs).main()
+    if isinstance(results, pd.DataFrame):
+        results = (results,)
+
+    paths = {}
+    for name, table in zip(_stage_outputs(stage), results):
+        paths[name] = os.path.join(output_directory, name + '.feather')
+        # Written uncompressed: the files only carry the results back to the parent process
+        write_feather(table, paths[name])
+
+    peak = _peak_memory_mb()
+    logger.info('Stage {} done in {}, peak memory {} MB', stage, datetime.now() - start, peak and round(peak))
+    if memory_limit_mb is not None and peak is not None and peak > memory_limit_mb:
+        logger.warning('Stage {} went over its memory budget: {:.0f} MB for {:.0f} MB.', stage, peak, memory_limit_mb)
+    return paths
+
+
+def _run_stage_in_worker(*args, **kwargs) -> Tuple[Dict[str, str], Optional[float]]:
+    # The worker runs a single stage, so its peak memory is the one of the stage
+    return run_stage(*args, **kwargs), _peak_memory_mb()
+
+
+def run_stages(
+    file_directory: str,
+    cleaned_data_directory: Optional[str] = None,
+    workers: Optional[int] = None,
+    memory_limit_mb: Optional[float] = None,
+    output_directory: Optional[str] = None,
+    stages: Optional[Sequence[str]] = None,
+    stage_kwargs: Optional[Dict[str, dict]] = None,
+) -> Dict[str, pd.DataFrame]:
+    '''
+    Run the preprocessing stages in a pool of processes.
+
+    Each stage runs in a fresh process, so that the memory it used is handed back to the system as soon as it is
+    done, and writes its results to Feather files that are read back here, instead of pickling large DataFrames
+    through the pool. The stages reading the largest tables are started first, so that the total time approaches
+    that of the slowest stage when there are enough workers.
+
+    The memory budget is held by the scheduling: the number of workers is lowered so that each gets its budget out
+    of the available memory, the stages reading their table chunk by chunk take it as their chunk budget, and once
+    a stage went over it, the budget no longer tells how many stages fit in memory, so the remaining stages are
+    started one at a time.
+
+    Args:
+        file_directory (str): Directory of the raw competition tables, with a trailing '/'. Can also be the path of
+            the competition zip archive.
+        cleaned_data_directory (str, optional): Directory of the cleaned application_train and previous_application
+            tables. Defaults to `file_directory`.
+        workers (int, optional): Number of stages run at the same time. Defaults to the number of CPUs, and is
+            lowered so that every worker gets its memory budget out of the available memory.
+        memory_limit_mb (float, optional): Memory budget of each worker, in MB, see above. Defaults to no budget.
+        output_directory (str, optional): Where to keep the Feather files of the results. Defaults to a temporary
+            directory removed once the results are loaded.
+        stages (Sequence[str], optional): Stages to run. Defaults to all the `STAGES`.
+        stage_kwargs (Dict[str, dict], optional): Extra arguments of the preprocessing class of each stage, by stage.
+
+    Returns:
+        Dict[str, pd.DataFrame]: Result of each stage by name, application giving application_train and
+            application_test.
+    '''
+    cleaned_data_directory = cleaned_data_directory or file_directory
+    stages = sorted(
+        stages or STAGES, key=lambda stage: _stage_size(stage, file_directory, cleaned_data_directory), reverse=True
+    )
+    stage_kwargs = stage_kwargs or {}
+    workers = workers or os.cpu_count() or 1
+    if memory_limit_mb is not None:
+        workers = min(workers, max(1, int(available_memory_mb() // memory_limit_mb)))
+    workers = min(workers, len(stages))
+
+    start = datetime.now()
+    logger.info('Running stages {} with {} workers', stages, workers)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = output_directory or temporary_directory
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        pending, running, concurrency = list(stages), {}, workers
+        # A spawned single-use executor per stage: nothing of a stage outlives it
+        context = multiprocessing.get_context('spawn')
+        try:
+            while pending or running:
+                while pending and len(running) < concurrency:
+                    stage = pending.pop(0)
+                    executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+                    future = executor.submit(
+                        _run_stage_in_worker,
+                        stage,
+                        file_directory,
+                        cleaned_data_directory,
+                        directory,
+                        memory_limit_mb,
+                        **stage_kwargs.get(stage, {}),
+                    )
+                    running[future] = stage, executor
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, executor = running.pop(future)
+                    executor.shutdown()
+                    stage_paths, peak = future.result()
+                    paths.update(stage_paths)
+                    if memory_limit_mb is not None and peak is not None and peak > memory_limit_mb and concurrency > 1:
+                        logger.warning(
+                            'Stage {} needed {:.0f} MB for a budget of {:.0f} MB, the remaining stages {} are run one '
+                            'at a time.',
+                            stage,
+                            peak,
+                            memory_limit_mb,
+                            pending,
+                        )
+                        concurrency = 1
+        finally:
+            for _, executor in running.values():
+                executor.shutdown(cancel_futures=True)
+        results = {name: read_feather(path) for name, path in paths.items()}
+    logger.info('All stages done in {}', datetime.now() - start)
+    return results
+
+
+def shard_directory_of(shard_directory: str, stage: str, index: int) -> str:
+    '''Return the directory of a shard of the raw tables of a stage, see `partition_stage`.'''
+    return os.path.join(shard_directory, stage, f'shard_{index:04d}')
+
+
+def partition_stage(
+    stage: str,
+    file_directory: str,
+    cleaned_data_directory: Optional[str],
+    shard_directory: str,
+    shards: int,
+    use_cache: bool = True,
+    dtype_policy: str = 'compute',
+):
+    '''
+    Hash-partition the raw tables of a stage by SK_ID_CURR into shards, written as memory-mappable Feather files.
+
+    All the rows of a customer land in the same shard, so that the stage gives the same features for it from its
+    shard alone. The rows of bureau_balance go to the shard of the customer of their credit, see `SHARD_LINKS`.
+
+    Args:
+        stage (str): Name of the stage, one of `SHARDED_STAGES`.
+        file_directory (str): Directory of the raw competition tables, with a trailing '/'.
+        cleaned_data_directory (str, optional): Directory of the cleaned tables. Defaults to `file_directory`.
+        shard_directory (str): Where the shards are written, see `shard_directory_of`.
+        shards (int): Number of shards.
+        use_cache (bool): Whether to load the raw tables through the columnar cache.
+        dtype_policy (str): Dtype policy of the loaded raw tables, the one of the stage.
+    '''
+    start = datetime.now()
+    directories = _stage_directories(stage, file_directory, cleaned_data_directory or file_directory)
+    shard_directories = [shard_directory_of(shard_directory, stage, index) for index in range(shards)]
+    input_files = [
+        (attribute, file_name)
+        for attribute, file_names in STAGES[stage].INPUT_FILES.items()
+        for file_name in file_names
+    ]
+    # The tables other tables are sharded through come first
+    input_files.sort(key=lambda input_file: input_file[1] in SHARD_LINKS)
+    link_keys_of = {link_file: link_key for link_file, link_key in SHARD_LINKS.values()}
+
+    links = {}
+    for attribute, file_name in input_files:
+        file_path = directories[attribute] + file_name
+        table = read_raw_table(file_path, use_cache=use_cache, dtype_policy=dtype_policy)
+        if file_name in SHARD_LINKS:
+            link_file, link_key = SHARD_LINKS[file_name]
+            link_keys, link_ids = links[link_file]
+            positions = pd.Index(link_keys).get_indexer(table[link_key])
+            # Rows referring to no row of the linked table have no features, they are left out of every shard
+            ids = np.where(positions >= 0, link_ids[positions], -1)
+        else:
+            ids = shard_ids(table['SK_ID_CURR'], shards)
+        if file_name in link_keys_of:
+            links[file_name] = (table[link_keys_of[file_name]].to_numpy(), ids)
+        write_shards(table, ids, shard_directories, file_path)
+        del table
+    logger.info('Partitioned the tables of stage {} into {} shards in {}', stage, shards, datetime.now() - start)
+
+
+def run_shard(
+    stage: str,
+    file_directory: str,
+    cleaned_data_directory: Optional[str],
+    shard_directory: str,
+    index: int,
+    **kwargs,
+) -> str:
+    '''
+    Run a stage over one shard of its raw tables, written by `partition_stage`, and write its result to the shard.
+
+    The shards are independent: once partitioned, they can be run by any processes sharing the shard directory,
+    such as workers on several machines standing in for the nodes of a cluster, `collect_shards` gathering their
+    results.
+
+    Args:
+        stage (str): Name of the stage, one of `SHARDED_STAGES`.
+        file_directory (str): Directory of the raw competition tables, with a trailing '/'. Only their schemas are
+            read.
+        cleaned_data_directory (str, optional): Directory of the cleaned tables. Defaults to `file_directory`.
+        shard_directory (str): Directory the shards were written to.
+        index (int): Index of the shard.
+        **kwargs: Extra arguments of the preprocessing class of the stage.
+
+    Returns:
+        str: Path of the Feather file of the result of the shard.
+    '''
+    if kwargs.get('streaming'):
+        raise ValueError('A shard is loaded at once, the sharded stages cannot stream their tables.')
+    directory = shard_directory_of(shard_directory, stage, index)
+    # The stage cache is keyed by the whole tables, not by their shards
+    kwargs = {**kwargs, 'stage_cache': False}
+    result = STAGES[stage](
+        **_stage_directories(stage, file_directory, cleaned_data_directory or file_directory),
+        shard_directory=directory,
+        **kwargs,
+    ).main()
+    path = os.path.join(directory, 'result.feather')
+    write_feather(result, path)
+    return path
+
+
+def collect_shards(stage: str, shard_directory: str, shards: int) -> pd.DataFrame:
+    '''
+    Concatenate the results of the shards of a stage, see `run_shard`.
+
+    Args:
+        stage (str): Name of the stage.
+        shard_directory (str): Directory the shards were written to.
+        shards (int): Number of shards.
+
+    Returns:
+        pd.DataFrame: The result of the stage over all the customers, sorted by SK_ID_CURR like the unsharded one.
+    '''
+    results = [
+        read_feather(os.path.join(shard_directory_of(shard_directory, stage, index), 'result.feather'))
+        for index in range(shards)
+    ]
+    return pd.concat(results, ignore_index=True).sort_values('SK_ID_CURR', ignore_index=True)
+
+
+def run_sharded_stage(
+    stage: str,
+    file_directory: str,
+    cleaned_data_directory: Optional[str] = None,
+    shards: Optional[int] = None,
+    workers: Optional[int] = None,
+    shard_directory: Optional[str] = None,
+    **kwargs,
+) -> pd.DataFrame:
+    '''
+    Run a stage shard by shard in a pool of processes, the customers being hash-partitioned by SK_ID_CURR.
+
+    The raw tables are partitioned once by `partition_stage`, and each worker memory-maps the tables of its shard
+    instead of loading the whole tables, see `run_shard`. The per-customer aggregations of the shards are
+    independent, so the time of the stage goes down with the number of workers until the partitioning dominates.
+
+    Args:
+        stage (str): Name of the stage, one of `SHARDED_STAGES`.
+        file_directory (str): Directory of the raw competition tables, with a trailing '/'.
+        cleaned_data_directory (str, optional): Directory of the cleaned tables. Defaults to `file_directory`.
+        shards (int, optional): Number of shards. Defaults to the number of workers.
+        workers (int, optional): Number of shards run at the same time. Defaults to the number of CPUs.
+        shard_directory (str, optional): Where to keep the shards and their results. Defaults to a temporary
+            directory removed once the results are loaded.
+        **kwargs: Extra arguments of the preprocessing class of the stage.
+
+    Returns:
+        pd.DataFrame: The result of the stage, as `main` of the stage gives it.
+    '''
+    if stage not in SHARDED_STAGES:
+        raise ValueError(f"Stage {stage!r} cannot be sharded, expected one of {list(SHARDED_STAGES)}")
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers
+    parameters = inspect.signature(STAGES[stage]).parameters
+
+    start = datetime.now()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = shard_directory or temporary_directory
+        partition_stage(
+            stage,
+            file_directory,
+            cleaned_data_directory,
+            directory,
+            shards,
+            use_cache=kwargs.get('use_cache', parameters['use_cache'].default),
+            dtype_policy=kwargs.get('dtype_policy', parameters['dtype_policy'].default),
+        )
+        with ProcessPoolExecutor(
+            max_workers=min(workers, shards), mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            futures = [
+                executor.submit(run_shard, stage, file_directory, cleaned_data_directory, directory, index, **kwargs)
+                for index in range(shards)
+            ]
+            for future in as_completed(futures):
+                future.result()
+        result = collect_shards(stage, directory, shards)
+    logger.info('Stage {} done over {} shards with {} workers in {}', stage, shards, workers, datetime.now() - start)
+    return result
+
+
+def run_pipeline(
+    file_directory: str,
+    cleaned_data_directory: Optional[str] = None,
+    workers: Optional[int] = None,
+    memory_limit_mb: Optional[float] = None,
+    output_directory: Optional[str] = None,
+    stage_kwargs: Optional[Dict[str, dict]] = None,
+    engine: str = 'pandas',
+    feature_store: Optional[str] = None,
+    features: Optional[Sequence[str]] = None,
+    combined: bool = False,
+    shards: Optional[int] = None,
+    feature_matrix_directory: Optional[str] = None,
+    sparse: bool = False,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    '''
+    Run all the preprocessing stages in parallel with `run_stages`, then merge their results with
+    `merge_all_tables`.
+
+    Args:
+        file_directory (str): Directory of the raw competition tables, with a trailing '/'.
+        cleaned_data_directory (str, optional): Directory of the cleaned tables. Defaults to `file_directory`.
+        workers (int, optional): Number of stages run at the same time, see `run_stages`.
+        memory_limit_mb (float, optional): Memory budget of each worker, in MB, see `run_stages`.
+        output_directory (str, optional): Where to keep the results of the stages, see `run_stages`.
+        stage_kwargs (Dict[str, dict], optional): Extra arguments of the preprocessing class of each stage.
+        engine (str): DataFrame engine of the stages that take one and of the merge, see `engines.ENGINES`.
+        feature_store (str, optional): Path of a `FeatureStore` the features of the test customers are published
+            to, replacing its content, for the scoring API and dashboard. Defaults to no publication.
+        features (Sequence[str], optional): Features the merged tables are restricted to, e.g.
+            `MODEL_PARAMS['features_selected']`. Each stage then only loads and computes what they need. Defaults to
+            all the features.
+        combined (bool): Whether to merge the training and test applications at once, see `merge_all_tables`.
+        shards (int, optional): Number of shards the stages aggregating per customer are run over, one stage after
+            the other, with all the workers, see `run_sharded_stage`. Defaults to running the stages whole, in
+            parallel.
+        feature_matrix_directory (str, optional): Directory the merged training and test data are written to, as the
+            `FeatureMatrix` artifacts `train` and `test` of `features`, or of the features of the model without them,
+            replacing them, for training and batch scoring. Defaults to no artifact.
+        sparse (bool): Whether the stages taking the option return their category frequencies as sparse columns,
+            kept sparse by the merge, for `Trainer(..., sparse=True)`. Only the pandas engine merges them.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: The merged training and test data.
+    '''
+    if sparse and engine != 'pandas':
+        raise ValueError("Sparse columns are only merged by the 'pandas' engine.")
+    stage_kwargs = dict(stage_kwargs or {})
+    for stage, preprocess in STAGES.items():
+        if 'engine' in inspect.signature(preprocess).parameters:
+            stage_kwargs[stage] = {'engine': engine, **stage_kwargs.get(stage, {})}
+        if sparse and 'sparse' in inspect.signature(preprocess).parameters:
+            stage_kwargs[stage] = {'sparse': True, **stage_kwargs.get(stage, {})}
+        if features is not None:
+            stage_kwargs[stage] = {'features': features, **stage_kwargs.get(stage, {})}
+    results = run_stages(
+        file_directory,
+        cleaned_data_directory,
+        workers=workers,
+        memory_limit_mb=memory_limit_mb,
+        output_directory=output_directory,
+        stages=None if shards is None else ['application'],
+        stage_kwargs=stage_kwargs,
+    )
+    if shards is not None:
+        for stage in SHARDED_STAGES:
+            results[stage] = run_sharded_stage(
+                stage,
+                file_directory,
+                cleaned_data_directory,
+                shards=shards,
+                workers=workers,
+                **stage_kwargs.get(stage, {}),
+            )
+    train, test = merge_all_tables(
+        results['application_train'],
+        results['application_test'],
+        results['bureau'],
+        results['previous_application'],
+        results['installments_payments'],
+        results['pos_cash'],
+        results['credit_card_balance'],
+        engine=engine,
+        features=features,
+        combined=combined,
+    )
+    if feature_store is not None:
+        # The merged rows follow the rows of application_test, whose SK_ID_CURR column is dropped by the merge
+        with FeatureStore(feature_store) as store:
+            store.publish(test, customer_ids=results['application_test']['SK_ID_CURR'], replace=True)
+    if feature_matrix_directory is not None:
+        FeatureMatrix.write(
+            os.path.join(feature_matrix_directory, 'train'),
+            train,
+            customer_ids=results['application_train']['SK_ID_CURR'],
+            features=features,
+        )
+        FeatureMatrix.write(
+            os.path.join(feature_matrix_directory, 'test'),
+            test,
+            customer_ids=results['application_test']['SK_ID_CURR'],
+            features=features,
+        )
+    return train, test
@@ -0,0 +1,238 @@
+"""Projection of the features a model needs down to the raw columns, categories and statistics of each stage."""
+
+import os
+import sys
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+# Add the current directory to the Python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from aggregation import OTHER_COLUMNS, statistic_name
+from schemas import load_schema
+from utils import clean_column_name
+
+
+def table_columns(file_path: str) -> Tuple[List[str], Dict[str, Optional[List[str]]]]:
+    '''
+    Return the columns of a raw table from its schema, without loading the table.
+
+    Args:
+        file_path (str): Path of the CSV file.
+
+    Returns:
+        Tuple[List[str], Dict[str, Optional[List[str]]]]: Numerical columns, and vocabulary of each categorical
+            column, None for the columns whose values are not all strings, both in file order.
+    '''
+    schema = load_schema(file_path)
+    numerical, categorical = [], {}
+    for column, dtype in schema['columns'].items():
+        if dtype == 'category':
+            categorical[column] = schema['categories'].get(column)
+        elif dtype != 'bool':
+            numerical.append(column)
+    return numerical, categorical
+
+
+def spec_names(
+    columns: Sequence[str],
+    spec: Dict[str, Sequence[str]],
+    windows: Optional[Dict[str, float]] = None,
+    window_spec: Optional[Dict[str, Sequence[str]]] = None,
+) -> List[str]:
+    '''
+    Return the names of the statistics an aggregation spec gives for some numerical columns, see `expand_spec`.
+
+    Args:
+        columns (Sequence[str]): Numerical columns aggregated.
+        spec (Dict[str, Sequence[str]]): Statistics of each column.
+        windows (Dict[str, float], optional): Recency windows, by label.
+        window_spec (Dict[str, Sequence[str]], optional): Statistics of each column over each window.
+
+    Returns:
+        List[str]: Names of the statistics, given by `statistic_name`.
+    '''
+    names = []
+    for column in columns:
+        names.extend(statistic_name(column, statistic) for statistic in spec.get(column, spec.get(OTHER_COLUMNS, ())))
+        for label in windows or {}:
+            statistics = (window_spec or {}).get(column, (window_spec or {}).get(OTHER_COLUMNS, ()))
+            names.extend(statistic_name(column, statistic, label) for statistic in statistics)
+    return names
+
+
+class FeatureProjection:
+    '''
+    Output features a preprocessing stage is asked for, resolved into the raw columns, categories and statistics
+    the stage must compute.
+
+    Features are named as in the merged tables, e.g. `MODEL_PARAMS['features_selected']`: the name a stage gives a
+    column is compared with them once prefixed like the stage does, and cleaned like `merge_all_tables` does. A
+    projection without features wants every column, so that a stage resolves its inputs the same way in both cases.
+
+    Attributes:
+        features (frozenset, optional): Cleaned names of the features, None for all of them.
+        prefix (str): Prefix the stage gives the names of its columns.
+    '''
+
+    def __init__(self, features: Optional[Iterable[str]] = None, prefix: str = ''):
+        self.features = None if features is None else frozenset(map(clean_column_name, features))
+        self.prefix = prefix
+
+    def wants(self, name: str) -> bool:
+        '''Whether the column a stage names `name` is one of the features.'''
+        return self.features is None or clean_column_name(self.prefix + name) in self.features
+
+    def within(self, names: Iterable[str]) -> 'FeatureProjection':
+        '''
+        Projection onto the columns of an intermediate table that the features are computed from, such as the
+        per-credit features of bureau_balance, named as in that table.
+        '''
+        return FeatureProjection(None if self.features is None else names)
+
+    def spec(
+        self,
+        columns: Sequence[str],
+        spec: Dict[str, Sequence[str]],
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+        wanted: Optional[Callable[[str], bool]] = None,
+    ) -> Tuple[Dict[str, List[str]], Dict[str, float], Dict[str, List[str]]]:
+        '''
+        Restrict an aggregation spec, its recency windows and their spec to the statistics that are features.
+
+        Args:
+            columns (Sequence[str]): Numerical columns the spec applies to, see `aggregation.expand_spec`.
+            spec (Dict[str, Sequence[str]]): Statistics of each column.
+            windows (Dict[str, float], optional): Recency windows, by label.
+            window_spec (Dict[str, Sequence[str]], optional): Statistics of each column over each window.
+            wanted (Callable[[str], bool], optional): Whether a statistic is needed, from its name. Defaults to
+                `wants`.
+
+        Returns:
+            Tuple[Dict[str, List[str]], Dict[str, float], Dict[str, List[str]]]: The spec, the windows and the window
+                spec. Unless every feature is wanted, the specs list the wanted statistics column by column, and
+                only the windows some of them are computed over are kept.
+        '''
+        windows, window_spec = windows or {}, window_spec or {}
+        if self.features is None:
+            return spec, windows, window_spec
+        wanted = wanted or self.wants
+
+        projected, projected_window_spec, labels = {}, {}, set()
+        for column in columns:
+            statistics = spec.get(column, spec.get(OTHER_COLUMNS, ()))
+            statistics = [statistic for statistic in statistics if wanted(statistic_name(column, statistic))]
+            if statistics:
+                projected[column] = statistics
+            window_statistics = []
+            for statistic in window_spec.get(column, window_spec.get(OTHER_COLUMNS, ())):
+                statistic_labels = {label for label in windows if wanted(statistic_name(column, statistic, label))}
+                if statistic_labels:
+                    window_statistics.append(statistic)
+                    labels |= statistic_labels
+            if window_statistics:
+                projected_window_spec[column] = window_statistics
+        projected_windows = {label: lower for label, lower in windows.items() if label in labels}
+        return projected, projected_windows, projected_window_spec
+
+    def hierarchical_spec(
+        self,
+        columns: Sequence[str],
+        inner_spec: Dict[str, Sequence[str]],
+        spec: Dict[str, Sequence[str]],
+        windows: Optional[Dict[str, float]] = None,
+        window_spec: Optional[Dict[str, Sequence[str]]] = None,
+    ) -> Tuple[Dict[str, List[str]], Dict[str, List[str]], Dict[str, float], Dict[str, List[str]]]:
+        '''
+        Restrict the specs of a two-level aggregation, see `aggregation.hierarchical_aggregate`, to the statistics
+        that are features.
+
+        Args:
+            columns (Sequence[str]): Numerical columns aggregated per inner group.
+            inner_spec (Dict[str, Sequence[str]]): Statistics of each column per inner group.
+            spec (Dict[str, Sequence[str]]): Statistics of each inner statistic per group.
+            windows (Dict[str, float], optional): Recency windows of the inner level, by label.
+            window_spec (Dict[str, Sequence[str]], optional): Statistics over the windows of the inner level.
+
+        Returns:
+            Tuple[Dict[str, List[str]], Dict[str, List[str]], Dict[str, float], Dict[str, List[str]]]: The inner
+                spec, the outer spec, the windows and the window spec.
+        '''
+        if self.features is None:
+            return inner_spec, spec, windows or {}, window_spec or {}
+
+        projected = {}
+
+        def wanted(inner_statistic: str) -> bool:
+            # An inner statistic is needed when one of its statistics per group is
+            statistics = spec.get(inner_statistic, spec.get(OTHER_COLUMNS, ()))
+            statistics = [statistic for statistic in statistics if self.wants(f'{inner_statistic}_{statistic.upper()}')]
+            if statistics:
+                projected[inner_statistic] = statistics
+            return bool(statistics)
+
+        inner_spec, windows, window_spec = self.spec(columns, inner_spec, windows, window_spec, wanted=wanted)
+        return inner_spec, projected, windows, window_spec
+
+    def categories(self, vocabularies: Dict[str, Optional[Sequence[str]]]) -> Optional[Dict[str, Optional[List[str]]]]:
+        '''
+        Resolve the categories whose frequencies, or dummies, are features.
+
+        Args:
+            vocabularies (Dict[str, Optional[Sequence[str]]]): Vocabulary of each categorical column, None when it
+                is not known in advance, see `table_columns`.
+
+        Returns:
+            Dict[str, Optional[List[str]]]: Wanted categories of the columns having some, all the categories of a
+                column whose vocabulary is not known being kept, or None when every feature is wanted.
+        '''
+        if self.features is None:
+            return None
+        categories = {}
+        for column, vocabulary in vocabularies.items():
+            if vocabulary is None:
+                prefix = clean_column_name(f'{self.prefix}{column}_')
+                if any(feature.startswith(prefix) for feature in self.features):
+                    categories[column] = None
+                continue
+            wanted = [category for category in vocabulary if self.wants(f'{column}_{category}')]
+            if wanted:
+                categories[column] = wanted
+        return categories
+
+    def covers(self, names: Iterable[str]) -> bool:
+        '''Whether every feature having the prefix of the projection is the name of one of the columns `names`.'''
+        if self.features is None:
+            return False
+        prefix = clean_column_name(self.prefix)
+        covered = {clean_column_name(self.prefix + name) for name in names}
+        return all(feature in covered for feature in self.features if feature.startswith(prefix))
+
+    def select(self, table: pd.DataFrame, keys: Sequence[str] = ('SK_ID_CURR',)) -> pd.DataFrame:
+        '''
+        Restrict the output of a stage, its columns prefixed, to its keys and the features. The windowed statistics
+        are computed over all the windows kept, so some of them may not be features.
+        '''
+        if self.features is None:
+            return table
+        return table[
+            [column for column in table.columns if column in keys or clean_column_name(column) in self.features]
+        ]
+
+    def usecols(self, file_path: str, columns: Iterable[str]) -> Optional[List[str]]:
+        '''
+        Return the raw columns of a table to load, in file order.
+
+        Args:
+            file_path (str): Path of the CSV file.
+            columns (Iterable[str]): Columns needed, including the keys.
+
+        Returns:
+            List[str]: Columns of the table among `columns`, or None when every feature is wanted.
+        '''
+        if self.features is None:
+            return None
+        columns = set(columns)
+        return [column for column in load_schema(file_path)['columns'] if column in columns]
@@ -0,0 +1,276 @@
+"""Shared loader for the raw Home Credit CSV tables, backed by a columnar cache."""
+
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather
+import pyarrow.ipc
+from loguru import logger
+
+# Add the current directory to the Python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from schemas import iter_csv_with_schema, load_schema, read_csv_with_schema
+from utils import fingerprint, source_directory, source_stat
+
+CACHE_FORMAT_VERSION = 2
+DEFAULT_STREAMING_CHUNKSIZE = 1_000_000
+# Rough ratio between the memory needed to parse a chunk and the size of its CSV text
+PARSE_MEMORY_FACTOR = 8
+
+
+def default_cache_directory(file_path: str) -> str:
+    '''Return the cache directory used for a source file: a `cache/` folder next to it, or next to its archive.'''
+    return os.path.join(source_directory(file_path), 'cache')
+
+
+def _cache_paths(file_path: str, cache_directory: str, dtype_policy: str = 'storage'):
+    table_name = os.path.splitext(os.path.basename(file_path))[0]
+    if dtype_policy != 'storage':
+        table_name = f'{table_name}.{dtype_policy}'
+    base = os.path.join(cache_directory, table_name)
+    return base + '.feather', base + '.json'
+
+
+def _load_manifest(manifest_path: str) -> Optional[dict]:
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def _dump_json(obj: dict, path: str):
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2)
+
+
+def _write_atomic(path: str, write):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_raw_table(
+    file_path: str,
+    cache_directory: Optional[str] = None,
+    use_cache: bool = True,
+    usecols: Optional[List[str]] = None,
+    dtype_policy: str = 'storage',
+) -> pd.DataFrame:
+    '''
+    Load a raw CSV table with compact dtypes, going through the columnar cache.
+
+    On the first call the CSV is parsed with the dtypes of its schema (see `schemas.load_schema`) and written to a
+    zstd-compressed Feather file along with a JSON manifest holding the source fingerprint and the dtypes. Later
+    calls read the Feather file directly as long as the source size, modification time or content hash still
+    match, which skips the CSV parsing altogether.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        cache_directory (str, optional): Where to store the cached tables. Defaults to a `cache/` folder next
+            to the CSV file.
+        use_cache (bool): Whether to read from and write to the cache. Default is True.
+        usecols (List[str], optional): Subset of columns to return. Defaults to all the columns of the table.
+        dtype_policy (str): "storage" to return the compact schema dtypes, or "compute" to return float32 instead of
+            float16 for tables headed into aggregations. Each policy has its own cache entry.
+
+    Returns:
+        pd.DataFrame: The loaded table.
+    '''
+    start = datetime.now()
+    if not use_cache:
+        table = read_csv_with_schema(file_path, load_schema(file_path), usecols=usecols, dtype_policy=dtype_policy)
+        logger.info('Loaded {} from CSV in {}', file_path, datetime.now() - start)
+        return table
+
+    cache_directory = cache_directory or default_cache_directory(file_path)
+    data_path, manifest_path = _cache_paths(file_path, cache_directory, dtype_policy)
+    manifest = _load_manifest(manifest_path)
+
+    if manifest is not None and os.path.exists(data_path):
+        source = fingerprint(file_path, previous=manifest['source'])
+        if source['sha256'] == manifest['source']['sha256']:
+            # Columns in table order, like when parsing the CSV
+            columns = None if usecols is None else [column for column in manifest['dtypes'] if column in usecols]
+            table = pd.read_feather(data_path, columns=columns)
+            dtypes = {
+                column: manifest['dtypes'][column]
+                for column in table.columns
+                if str(table[column].dtype) != manifest['dtypes'][column]
+            }
+            if dtypes:
+                table = table.astype(dtypes)
+            if source is not manifest['source']:
+                # The file was touched but its content did not change: remember the new modification time
+                manifest['source'] = source
+                _write_atomic(manifest_path, lambda path: _dump_json(manifest, path))
+            logger.info('Loaded {} from columnar cache in {} (warm)', file_path, datetime.now() - start)
+            return table
+        logger.info('Source {} changed since it was cached, rebuilding the cache entry.', file_path)
+    else:
+        source = fingerprint(file_path)
+
+    table = read_csv_with_schema(file_path, load_schema(file_path), dtype_policy=dtype_policy)
+    os.makedirs(cache_directory, exist_ok=True)
+    _write_atomic(data_path, lambda path: table.to_feather(path, compression='zstd'))
+    manifest = {
+        'version': CACHE_FORMAT_VERSION,
+        'source': source,
+        'dtypes': {column: str(dtype) for column, dtype in table.dtypes.items()},
+    }
+    _write_atomic(manifest_path, lambda path: _dump_json(manifest, path))
+    logger.info('Loaded {} from CSV in {} (cold), cached to {}', file_path, datetime.now() - start, data_path)
+
+    if usecols is not None:
+        table = table[[column for column in table.columns if column in usecols]]
+    return table
+
+
+def columnar_cache_path(file_path: str, cache_directory: Optional[str] = None, dtype_policy: str = 'storage') -> str:
+    '''
+    Return the path of the Feather file holding a raw table in the columnar cache, for engines scanning it directly.
+
+    The cache entry is built, or rebuilt when the source changed, with `read_raw_table` first.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        cache_directory (str, optional): Where the cached tables are stored. Defaults to a `cache/` folder next to
+            the CSV file.
+        dtype_policy (str): "storage" or "compute", see `read_raw_table`.
+
+    Returns:
+        str: Path of the zstd-compressed Feather file of the table.
+    '''
+    cache_directory = cache_directory or default_cache_directory(file_path)
+    data_path, manifest_path = _cache_paths(file_path, cache_directory, dtype_policy)
+    manifest = _load_manifest(manifest_path)
+    if (
+        manifest is None
+        or not os.path.exists(data_path)
+        or fingerprint(file_path, previous=manifest['source'])['sha256'] != manifest['source']['sha256']
+    ):
+        read_raw_table(file_path, cache_directory, dtype_policy=dtype_policy)
+    return data_path
+
+
+def shard_ids(keys, shards: int) -> np.ndarray:
+    '''
+    Return the shard of each key, out of a hash of the key that is the same in every process.
+
+    Args:
+        keys: Integer keys, e.g. SK_ID_CURR.
+        shards (int): Number of shards.
+
+    Returns:
+        np.ndarray: Shard of each key, between 0 and `shards` - 1.
+    '''
+    hashes = pd.util.hash_array(np.asarray(keys, dtype=np.int64))
+    return (hashes % np.uint64(shards)).astype(np.int64)
+
+
+def shard_path(shard_directory: str, file_path: str) -> str:
+    '''Return the path of the shard of a raw table in a shard directory, see `read_shard`.'''
+    return os.path.join(shard_directory, os.path.splitext(os.path.basename(file_path))[0] + '.feather')
+
+
+def write_shards(table: pd.DataFrame, ids: np.ndarray, shard_directories: List[str], file_path: str):
+    '''
+    Write the rows of a raw table to its shards, as uncompressed Feather files that `read_shard` memory-maps.
+
+    Args:
+        table (pd.DataFrame): The table.
+        ids (np.ndarray): Shard of each row, -1 for the rows left out of every shard.
+        shard_directories (List[str]): Directory of each shard, created if needed.
+        file_path (str): Path of the CSV file of the table.
+    '''
+    # A stable sort keeps the rows of each shard in the order of the table
+    order = np.argsort(ids, kind='stable')
+    bounds = np.searchsorted(ids[order], np.arange(len(shard_directories) + 1) - 0.5)
+    for shard, directory in enumerate(shard_directories):
+        os.makedirs(directory, exist_ok=True)
+        rows = table.iloc[order[bounds[shard] : bounds[shard + 1]]].reset_index(drop=True)
+        path = shard_path(directory, file_path)
+        _write_atomic(path, lambda tmp_path: rows.to_feather(tmp_path, compression='uncompressed'))
+
+
+def read_shard(shard_directory: str, file_path: str, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    '''
+    Load the shard of a raw table written by `write_shards`.
+
+    The file is memory-mapped rather than read, and the numerical columns without missing values are handed to
+    pandas without a copy, so the rows of the shard are only paged in from the file as they are used.
+
+    Args:
+        shard_directory (str): Directory of the shard.
+        file_path (str): Path of the CSV file of the table.
+        usecols (List[str], optional): Subset of columns to return. Defaults to all the columns of the table.
+
+    Returns:
+        pd.DataFrame: The rows of the table in the shard, with the dtypes of `read_raw_table`.
+    '''
+    path = shard_path(shard_directory, file_path)
+    columns = None
+    if usecols is not None:
+        # Columns in table order, like when parsing the CSV
+        columns = [column for column in pyarrow.ipc.open_file(path).schema.names if column in usecols]
+    return pyarrow.feather.read_table(path, columns=columns, memory_map=True).to_pandas(split_blocks=True)
+
+
+def streaming_chunksize(file_path: str, schema: dict, memory_limit_mb: float) -> int:
+    '''
+    Derive the number of rows per chunk that keeps the parsing of one chunk within a memory budget.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        schema (dict): Schema of the file, as returned by `schemas.load_schema`.
+        memory_limit_mb (float): Memory budget for one chunk, in MB.
+
+    Returns:
+        int: Number of rows per chunk.
+    '''
+    size, _ = source_stat(file_path)
+    bytes_per_row = size / max(schema['rows'], 1)
+    return max(1_000, int(memory_limit_mb * 1024**2 / (bytes_per_row * PARSE_MEMORY_FACTOR)))
+
+
+def iter_raw_table_chunks(
+    file_path: str,
+    chunksize: Optional[int] = None,
+    memory_limit_mb: Optional[float] = None,
+    usecols: Optional[List[str]] = None,
+    dtype_policy: str = 'storage',
+) -> Iterator[pd.DataFrame]:
+    '''
+    Stream a raw CSV table chunk by chunk, with the compact dtypes of its schema.
+
+    Every chunk gets the same numerical dtypes, so that partial aggregates computed on each of them can be merged.
+    The columnar cache is not used here: streaming is meant for tables too large to be held in memory at once.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        chunksize (int, optional): Number of rows per chunk. Takes precedence over `memory_limit_mb`.
+        memory_limit_mb (float, optional): Memory budget for parsing one chunk, in MB, used to derive the chunk
+            size. Defaults to chunks of `DEFAULT_STREAMING_CHUNKSIZE` rows when neither option is given.
+        usecols (List[str], optional): Subset of columns to load. Defaults to all the columns of the table.
+        dtype_policy (str): "storage" or "compute", see `read_raw_table`.
+
+    Yields:
+        pd.DataFrame: Consecutive chunks of the table.
+    '''
+    schema = load_schema(file_path)
+    if chunksize is None:
+        if memory_limit_mb is not None:
+            chunksize = streaming_chunksize(file_path, schema, memory_limit_mb)
+        else:
+            chunksize = DEFAULT_STREAMING_CHUNKSIZE
+    logger.info('Streaming {} in chunks of {} rows', file_path, chunksize)
+
+    yield from iter_csv_with_schema(file_path, schema, usecols=usecols, chunksize=chunksize, dtype_policy=dtype_policy)
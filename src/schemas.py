@@ -0,0 +1,261 @@
+"""Per-table dtype schemas used to parse the raw CSV tables directly at their compact width."""
+
+import json
+import os
+import sys
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from pandas.api.types import union_categoricals
+
+# Add the current directory to the Python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from utils import downcast_dtype, fingerprint, open_source, policy_dtype, reduce_memory_usage, source_directory
+
+SCHEMA_FORMAT_VERSION = 2
+SCAN_CHUNKSIZE = 500_000
+READ_CHUNKSIZE = 100_000
+
+# Order in which the column kinds seen in different chunks win over each other
+_KIND_ORDER = {'bool': 0, 'int': 1, 'float': 2, 'object': 3}
+
+
+def default_schema_directory(file_path: str) -> str:
+    '''Return the directory holding the schema of a source file: a `schemas/` folder next to it or to its archive.'''
+    return os.path.join(source_directory(file_path), 'schemas')
+
+
+def schema_path(file_path: str, schema_directory: Optional[str] = None) -> str:
+    '''Return the path of the JSON schema of a source file.'''
+    schema_directory = schema_directory or default_schema_directory(file_path)
+    table_name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(schema_directory, table_name + '.json')
+
+
+def _column_kind(series: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return 'bool'
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return 'int'
+    if pd.api.types.is_float_dtype(series.dtype):
+        return 'float'
+    return 'object'
+
+
+def _read_csv_chunks(file_path: str, **kwargs) -> Iterator[pd.DataFrame]:
+    with open_source(file_path) as f:
+        yield from pd.read_csv(f, **kwargs)
+
+
+def infer_schema(file_path: str, chunksize: int = SCAN_CHUNKSIZE) -> dict:
+    '''
+    Scan a CSV file chunk by chunk and derive the compact dtype of each of its columns.
+
+    Numerical columns get the dtype `reduce_memory_usage` would pick for their value range over the whole file,
+    and string columns are mapped to `category`, with the sorted vocabulary of their values. Parsing with that
+    fixed vocabulary gives every chunk and every load of the table the same category codes. Only one chunk is held
+    in memory at a time.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        chunksize (int): Number of rows parsed per chunk during the scan.
+
+    Returns:
+        dict: Schema with the keys "columns", mapping each column name to its dtype name in file order,
+            "categories", mapping each string column to its vocabulary, and "rows", the number of rows of the file.
+    '''
+    kinds, minima, maxima, vocabularies = {}, {}, {}, {}
+    # Columns parsed as numbers in some chunk: their values are not kept as they appear in the file
+    numerical_chunks = set()
+    rows = 0
+    for chunk in _read_csv_chunks(file_path, chunksize=chunksize):
+        rows += len(chunk)
+        for column in chunk.columns:
+            kind = _column_kind(chunk[column])
+            if column not in kinds or _KIND_ORDER[kind] > _KIND_ORDER[kinds[column]]:
+                kinds[column] = kind
+            if kind == 'object':
+                vocabularies.setdefault(column, set()).update(chunk[column].dropna().unique())
+            else:
+                numerical_chunks.add(column)
+        numerical = chunk.select_dtypes(include=[np.number])
+        for column, value in numerical.min().items():
+            minima[column] = np.fmin(minima.get(column, np.nan), value)
+        for column, value in numerical.max().items():
+            maxima[column] = np.fmax(maxima.get(column, np.nan), value)
+
+    dtypes, categories = {}, {}
+    for column, kind in kinds.items():
+        if kind == 'object':
+            dtypes[column] = 'category'
+            if column not in numerical_chunks:
+                categories[column] = sorted(vocabularies[column])
+        elif kind == 'bool':
+            dtypes[column] = 'bool'
+        else:
+            source_type = 'int64' if kind == 'int' else 'float64'
+            target_type = downcast_dtype(source_type, minima.get(column, np.nan), maxima.get(column, np.nan))
+            dtypes[column] = np.dtype(target_type or source_type).name
+    return {'columns': dtypes, 'categories': categories, 'rows': rows}
+
+
+def load_schema(file_path: str, schema_directory: Optional[str] = None) -> dict:
+    '''
+    Return the schema registered for a CSV file, scanning the file first if needed.
+
+    The schema is stored as JSON together with the fingerprint of the file it was generated from. It is
+    regenerated when the file content changes, since a stale integer width would silently overflow at parse time.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        schema_directory (str, optional): Where the schemas are stored. Defaults to a `schemas/` folder next to
+            the CSV file.
+
+    Returns:
+        dict: Schema with the keys "columns", mapping each column name to its dtype name, "categories", mapping
+            string columns to their vocabulary, and "rows".
+    '''
+    path = schema_path(file_path, schema_directory)
+    if os.path.exists(path):
+        with open(path) as f:
+            schema = json.load(f)
+        if schema.get('version') == SCHEMA_FORMAT_VERSION:
+            source = fingerprint(file_path, previous=schema['source'])
+            if source['sha256'] == schema['source']['sha256']:
+                return schema
+        logger.info('Schema of {} is out of date, scanning the file again.', file_path)
+
+    logger.info('Scanning {} to build its dtype schema...', file_path)
+    schema = {'version': SCHEMA_FORMAT_VERSION, 'source': fingerprint(file_path), **infer_schema(file_path)}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(schema, f, indent=2)
+    logger.info('Schema of {} saved to {}', file_path, path)
+
+    return schema
+
+
+def _schema_columns(file_path: str, schema: dict, usecols: Optional[List[str]] = None, dtype_policy: str = 'storage'):
+    with open_source(file_path) as f:
+        header = pd.read_csv(f, nrows=0).columns
+    columns = [column for column in header if usecols is None or column in usecols]
+    dtypes = {}
+    for column in columns:
+        if column in schema['categories']:
+            dtypes[column] = pd.CategoricalDtype(schema['categories'][column])
+        elif column in schema['columns']:
+            dtypes[column] = policy_dtype(schema['columns'][column], dtype_policy)
+    return columns, dtypes
+
+
+def iter_csv_with_schema(
+    file_path: str,
+    schema: dict,
+    usecols: Optional[List[str]] = None,
+    chunksize: int = READ_CHUNKSIZE,
+    dtype_policy: str = 'storage',
+) -> Iterator[pd.DataFrame]:
+    '''
+    Parse a CSV file chunk by chunk with the dtypes of its schema.
+
+    The C parser cannot produce float16 columns holding missing values, so those are parsed as float32 and
+    narrowed within each chunk. String columns are parsed into categories with the vocabulary of the schema, so all
+    the chunks share the same category codes. Columns missing from the schema keep the dtypes inferred by the
+    parser.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        schema (dict): Schema of the file, as returned by `load_schema`.
+        usecols (List[str], optional): Subset of columns to load. Defaults to all the columns of the file.
+        chunksize (int): Number of rows per chunk.
+        dtype_policy (str): "storage" to use the schema dtypes as they are, or "compute" to parse its float16
+            columns as float32 (see `utils.DTYPE_POLICIES`).
+
+    Yields:
+        pd.DataFrame: Consecutive chunks of the table.
+    '''
+    columns, dtypes = _schema_columns(file_path, schema, usecols, dtype_policy)
+    half_columns = [column for column, dtype in dtypes.items() if dtype == 'float16']
+    parse_dtypes = {**dtypes, **dict.fromkeys(half_columns, 'float32')}
+
+    for chunk in _read_csv_chunks(file_path, usecols=columns, dtype=parse_dtypes, chunksize=chunksize):
+        for column in half_columns:
+            chunk[column] = chunk[column].astype(np.float16)
+        yield chunk
+
+
+def read_csv_with_schema(
+    file_path: str,
+    schema: dict,
+    usecols: Optional[List[str]] = None,
+    chunksize: int = READ_CHUNKSIZE,
+    dtype_policy: str = 'storage',
+) -> pd.DataFrame:
+    '''
+    Parse a CSV file with the dtypes of its schema, so that columns are built at their compact width directly.
+
+    Numerical columns, and the codes of the categorical columns, are preallocated at their final dtype for the
+    number of rows recorded in the schema, and filled chunk by chunk, so the peak memory stays close to the size of
+    the final table. Columns of the file that are missing from the schema are parsed with the default dtypes and
+    then passed through `reduce_memory_usage`.
+
+    Args:
+        file_path (str): Path of the CSV file.
+        schema (dict): Schema of the file, as returned by `load_schema`.
+        usecols (List[str], optional): Subset of columns to load. Defaults to all the columns of the file.
+        chunksize (int): Number of rows parsed at a time.
+        dtype_policy (str): "storage" to use the schema dtypes as they are, or "compute" to parse its float16
+            columns as float32 (see `utils.DTYPE_POLICIES`).
+
+    Returns:
+        pd.DataFrame: The parsed table.
+    '''
+    columns, dtypes = _schema_columns(file_path, schema, usecols, dtype_policy)
+    arrays, codes = {}, {}
+    for column, dtype in dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            codes[column] = np.empty(schema['rows'], dtype=pd.Categorical([], dtype=dtype).codes.dtype)
+        elif dtype != 'category':
+            arrays[column] = np.empty(schema['rows'], dtype=dtype)
+    pieces = {column: [] for column in columns if column not in arrays and column not in codes}
+
+    position = 0
+    for chunk in iter_csv_with_schema(
+        file_path, schema, usecols=usecols, chunksize=chunksize, dtype_policy=dtype_policy
+    ):
+        end = position + len(chunk)
+        if end > schema['rows']:
+            raise ValueError(f'{file_path} has more rows than recorded in its schema.')
+        for column, array in arrays.items():
+            array[position:end] = chunk[column].to_numpy()
+        for column, array in codes.items():
+            array[position:end] = chunk[column].cat.codes.to_numpy()
+        for column, column_pieces in pieces.items():
+            column_pieces.append(chunk[column])
+        position = end
+    if position != schema['rows']:
+        raise ValueError(f'{file_path} has fewer rows than recorded in its schema.')
+
+    table = {}
+    for column in columns:
+        if column in arrays:
+            table[column] = arrays.pop(column)
+        elif column in codes:
+            table[column] = pd.Categorical.from_codes(codes.pop(column), dtype=dtypes[column])
+        elif column in dtypes:
+            table[column] = union_categoricals(pieces.pop(column), sort_categories=True)
+        else:
+            table[column] = pd.concat(pieces.pop(column), ignore_index=True)
+    table = pd.DataFrame(table, copy=False)
+
+    unknown_columns = [column for column in columns if column not in dtypes]
+    if unknown_columns:
+        logger.info('Columns of {} missing from its schema: {}', file_path, unknown_columns)
+        reduced = reduce_memory_usage(table[unknown_columns], policy=dtype_policy)
+        for column in unknown_columns:
+            table[column] = reduced[column]
+
+    return table
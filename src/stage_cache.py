@@ -0,0 +1,282 @@
+"""Content-addressed cache of the results of the preprocessing stages."""
+
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+from loguru import logger
+
+# Add the current directory to the Python path
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from utils import fingerprint, read_feather, source_directory, write_feather
+
+STAGE_CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_SIZE_MB = 10_240
+
+# Constructor arguments of the preprocess_* classes that do not change their results
+NEUTRAL_PARAMETERS = ('verbose', 'use_cache', 'stage_cache', 'stage_cache_directory', 'state_directory')
+
+_SOURCE_DIRECTORY = os.path.abspath(os.path.dirname(__file__))
+
+
+@functools.lru_cache(maxsize=None)
+def code_version() -> str:
+    '''
+    Return a hash of the source of the preprocessing code: the modules of `src/` and `src/datasets/`.
+
+    Any edit of the code computing the stages gives new cache keys, so results computed by older code are never
+    served.
+    '''
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(_SOURCE_DIRECTORY, '*.py'))) + sorted(
+        glob.glob(os.path.join(_SOURCE_DIRECTORY, 'datasets', '*.py'))
+    ):
+        digest.update(os.path.relpath(path, _SOURCE_DIRECTORY).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _dump_json(obj: dict, path: str):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def _load_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class StageCache:
+    '''
+    Cache of the results of the preprocessing stages, stored as Feather files.
+
+    Each entry is addressed by a hash of the content of the input files of the stage, of its parameters and of the
+    version of the code (see `code_version`), so a stage is served from the cache exactly when none of those
+    changed. Input files are hashed once: their fingerprints are remembered by the cache and only hashed again when
+    their size or modification time changes. Entries unused for longer than `max_age_days` are evicted, then the
+    least recently used ones until the cache fits in `max_size_mb`.
+
+    Attributes:
+        directory (str): Directory of the cache, holding one folder per stage and one subfolder per entry.
+        max_age_days (float, optional): Age of the last use after which an entry is evicted.
+        max_size_mb (float, optional): Total size of the entries the cache is trimmed to.
+    '''
+
+    def __init__(
+        self,
+        directory: str,
+        max_age_days: Optional[float] = DEFAULT_MAX_AGE_DAYS,
+        max_size_mb: Optional[float] = DEFAULT_MAX_SIZE_MB,
+    ):
+        self.directory = directory
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+
+    def key(self, stage: str, input_paths: Sequence[str], parameters: dict) -> str:
+        '''
+        Compute the key of the result of a stage.
+
+        Args:
+            stage (str): Name of the stage.
+            input_paths (Sequence[str]): Files read by the stage.
+            parameters (dict): Parameters the result of the stage depends on, serializable to JSON.
+
+        Returns:
+            str: Hexadecimal key of the entry.
+        '''
+        fingerprints_path = os.path.join(self.directory, stage, 'inputs.json')
+        previous = _load_json(fingerprints_path) or {}
+        fingerprints = {path: fingerprint(path, previous=previous.get(path)) for path in input_paths}
+        if fingerprints != previous:
+            os.makedirs(os.path.dirname(fingerprints_path), exist_ok=True)
+            _dump_json(fingerprints, fingerprints_path)
+
+        description = {
+            'version': STAGE_CACHE_FORMAT_VERSION,
+            'stage': stage,
+            'inputs': [fingerprints[path]['sha256'] for path in input_paths],
+            'parameters': parameters,
+            'code': code_version(),
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_directory(self, stage: str, key: str) -> str:
+        return os.path.join(self.directory, stage, key)
+
+    def load(self, stage: str, key: str) -> Optional[Tuple[List[pd.DataFrame], dict]]:
+        '''
+        Read the result of a stage from the cache.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key of the entry, as returned by `key`.
+
+        Returns:
+            Tuple[List[pd.DataFrame], dict]: Tables of the result and manifest of the entry, or None if the entry
+                is missing.
+        '''
+        entry_directory = self._entry_directory(stage, key)
+        manifest = _load_json(os.path.join(entry_directory, 'manifest.json'))
+        if manifest is None:
+            return None
+        tables = [
+            read_feather(os.path.join(entry_directory, f'{position}.feather')) for position in range(manifest['tables'])
+        ]
+        manifest['last_used'] = time.time()
+        _dump_json(manifest, os.path.join(entry_directory, 'manifest.json'))
+        return tables, manifest
+
+    def store(self, stage: str, key: str, tables: Sequence[pd.DataFrame], manifest: dict):
+        '''
+        Write the result of a stage to the cache, then evict the entries over the age and size limits.
+
+        Args:
+            stage (str): Name of the stage.
+            key (str): Key of the entry, as returned by `key`.
+            tables (Sequence[pd.DataFrame]): Tables of the result.
+            manifest (dict): Description of the entry, stored along with the tables.
+        '''
+        entry_directory = self._entry_directory(stage, key)
+        # Written to a temporary folder renamed at the end, so that an entry is either complete or missing
+        tmp_directory = f'{entry_directory}.{os.getpid()}.tmp'
+        os.makedirs(tmp_directory, exist_ok=True)
+        size = 0
+        for position, table in enumerate(tables):
+            path = os.path.join(tmp_directory, f'{position}.feather')
+            write_feather(table, path, compression='zstd')
+            size += os.path.getsize(path)
+        manifest = {**manifest, 'tables': len(tables), 'size': size, 'created': time.time(), 'last_used': time.time()}
+        _dump_json(manifest, os.path.join(tmp_directory, 'manifest.json'))
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        os.replace(tmp_directory, entry_directory)
+
+        self.evict()
+
+    def entries(self) -> List[Tuple[str, dict]]:
+        '''Return the directory and manifest of each entry of the cache.'''
+        entries = []
+        for manifest_path in glob.glob(os.path.join(self.directory, '*', '*', 'manifest.json')):
+            if os.path.dirname(manifest_path).endswith('.tmp'):
+                # Entry being written
+                continue
+            manifest = _load_json(manifest_path)
+            if manifest is not None:
+                entries.append((os.path.dirname(manifest_path), manifest))
+        return entries
+
+    def evict(self) -> List[str]:
+        '''
+        Remove the entries unused for longer than `max_age_days`, then the least recently used entries until the
+        total size of the cache is at most `max_size_mb`.
+
+        Returns:
+            List[str]: Directories of the removed entries.
+        '''
+        entries = sorted(self.entries(), key=lambda entry: entry[1]['last_used'])
+        removed = []
+        if self.max_age_days is not None:
+            oldest = time.time() - timedelta(days=self.max_age_days).total_seconds()
+            removed += [directory for directory, manifest in entries if manifest['last_used'] < oldest]
+        if self.max_size_mb is not None:
+            kept = [(directory, manifest) for directory, manifest in entries if directory not in removed]
+            total = sum(manifest['size'] for _, manifest in kept)
+            for directory, manifest in kept:
+                if total <= self.max_size_mb * 1024**2:
+                    break
+                removed.append(directory)
+                total -= manifest['size']
+        for directory in removed:
+            shutil.rmtree(directory, ignore_errors=True)
+        if removed:
+            logger.info('Evicted {} entries from the stage cache {}', len(removed), self.directory)
+        return removed
+
+
+def stage_parameters(preprocess) -> dict:
+    '''
+    Return the parameters a preprocess_* instance was built with that change its result.
+
+    The constructor arguments are read back from the attributes of the same name, which hold the defaults resolved
+    by the constructor. The directories of the input files are left out, their content is part of the key.
+    '''
+    directories = getattr(preprocess, 'INPUT_FILES', {})
+    parameters = {}
+    for name in inspect.signature(type(preprocess).__init__).parameters:
+        if name == 'self' or name in NEUTRAL_PARAMETERS or name in directories:
+            continue
+        parameters[name] = getattr(preprocess, name, None)
+    return parameters
+
+
+def stage_inputs(preprocess) -> List[str]:
+    '''Return the paths of the files read by a preprocess_* instance, from its `INPUT_FILES`.'''
+    return [
+        getattr(preprocess, attribute) + file_name
+        for attribute, file_names in preprocess.INPUT_FILES.items()
+        for file_name in file_names
+    ]
+
+
+def cached_stage(main):
+    '''
+    Serve the result of the `main` method of a preprocess_* class from the stage cache.
+
+    The class lists the files it reads in `INPUT_FILES`, keyed by the attribute holding their directory, and has
+    the `stage_cache` and `stage_cache_directory` attributes. The cache defaults to a `stage_cache/` folder next to
+    the first input file.
+    '''
+
+    @functools.wraps(main)
+    def wrapper(self) -> Union[pd.DataFrame, Tuple[pd.DataFrame, ...]]:
+        if not self.stage_cache:
+            return main(self)
+
+        stage = type(self).__name__
+        input_paths = stage_inputs(self)
+        directory = self.stage_cache_directory or os.path.join(source_directory(input_paths[0]), 'stage_cache')
+        cache = StageCache(directory)
+        start = datetime.now()
+        key = cache.key(stage, input_paths, stage_parameters(self))
+
+        cached = cache.load(stage, key)
+        if cached is not None:
+            tables, manifest = cached
+            elapsed = datetime.now() - start
+            logger.info(
+                'Stage cache hit for {}: loaded in {}, saving {}',
+                stage,
+                elapsed,
+                timedelta(seconds=manifest['compute_seconds']) - elapsed,
+            )
+            return tables[0] if manifest['single'] else tuple(tables)
+
+        logger.info('Stage cache miss for {}, computing it.', stage)
+        result = main(self)
+        compute_seconds = (datetime.now() - start).total_seconds()
+        single = isinstance(result, pd.DataFrame)
+        cache.store(
+            stage, key, [result] if single else list(result), {'single': single, 'compute_seconds': compute_seconds}
+        )
+        logger.info(
+            'Stage {} computed in {} and stored in the stage cache {}', stage, datetime.now() - start, directory
+        )
+        return result
+
+    return wrapper
@@ -5,15 +5,33 @@ from typing import Callable, Union, Dict, Optional, List
 import mlflow
 import numpy as np
 import pandas as pd
+import scipy.sparse
 from loguru import logger
 from sklearn.metrics import log_loss, f1_score, roc_auc_score, recall_score, precision_score
 from sklearn.compose import ColumnTransformer, make_column_selector
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.pipeline import make_pipeline, Pipeline
+from sklearn.preprocessing import FunctionTransformer
 
 from settings.params import SEED
 
 
+def sparse_columns(data: pd.DataFrame) -> List[str]:
+    """Select the sparse columns of a table, such as the sparse category frequencies of the merged tables."""
+    return [column for column, dtype in data.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+
+
+def dense_numerical_columns(data: pd.DataFrame) -> List[str]:
+    """Select the numerical columns of a table that are not sparse."""
+    sparse = set(sparse_columns(data))
+    return [column for column in make_column_selector(dtype_include=["number"])(data) if column not in sparse]
+
+
+def to_csr(data: pd.DataFrame) -> scipy.sparse.csr_matrix:
+    """Convert a table of sparse columns to a CSR matrix, without densifying them."""
+    return data.sparse.to_coo().tocsr()
+
+
 class Trainer:
     def __init__(
         self,
@@ -25,10 +43,12 @@ class Trainer:
         features: Optional[List[str]] = None,
         test_size: Optional[float] = 0.25,
         cv: Optional[int] = None,
+        sparse: bool = False,
     ):
-        logger.info(f"Test size: {test_size} | cross validation: {cv}")
+        logger.info(f"Test size: {test_size} | cross validation: {cv} | sparse: {sparse}")
         self.test_size = test_size
         self.cv = cv
+        self.sparse = sparse
         self.numerical_transformer = numerical_transformer
         self.categorical_transformer = categorical_transformer
         self.estimator = estimator
@@ -54,6 +74,7 @@ class Trainer:
         numerical_transformer: list,
         categorical_transformer: list,
         classifier: Callable,
+        sparse: bool = False,
     ) -> Pipeline:
         """Define pipeline for modeling
 
@@ -61,6 +82,9 @@ class Trainer:
             numerical_transformer: List of transformers for numerical features.
             categorical_transformer: List of transformers for categorical features.
             classifier: The classifier to be used.
+            sparse: Whether to pass the sparse columns of the data through untransformed and hand the classifier a
+                CSR matrix, instead of transforming them with the numerical features into a dense array. The
+                classifier must accept sparse input, like LightGBM.
 
         Returns:
             Pipeline: sklearn pipeline
@@ -68,14 +92,27 @@ class Trainer:
         numerical_pipeline = make_pipeline(*numerical_transformer)
         categorical_pipeline = make_pipeline(*categorical_transformer)
 
-        preprocessor = ColumnTransformer(
-            transformers=[
-                ("num", numerical_pipeline, make_column_selector(dtype_include=["number"])),
-                ("cat", categorical_pipeline, make_column_selector(dtype_include=["object", "bool"])),
-            ],
-            remainder="drop",
-            verbose_feature_names_out=False,
-        )
+        if sparse:
+            preprocessor = ColumnTransformer(
+                transformers=[
+                    ("num", numerical_pipeline, dense_numerical_columns),
+                    ("cat", categorical_pipeline, make_column_selector(dtype_include=["object", "bool"])),
+                    ("sparse", FunctionTransformer(to_csr, feature_names_out="one-to-one"), sparse_columns),
+                ],
+                remainder="drop",
+                # Stacked into a CSR matrix whatever the density of the output
+                sparse_threshold=1.0,
+                verbose_feature_names_out=False,
+            )
+        else:
+            preprocessor = ColumnTransformer(
+                transformers=[
+                    ("num", numerical_pipeline, make_column_selector(dtype_include=["number"])),
+                    ("cat", categorical_pipeline, make_column_selector(dtype_include=["object", "bool"])),
+                ],
+                remainder="drop",
+                verbose_feature_names_out=False,
+            )
 
         model_pipeline = Pipeline(steps=[("preprocessor", preprocessor), ("classifier", classifier)])
 
@@ -129,6 +166,7 @@ class Trainer:
                 numerical_transformer=self.numerical_transformer,
                 categorical_transformer=self.categorical_transformer,
                 classifier=self.estimator,
+                sparse=self.sparse,
             )
 
             sk_model.fit(self.x_train, self.y_train)
@@ -1,14 +1,134 @@
+import hashlib
+import json
+import os
+import re
+import zipfile
+from contextlib import contextmanager
+from typing import IO, Iterator, Optional, Tuple
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather
 from loguru import logger
 
+HASH_BLOCK_SIZE = 8 * 1024**2
+
+# Smallest float dtype of each dtype policy. float16 halves the size of tables at rest, but pandas and NumPy have no
+# float16 kernels: groupby reductions upcast it on the fly and its sums lose precision, so tables headed into
+# aggregations keep float32 ("compute") and float16 is reserved for stored artifacts ("storage").
+DTYPE_POLICIES = {'storage': np.float16, 'compute': np.float32}
+
+# A path like `data/home-credit-default-risk.zip/bureau.csv` designates a member of a zip archive
+_ARCHIVE_PATH = re.compile(r'^(.*?\.zip)[/\\](.+)$', re.IGNORECASE)
+# Characters LightGBM rejects in feature names, removed from the names of the merged tables
+_FEATURE_NAME_CHARACTERS = re.compile('[^A-Za-z0-9_]+')
+# Key of the Feather schema metadata listing the columns written dense from sparse ones
+_SPARSE_COLUMNS_KEY = b'sparse_columns'
+
+
+def _smallest_float(policy: str) -> type:
+    if policy not in DTYPE_POLICIES:
+        raise ValueError(f"Unknown dtype policy {policy!r}, expected one of {list(DTYPE_POLICIES)}")
+    return DTYPE_POLICIES[policy]
+
+
+def clean_column_name(name: str) -> str:
+    """Return a column name without the characters LightGBM rejects, as in the merged tables."""
+    return _FEATURE_NAME_CHARACTERS.sub('', name)
+
+
+def downcast_dtype(col_type, c_min, c_max, policy: str = 'storage') -> Optional[type]:
+    """
+    Pick the smallest dtype able to hold a numerical column, given its current dtype and its value range.
+
+    Args:
+        col_type: Current dtype of the column.
+        c_min: Minimum value of the column.
+        c_max: Maximum value of the column.
+        policy (str): Dtype policy, "storage" or "compute". Floats are not downcast below float32 under "compute".
+
+    Returns:
+        Optional[type]: The numpy type to cast the column to, or None if the column should be left untouched.
+    """
+    if str(col_type)[:3] == 'int':
+        # Downcast integer columns
+        if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
+            return np.int8
+        elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
+            return np.int16
+        elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
+            return np.int32
+        elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
+            return np.int64
+        return None
+
+    # Downcast float columns
+    half_allowed = _smallest_float(policy) == np.float16
+    if half_allowed and c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
+        return np.float16
+    elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
+        return np.float32
+    return np.float64
+
+
+def policy_dtype(dtype, policy: str):
+    """
+    Return the dtype a column stored with `dtype` gets under a dtype policy: float16 becomes float32 under "compute".
+
+    Args:
+        dtype: Dtype, or dtype name, of the column.
+        policy (str): Dtype policy, "storage" or "compute".
+
+    Returns:
+        The dtype to use, of the same kind as `dtype` (name or dtype).
+    """
+    if str(dtype) == 'float16' and _smallest_float(policy) != np.float16:
+        return np.dtype(np.float32) if isinstance(dtype, np.dtype) else 'float32'
+    return dtype
+
+
+def write_feather(table: pd.DataFrame, path: str, compression: str = 'uncompressed'):
+    """
+    Write a table to a Feather file like `DataFrame.to_feather`, sparse columns included.
 
-def reduce_memory_usage(df: pd.DataFrame) -> pd.DataFrame:
+    Arrow has no sparse arrays: the sparse columns, such as sparse category frequencies, are written dense, one
+    after the other, and listed in the schema metadata so that `read_feather` makes them sparse again.
+
+    Args:
+        table (pd.DataFrame): Table with a default index.
+        path (str): Path of the Feather file.
+        compression (str): Compression of the file, 'uncompressed' (default), 'lz4' or 'zstd'.
+    """
+    sparse_columns = [column for column, dtype in table.dtypes.items() if isinstance(dtype, pd.SparseDtype)]
+    if not sparse_columns:
+        table.to_feather(path, compression=compression)
+        return
+    arrow_table = pa.Table.from_pandas(
+        table.assign(**{column: table[column].sparse.to_dense() for column in sparse_columns})
+    )
+    metadata = {**arrow_table.schema.metadata, _SPARSE_COLUMNS_KEY: json.dumps(sparse_columns).encode()}
+    pyarrow.feather.write_feather(arrow_table.replace_schema_metadata(metadata), path, compression=compression)
+
+
+def read_feather(path: str) -> pd.DataFrame:
+    """Read a table written by `write_feather`, its sparse columns restored."""
+    arrow_table = pyarrow.feather.read_table(path)
+    table = arrow_table.to_pandas()
+    sparse_columns = json.loads((arrow_table.schema.metadata or {}).get(_SPARSE_COLUMNS_KEY, b'[]'))
+    if sparse_columns:
+        table = table.astype({column: pd.SparseDtype(table[column].dtype, 0) for column in sparse_columns})
+    return table
+
+
+def reduce_memory_usage(df: pd.DataFrame, policy: str = 'storage') -> pd.DataFrame:
     """
     Optimize the memory usage of a DataFrame by downcasting numerical columns to more efficient types.
 
     Args:
         df (pd.DataFrame): The DataFrame for which memory usage should be optimized.
+        policy (str): Dtype policy, "storage" (default) or "compute". Under "compute", floats are not downcast below
+            float32, since the frame is headed into aggregations.
 
     Returns:
         pd.DataFrame: The DataFrame with optimized memory usage.
@@ -16,40 +136,45 @@ def reduce_memory_usage(df: pd.DataFrame) -> pd.DataFrame:
     Notes:
         - This function will downcast integer columns to the smallest possible integer type (int8, int16, int32, or int64)
           based on their minimum and maximum values.
-        - It will also downcast floating-point columns to the smallest possible floating-point type (float16, float32, or float64).
-        - Columns of type object (e.g., strings) are not modified.
+        - It will also downcast floating-point columns to the smallest possible floating-point type (float16, float32, or float64),
+          float16 being only used under the "storage" policy.
+        - Columns of type object (e.g., strings) or category are not modified.
         - The function prints the memory usage before and after optimization and the percentage decrease in memory usage.
+        - A new DataFrame is returned, the columns of each dtype being cast once into a single array the frame
+          views; the input is left unchanged.
     """
     # Calculate and print initial memory usage
     start_mem = df.memory_usage().sum() / 1024**2
     logger.info('Memory usage of dataframe is {:.2f} MB'.format(start_mem))
 
-    # Iterate through each column to optimize its data type
-    for col in df.columns:
-        col_type = df[col].dtype
-
-        if col_type != object:
-            c_min = df[col].min()
-            c_max = df[col].max()
-
-            if str(col_type)[:3] == 'int':
-                # Downcast integer columns
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)
-            else:
-                # Downcast float columns
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)
+    # Group the columns by target dtype; the value range of each numerical column comes from one reduction
+    positions_by_type, extension_positions = {}, []
+    for position, col_type in enumerate(df.dtypes):
+        if not isinstance(col_type, np.dtype):
+            # Extension dtypes such as category are kept as they are
+            extension_positions.append(position)
+            continue
+        target_type = col_type
+        if col_type.kind in 'biuf':
+            values = df.iloc[:, position].to_numpy()
+            c_min, c_max = (np.fmin.reduce(values), np.fmax.reduce(values)) if len(values) else (np.nan, np.nan)
+            target_type = np.dtype(downcast_dtype(col_type, c_min, c_max, policy) or col_type)
+        positions_by_type.setdefault(target_type, []).append(position)
+
+    # Cast the columns of each target dtype into a single preallocated block. The frame is built in the column order
+    # from the rows of the blocks, as views, so that the columns are not copied a second time to be put back in order
+    columns = {position: df.iloc[:, position].array for position in extension_positions}
+    for target_type, positions in positions_by_type.items():
+        block = np.empty((len(positions), len(df)), dtype=target_type)
+        for row, position in zip(block, positions):
+            row[:] = df.iloc[:, position].to_numpy()
+            columns[position] = row
+    if columns:
+        reduced = pd.DataFrame(
+            {position: columns[position] for position in range(df.shape[1])}, index=df.index, copy=False
+        )
+        reduced.columns = df.columns
+        df = reduced
 
     # Calculate and print memory usage after optimization
     end_mem = df.memory_usage().sum() / 1024**2
@@ -57,3 +182,102 @@ def reduce_memory_usage(df: pd.DataFrame) -> pd.DataFrame:
     logger.info('Decreased by {:.1f}%'.format(100 * (start_mem - end_mem) / start_mem))
 
     return df
+
+
+def split_archive_path(file_path: str) -> Tuple[Optional[str], str]:
+    """
+    Split a path designating a member of a zip archive, such as `data/home-credit-default-risk.zip/bureau.csv`.
+
+    Args:
+        file_path (str): Path of a file, or of a member inside a zip archive.
+
+    Returns:
+        Tuple[Optional[str], str]: The archive path and the member name, or None and the path itself for a
+            regular file.
+    """
+    match = _ARCHIVE_PATH.match(file_path)
+    if match is None or not os.path.isfile(match.group(1)):
+        return None, file_path
+    return match.group(1), match.group(2).replace(os.sep, '/')
+
+
+@contextmanager
+def open_source(file_path: str) -> Iterator[IO[bytes]]:
+    """
+    Open a file, or a member of a zip archive, for binary reading.
+
+    Members are decompressed as they are read, so they can be streamed straight into a parser without being
+    extracted to disk.
+
+    Args:
+        file_path (str): Path of a file, or of a member inside a zip archive.
+
+    Yields:
+        IO[bytes]: The opened file.
+    """
+    archive_path, member = split_archive_path(file_path)
+    if archive_path is None:
+        with open(file_path, 'rb') as f:
+            yield f
+    else:
+        with zipfile.ZipFile(archive_path) as archive, archive.open(member) as f:
+            yield f
+
+
+def source_stat(file_path: str) -> Tuple[int, int]:
+    """
+    Return the size and modification time in nanoseconds of a file, or of a member of a zip archive.
+
+    Members take the modification time of their archive, and their uncompressed size.
+    """
+    archive_path, member = split_archive_path(file_path)
+    if archive_path is None:
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+    with zipfile.ZipFile(archive_path) as archive:
+        size = archive.getinfo(member).file_size
+    return size, os.stat(archive_path).st_mtime_ns
+
+
+def source_directory(file_path: str) -> str:
+    """Return the directory holding a file, or holding the archive of a member."""
+    archive_path, _ = split_archive_path(file_path)
+    return os.path.dirname(archive_path or file_path)
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Compute the sha256 digest of a file, reading it block by block.
+
+    Args:
+        file_path (str): Path of the file to hash.
+
+    Returns:
+        str: Hexadecimal digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open_source(file_path) as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(file_path: str, previous: Optional[dict] = None) -> dict:
+    """
+    Fingerprint a source file by its size, modification time and content hash.
+
+    The content hash is only recomputed when the size or the modification time differ from `previous`, so
+    an unchanged file costs a single `stat` call. Members of a zip archive are fingerprinted by their own content,
+    with the modification time of the archive.
+
+    Args:
+        file_path (str): Path of the file to fingerprint.
+        previous (dict, optional): Fingerprint recorded on a previous run.
+
+    Returns:
+        dict: Fingerprint with the keys "size", "mtime_ns" and "sha256".
+    """
+    size, mtime_ns = source_stat(file_path)
+    if previous and previous['size'] == size and previous['mtime_ns'] == mtime_ns:
+        return previous
+    return {'size': size, 'mtime_ns': mtime_ns, 'sha256': hash_file(file_path)}
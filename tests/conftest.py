@@ -0,0 +1,27 @@
+import zipfile
+
+import pytest
+
+COMPETITION_FILES = [
+    'HomeCredit_columns_description.csv',
+    'POS_CASH_balance.csv',
+    'application_test.csv',
+    'application_train.csv',
+    'bureau.csv',
+    'bureau_balance.csv',
+    'credit_card_balance.csv',
+    'installments_payments.csv',
+    'previous_application.csv',
+    'sample_submission.csv',
+]
+
+
+@pytest.fixture
+def mirror_archive(tmp_path):
+    # Offline stand-in for the competition archive served by Kaggle
+    archive_path = tmp_path / 'mirror' / 'home-credit-default-risk.zip'
+    archive_path.parent.mkdir()
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for i, name in enumerate(COMPETITION_FILES):
+            archive.writestr(name, 'SK_ID_CURR,VALUE\n' + ''.join(f'{100000 + j},{i * j}\n' for j in range(1000)))
+    return str(archive_path)
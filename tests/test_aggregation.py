@@ -0,0 +1,158 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.aggregation import (
+    STATISTICS,
+    IncrementalAggregator,
+    SortedSegments,
+    category_frequencies,
+    hierarchical_aggregate,
+    segment_aggregate,
+)
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    amounts = rng.normal(1e4, 1e3, 1000).astype(np.float32)
+    amounts[rng.random(1000) < 0.1] = np.nan
+    return pd.DataFrame(
+        {
+            'SK_ID_PREV': np.arange(1000, dtype=np.int32),
+            'SK_ID_CURR': rng.integers(0, 50, 1000).astype(np.int32),
+            'MONTHS_BALANCE': rng.integers(-96, 0, 1000).astype(np.int8),
+            'AMT_BALANCE': amounts,
+            'NAME_CONTRACT_STATUS': pd.Categorical(rng.choice(['Active', 'Completed', 'Signed'], 1000)),
+        }
+    )
+
+
+def densify(table):
+    return table.astype(
+        {column: dtype.subtype for column, dtype in table.dtypes.items() if isinstance(dtype, pd.SparseDtype)}
+    )
+
+
+def test_category_frequencies_match_dummies_means(table):
+    table['NAME_CONTRACT_TYPE'] = np.where(np.arange(len(table)) % 7 == 0, None, 'Cash loans')
+    table['NAME_CONTRACT_STATUS'] = table['NAME_CONTRACT_STATUS'].cat.add_categories(['Unused'])
+    table.loc[::11, 'NAME_CONTRACT_STATUS'] = np.nan
+
+    dummies = pd.get_dummies(table.select_dtypes(['object', 'category']))
+    dummies['SK_ID_CURR'] = table['SK_ID_CURR']
+    expected = dummies.groupby('SK_ID_CURR').mean().reset_index()
+
+    pd.testing.assert_frame_equal(category_frequencies(table, 'SK_ID_CURR'), expected)
+
+    sparse = category_frequencies(table, 'SK_ID_CURR', sparse=True)
+    assert all(isinstance(dtype, pd.SparseDtype) for dtype in sparse.dtypes.drop('SK_ID_CURR'))
+    assert sparse['NAME_CONTRACT_STATUS_Unused'].sparse.npoints == 0
+    pd.testing.assert_frame_equal(densify(sparse), expected)
+
+
+def test_segment_aggregate_matches_groupby_agg(table):
+    table['AMT_BALANCE'] = table['AMT_BALANCE'].astype(np.float64)
+    table.loc[table['SK_ID_CURR'] == 7, 'AMT_BALANCE'] = np.nan
+    shuffled = table.sample(frac=1, random_state=0)
+
+    aggregated = segment_aggregate(
+        shuffled, 'SK_ID_CURR', {'*': STATISTICS}, exclude=['SK_ID_PREV'], order_by='SK_ID_PREV'
+    )
+    expected = table.groupby('SK_ID_CURR')[['MONTHS_BALANCE', 'AMT_BALANCE']].agg(list(STATISTICS))
+    expected.columns = [
+        column if statistic == 'mean' else f'{column}_{statistic.upper()}' for column, statistic in expected.columns
+    ]
+
+    pd.testing.assert_frame_equal(aggregated, expected.reset_index(), check_dtype=False)
+    assert aggregated['MONTHS_BALANCE_SUM'].dtype == np.int64
+    assert aggregated['MONTHS_BALANCE_MIN'].dtype == np.int8
+
+
+def test_windowed_statistics_match_filtered_groupby(table):
+    windows = {'3M': -3, '12M': -12}
+    window_spec = {'AMT_BALANCE': ['mean', 'sum', 'count'], 'MONTHS_BALANCE': ['count']}
+
+    aggregated = segment_aggregate(
+        table, 'SK_ID_CURR', {}, order_by='MONTHS_BALANCE', windows=windows, window_spec=window_spec
+    ).set_index('SK_ID_CURR')
+
+    for label, lower in windows.items():
+        expected = table[table['MONTHS_BALANCE'] >= lower].groupby('SK_ID_CURR').agg(window_spec)
+        expected.columns = [f'{column}_{statistic.upper()}_{label}' for column, statistic in expected.columns]
+        expected = expected.reindex(aggregated.index)
+        # Customers without any row in the window have no group at all, here they get a count and sum of 0
+        expected = expected.fillna(
+            {column: 0 for column in expected.columns if not column.startswith('AMT_BALANCE_MEAN')}
+        )
+        pd.testing.assert_frame_equal(aggregated[expected.columns], expected, check_dtype=False, rtol=1e-5)
+
+
+def test_hierarchical_aggregate_matches_two_groupbys(table):
+    # Three loans per customer, the per-loan mean of a column keeps its name like in `segment_aggregate`
+    table = table.assign(SK_ID_PREV=table['SK_ID_CURR'] * 3 + np.arange(len(table)) % 3)
+    inner_spec = {'AMT_BALANCE': ['mean', 'max'], 'MONTHS_BALANCE': ['count']}
+
+    aggregated = hierarchical_aggregate(
+        table, 'SK_ID_CURR', 'SK_ID_PREV', inner_spec, {'*': ['mean', 'max']}
+    ).set_index('SK_ID_CURR')
+
+    loans = table.groupby('SK_ID_PREV').agg({'SK_ID_CURR': 'first', **inner_spec})
+    loans.columns = ['SK_ID_CURR', 'AMT_BALANCE', 'AMT_BALANCE_MAX', 'MONTHS_BALANCE_COUNT']
+    expected = loans.groupby('SK_ID_CURR').agg(['mean', 'max'])
+    expected.columns = [f'{column}_{statistic.upper()}' for column, statistic in expected.columns]
+    expected.insert(0, 'SK_ID_PREV_COUNT', loans.groupby('SK_ID_CURR').size())
+
+    pd.testing.assert_frame_equal(aggregated[expected.columns], expected, check_dtype=False, rtol=1e-5)
+
+
+def test_streaks_match_python_runs(table):
+    flags = table['AMT_BALANCE'].to_numpy() > 1e4
+    segments = SortedSegments(table['SK_ID_CURR'], table['MONTHS_BALANCE'])
+
+    longest, last = segments.streaks(segments.take(flags))
+
+    for position, (_, group) in enumerate(table.assign(FLAG=flags).groupby('SK_ID_CURR')):
+        runs = [0]
+        for flag in group.sort_values('MONTHS_BALANCE', kind='stable')['FLAG']:
+            runs.append(runs[-1] + 1 if flag else 0)
+        assert longest[position] == max(runs)
+        assert last[position] == runs[-1]
+
+
+def test_incremental_updates_match_aggregation_of_all_rows(table, tmp_path):
+    windows, window_spec = {'3M': -3, '12M': -12}, {'*': ['mean', 'sum', 'count']}
+    table.loc[::13, 'MONTHS_BALANCE'] = table['MONTHS_BALANCE'].iloc[1]
+
+    def aggregator():
+        return IncrementalAggregator(
+            'SK_ID_CURR', {'*': STATISTICS}, ['SK_ID_PREV'], 'MONTHS_BALANCE', windows, window_spec
+        )
+
+    incremental = aggregator()
+    incremental.update(table.iloc[:700])
+    incremental.save(tmp_path)
+    incremental = IncrementalAggregator.load(tmp_path)
+    incremental.update(table.iloc[700:900])
+    keys = incremental.update(table.iloc[900:])
+
+    expected = segment_aggregate(
+        table, 'SK_ID_CURR', {'*': STATISTICS}, ['SK_ID_PREV'], 'MONTHS_BALANCE', windows, window_spec
+    )
+    numerical, categorical = incremental.result()
+    pd.testing.assert_frame_equal(numerical, expected)
+    pd.testing.assert_frame_equal(categorical, category_frequencies(table, 'SK_ID_CURR'))
+    pd.testing.assert_frame_equal(
+        incremental.result(keys)[0], expected[expected['SK_ID_CURR'].isin(keys)].reset_index(drop=True)
+    )
+
+    merged = aggregator()
+    merged.update(table.iloc[:500])
+    later = aggregator()
+    later.update(table.iloc[500:])
+    pd.testing.assert_frame_equal(merged.merge(later).result()[0], expected)
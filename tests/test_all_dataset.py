@@ -1,42 +1,87 @@
 import os
 import sys
+import zipfile
 
 import pytest
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src import acquisition
 from src.load_all_dataset import load_all_dataset
 
 
 @pytest.fixture
-def setup_and_teardown():
-    # Setup: Create a temporary directory
-    test_dir = 'test_data'
-    if not os.path.exists(test_dir):
-        os.makedirs(test_dir)
+def setup_and_teardown(tmp_path):
+    # Setup: Use a temporary directory, removed by pytest
+    test_dir = str(tmp_path / 'test_data')
     yield test_dir
-    # Teardown: Remove the directory after test
-    if os.path.exists(test_dir):
-        for root, dirs, files in os.walk(test_dir, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(test_dir)
 
 
-def test_load_all_dataset_downloads_and_extracts_files(setup_and_teardown):
+@pytest.fixture
+def member_copies(monkeypatch):
+    copied = []
+    acquire_member = acquisition.acquire_member
+    is_up_to_date = acquisition.is_up_to_date
+
+    def recording_acquire_member(source, member, directory):
+        if not is_up_to_date(os.path.join(directory, member.name), member):
+            copied.append(member.name)
+        return acquire_member(source, member, directory)
+
+    monkeypatch.setattr(acquisition, 'acquire_member', recording_acquire_member)
+    return copied
+
+
+def test_load_all_dataset_downloads_and_extracts_files(setup_and_teardown, mirror_archive):
     test_dir = setup_and_teardown
-    if os.path.exists(test_dir):
-        os.rmdir(test_dir)
     assert not os.path.exists(test_dir)
 
-    load_all_dataset(directory=test_dir)
+    load_all_dataset(directory=test_dir, source=mirror_archive)
 
     assert os.path.exists(test_dir)
 
-    zip_path = os.path.join(test_dir, "home-credit-default-risk.zip")
+    with zipfile.ZipFile(mirror_archive) as archive:
+        for info in archive.infolist():
+            with open(os.path.join(test_dir, info.filename), 'rb') as f:
+                assert f.read() == archive.read(info)
+
+    assert len(os.listdir(test_dir)) == 10
+
+
+def test_load_all_dataset_skips_unchanged_files(setup_and_teardown, mirror_archive, member_copies):
+    test_dir = setup_and_teardown
+    load_all_dataset(directory=test_dir, source=mirror_archive)
+    os.remove(os.path.join(test_dir, 'bureau.csv'))
+    with open(os.path.join(test_dir, 'POS_CASH_balance.csv'), 'r+') as f:
+        f.write('X')
+    # Touched but unchanged: recognised from its checksum
+    os.utime(os.path.join(test_dir, 'previous_application.csv'))
+
+    load_all_dataset(directory=test_dir, source=mirror_archive)
+
+    assert len(member_copies) == 12
+    assert sorted(member_copies[10:]) == ['POS_CASH_balance.csv', 'bureau.csv']
+
+
+def test_load_all_dataset_from_local_directory(setup_and_teardown, mirror_archive, tmp_path):
+    mirror_dir = tmp_path / 'extracted'
+    with zipfile.ZipFile(mirror_archive) as archive:
+        archive.extractall(mirror_dir)
+    test_dir = setup_and_teardown
+
+    file_paths = load_all_dataset(directory=test_dir, source=str(mirror_dir), workers=2)
+
+    assert len(file_paths) == 10
+    assert sorted(os.listdir(test_dir)) == sorted(os.listdir(mirror_dir))
+
+
+def test_acquire_rejects_checksum_mismatch(setup_and_teardown, mirror_archive):
+    test_dir = setup_and_teardown
+    os.makedirs(test_dir)
+    source = acquisition.ZipMirrorSource(mirror_archive)
+    member = source.members()['bureau.csv']
 
-    assert os.path.exists(zip_path)
+    with pytest.raises(acquisition.ChecksumError):
+        acquisition.acquire_member(source, member._replace(crc32=member.crc32 ^ 1), test_dir)
 
-    assert len(os.listdir(test_dir)) == 11
+    assert os.listdir(test_dir) == []
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import ApplicationEncoder, preprocess_application_train_test
+
+
+def applications(rng, rows, target=True, types=('Cash loans', 'Revolving loans')):
+    table = pd.DataFrame(
+        {
+            'SK_ID_CURR': np.arange(100_000, 100_000 + rows),
+            'AMT_CREDIT': rng.gamma(2.0, 1e5, rows),
+            'NAME_CONTRACT_TYPE': rng.choice(types, rows),
+            'CODE_GENDER': rng.choice(['F', 'M', None], rows),
+            'FLAG_DOCUMENT_2': rng.integers(0, 2, rows),
+        }
+    )
+    if target:
+        table.insert(1, 'TARGET', rng.integers(0, 2, rows))
+    return table
+
+
+def test_encoder_encodes_any_batch_into_the_fitted_layout(tmp_path):
+    rng = np.random.default_rng(0)
+    train = applications(rng, 200)
+    test = applications(rng, 100, target=False, types=('Cash loans', 'Revolving loans', 'Consumer loans'))
+    encoder = ApplicationEncoder().fit(train, test)
+    encoder.save(str(tmp_path / 'encoder.json'))
+    encoder = ApplicationEncoder.load(str(tmp_path / 'encoder.json'))
+
+    encoded = encoder.transform(test)
+    assert list(encoded.columns) == [name for name in encoder.feature_names if name != 'TARGET']
+    assert not encoded['NAME_CONTRACT_TYPE_Cash loans'][test['NAME_CONTRACT_TYPE'] == 'Consumer loans'].any()
+    # A single application gets the columns and values of its row of the batch
+    pd.testing.assert_frame_equal(encoder.transform(test.iloc[[7]]), encoded.iloc[[7]])
+    assert list(encoder.transform(train).columns) == encoder.feature_names
+
+
+def test_stage_encoder_scores_single_applications(tmp_path):
+    rng = np.random.default_rng(0)
+    applications(rng, 200).to_csv(tmp_path / 'cleaned_train_data.csv', index=False)
+    test = applications(rng, 100, target=False)
+    test.to_csv(tmp_path / 'application_test.csv', index=False)
+
+    stage = preprocess_application_train_test(str(tmp_path) + os.sep, str(tmp_path) + os.sep, stage_cache=False)
+    train_encoded, test_encoded = stage.main()
+    assert list(train_encoded.columns.drop('TARGET')) == list(test_encoded.columns)
+
+    encoder = preprocess_application_train_test(str(tmp_path) + os.sep, str(tmp_path) + os.sep).encoder()
+    application = test.iloc[[3]].drop(columns=['FLAG_DOCUMENT_2'])
+    encoded = encoder.transform(application)
+    np.testing.assert_allclose(encoded.to_numpy(float), test_encoded.iloc[[3]].to_numpy(float), rtol=1e-6)
+
+
+def test_stage_encoder_follows_the_tables_served_by_the_stage_cache(tmp_path):
+    rng = np.random.default_rng(0)
+    applications(rng, 200).to_csv(tmp_path / 'cleaned_train_data.csv', index=False)
+    applications(rng, 100, target=False).to_csv(tmp_path / 'application_test.csv', index=False)
+
+    def stage(features=None):
+        return preprocess_application_train_test(
+            str(tmp_path) + os.sep, str(tmp_path) + os.sep, verbose=False, features=features
+        )
+
+    _, full = stage().main()
+    stage(['AMT_CREDIT', 'CODE_GENDER_F']).main()
+    # Served by the stage cache, the encoder of the projected tables being the one stored
+    _, cached = stage().main()
+    pd.testing.assert_frame_equal(cached, full)
+
+    assert stage().encoder().feature_names == ['SK_ID_CURR', 'TARGET', *full.columns.drop('SK_ID_CURR')]
+    assert stage(['AMT_CREDIT', 'CODE_GENDER_F']).encoder().feature_names == [
+        'SK_ID_CURR',
+        'TARGET',
+        'AMT_CREDIT',
+        'CODE_GENDER_F',
+    ]
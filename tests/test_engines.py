@@ -0,0 +1,107 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import (
+    preprocess_bureau_balance_and_bureau,
+    preprocess_credit_card_balance,
+    preprocess_POS_CASH_balance,
+    preprocess_previous_application,
+)
+from src.engines import get_engine
+
+pytest.importorskip('polars')
+
+
+@pytest.fixture
+def raw_directory(tmp_path):
+    rng = np.random.default_rng(0)
+    rows = 2_000
+    amounts = rng.normal(1e4, 1e3, rows)
+    amounts[rng.random(rows) < 0.2] = np.nan
+    statuses = rng.choice(['Active', 'Completed', 'Signed', None], rows).astype(object)
+    for file_name in ['POS_CASH_balance.csv', 'credit_card_balance.csv']:
+        pd.DataFrame(
+            {
+                'SK_ID_PREV': rng.integers(1_000_000, 1_000_300, rows),
+                'SK_ID_CURR': rng.integers(100_000, 100_100, rows),
+                'MONTHS_BALANCE': rng.integers(-96, 0, rows),
+                'AMT_BALANCE': amounts,
+                'SK_DPD': rng.integers(0, 30, rows),
+                'NAME_CONTRACT_STATUS': statuses,
+            }
+        ).to_csv(tmp_path / file_name, index=False)
+
+    pd.DataFrame(
+        {
+            'SK_ID_PREV': np.arange(rows),
+            'SK_ID_CURR': rng.integers(100_000, 100_100, rows),
+            'AMT_CREDIT': amounts,
+            'DAYS_DECISION': rng.integers(-2_000, 0, rows),
+            'NAME_CONTRACT_STATUS': statuses,
+        }
+    ).to_csv(tmp_path / 'previous_application.csv', index=False)
+
+    credits = 500
+    pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_100, credits),
+            'SK_ID_BUREAU': np.arange(credits),
+            'CREDIT_ACTIVE': rng.choice(['Active', 'Closed'], credits),
+            'DAYS_CREDIT': rng.integers(-2_900, 0, credits),
+            'AMT_CREDIT_SUM': amounts[:credits],
+        }
+    ).to_csv(tmp_path / 'bureau.csv', index=False)
+    # Credits without any month of history are left out of bureau_balance
+    pd.DataFrame(
+        {
+            'SK_ID_BUREAU': rng.integers(0, credits - 50, rows),
+            'MONTHS_BALANCE': rng.integers(-60, 0, rows),
+            'STATUS': rng.choice(['C', '0', 'X', '1', '2', '5'], rows),
+        }
+    ).to_csv(tmp_path / 'bureau_balance.csv', index=False)
+    return str(tmp_path) + os.sep
+
+
+@pytest.mark.parametrize(
+    'preprocess, kwargs',
+    [
+        (preprocess_POS_CASH_balance, {}),
+        (preprocess_POS_CASH_balance, {'hierarchical': True, 'dtype_policy': 'storage'}),
+        (preprocess_credit_card_balance, {'use_cache': False}),
+        (preprocess_previous_application, {}),
+        (preprocess_bureau_balance_and_bureau, {}),
+    ],
+)
+def test_polars_engine_matches_pandas_engine(raw_directory, preprocess, kwargs):
+    results = [
+        preprocess(file_directory=raw_directory, stage_cache=False, engine=engine, **kwargs).main()
+        for engine in ['pandas', 'polars']
+    ]
+
+    pd.testing.assert_frame_equal(results[0], results[1])
+
+
+def test_polars_merge_matches_pandas_merge():
+    rng = np.random.default_rng(0)
+    application = pd.DataFrame({'SK_ID_CURR': np.arange(100, dtype=np.int32), 'FLAG': rng.random(100) < 0.5})
+    # Customers missing from the aggregated tables turn their integer columns into floats
+    aggregated = [
+        pd.DataFrame({'SK_ID_CURR': np.arange(0, 100, 2), 'A_COUNT': rng.integers(0, 5, 50)}),
+        pd.DataFrame({'SK_ID_CURR': np.arange(50, dtype=np.int32), 'B': rng.random(50).astype(np.float32)}),
+    ]
+
+    merged = [get_engine(engine).merge(application, aggregated, on='SK_ID_CURR') for engine in ['pandas', 'polars']]
+
+    pd.testing.assert_frame_equal(merged[0], merged[1])
+    assert merged[1]['A_COUNT'].dtype == np.float64
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        get_engine('spark')
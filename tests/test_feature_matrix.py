@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from settings.params import MODEL_PARAMS
+from src.feature_matrix import FeatureMatrix
+
+FEATURES = ['AMT_CREDIT', 'EXT_SOURCE_2', 'BUREAU_DAYS_CREDIT']
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(rng.random((100, 3)), columns=FEATURES)
+    table['TARGET'] = rng.integers(0, 2, 100)
+    # Customers not sorted, as after a merge
+    table.insert(0, 'SK_ID_CURR', rng.permutation(np.arange(100_000, 100_100)))
+    return table
+
+
+def test_written_matrix_is_read_back(table, tmp_path):
+    path = str(tmp_path / 'train')
+    FeatureMatrix.write(path, table, features=FEATURES, batch_size=30)
+
+    matrix = FeatureMatrix(path)
+    assert isinstance(matrix.values, np.memmap)
+    assert not matrix.values.flags.writeable
+    assert matrix.features == FEATURES
+    assert len(matrix) == 100
+    np.testing.assert_array_equal(matrix.values, table[FEATURES].to_numpy(np.float32))
+
+    customer_id = table.loc[42, 'SK_ID_CURR']
+    assert customer_id in matrix and 1 not in matrix
+    np.testing.assert_array_equal(matrix.get(customer_id), table.loc[42, FEATURES].to_numpy(np.float32))
+    assert matrix.get(1) is None
+
+    ids = [table.loc[7, 'SK_ID_CURR'], 1, table.loc[3, 'SK_ID_CURR']]
+    expected = (
+        table.loc[[7, 3], ['SK_ID_CURR', *FEATURES]].reset_index(drop=True).astype({f: np.float32 for f in FEATURES})
+    )
+    pd.testing.assert_frame_equal(matrix.get_frame(ids), expected)
+
+    frame = matrix.to_frame(['EXT_SOURCE_2', 'AMT_CREDIT'])
+    pd.testing.assert_frame_equal(
+        frame,
+        table[['EXT_SOURCE_2', 'AMT_CREDIT', 'TARGET']].astype({'EXT_SOURCE_2': np.float32, 'AMT_CREDIT': np.float32}),
+    )
+
+    with pytest.raises(ValueError):
+        FeatureMatrix.write(path, table, features=['UNKNOWN'])
+    with pytest.raises(ValueError):
+        FeatureMatrix.write(path, table.assign(SK_ID_CURR=1), features=FEATURES)
+
+
+def test_replaced_matrix_keeps_the_mapped_one(table, tmp_path):
+    path = str(tmp_path / 'test')
+    reader = FeatureMatrix.write(path, table.drop(columns='TARGET'), features=FEATURES)
+    assert reader.target is None
+
+    FeatureMatrix.write(path, table.assign(AMT_CREDIT=-1.0).drop(columns='TARGET'), features=FEATURES)
+    np.testing.assert_array_equal(reader.values[:, 0], table['AMT_CREDIT'].to_numpy(np.float32))
+    assert (FeatureMatrix(path).values[:, 0] == -1).all()
+    assert sorted(os.listdir(tmp_path)) == ['test']
+
+    # Another process maps the same files
+    customer_id = table.loc[5, 'SK_ID_CURR']
+    script = f'from src.feature_matrix import FeatureMatrix; print(FeatureMatrix({path!r}).get({customer_id})[1])'
+    output = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert float(output) == pytest.approx(table.loc[5, 'EXT_SOURCE_2'])
+
+
+def test_matrix_defaults_to_the_features_of_the_model(table, tmp_path):
+    features = MODEL_PARAMS['features_selected']
+    rng = np.random.default_rng(0)
+    full = pd.DataFrame(rng.random((len(table), len(features) + 1)), columns=[*features, 'NOT_SELECTED'])
+    full.insert(0, 'SK_ID_CURR', table['SK_ID_CURR'])
+
+    matrix = FeatureMatrix.write(str(tmp_path / 'train'), full)
+    assert matrix.features == features
+    np.testing.assert_array_equal(matrix.values, full[features].to_numpy(np.float32))
+
+    with pytest.raises(ValueError, match='missing'):
+        FeatureMatrix.write(str(tmp_path / 'test'), table)
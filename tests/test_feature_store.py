@@ -0,0 +1,78 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.feature_store import FeatureStore
+
+FEATURES = ['AMT_CREDIT', 'EXT_SOURCE_2', 'BUREAU_DAYS_CREDIT']
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(rng.random((100, 4)), columns=[*FEATURES, 'UNUSED'])
+    table.insert(0, 'SK_ID_CURR', np.arange(100_000, 100_100))
+    return table
+
+
+class FailingConnection:
+    '''Connection failing on its second batch of vectors.'''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.batches = 0
+
+    def execute(self, *args):
+        return self.connection.execute(*args)
+
+    def executemany(self, statement, rows):
+        if 'feature_vectors' in statement:
+            self.batches += 1
+            if self.batches == 2:
+                raise RuntimeError('Publication interrupted')
+        return self.connection.executemany(statement, rows)
+
+
+def test_published_vectors_are_read_back(table, tmp_path):
+    path = str(tmp_path / 'features.sqlite')
+    with FeatureStore(path) as store:
+        assert store.publish(table, features=FEATURES, batch_size=30) == 100
+
+    reader = FeatureStore(path, read_only=True)
+    assert reader.features == FEATURES
+    assert len(reader) == 100
+    np.testing.assert_array_equal(reader.get(100_042), table.loc[42, FEATURES].to_numpy(np.float32))
+    assert reader.get(1) is None
+
+    frame = reader.get_frame([100_007, 1, 100_003])
+    expected = (
+        table.loc[[7, 3], ['SK_ID_CURR', *FEATURES]].reset_index(drop=True).astype({f: np.float32 for f in FEATURES})
+    )
+    pd.testing.assert_frame_equal(frame, expected)
+
+    # Upserted vectors are seen by the open reader
+    with FeatureStore(path) as store:
+        store.publish(table.iloc[:10].assign(AMT_CREDIT=-1.0))
+        with pytest.raises(ValueError):
+            store.publish(table, features=['AMT_CREDIT'])
+    assert reader.get(100_005)[0] == -1
+    assert len(reader) == 100
+
+
+def test_interrupted_publication_leaves_the_store_unchanged(table, tmp_path):
+    path = str(tmp_path / 'features.sqlite')
+    store = FeatureStore(path)
+    store.publish(table, features=FEATURES)
+
+    store._connection = FailingConnection(store._connection)
+    with pytest.raises(RuntimeError):
+        store.publish(table.assign(AMT_CREDIT=-1.0), features=FEATURES, replace=True, batch_size=30)
+
+    reader = FeatureStore(path, read_only=True)
+    assert len(reader) == 100
+    np.testing.assert_array_equal(reader.get(100_000), table.loc[0, FEATURES].to_numpy(np.float32))
@@ -0,0 +1,157 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import (
+    preprocess_bureau_balance_and_bureau,
+    preprocess_credit_card_balance,
+    preprocess_installments_payments,
+    preprocess_POS_CASH_balance,
+)
+
+
+def pos_cash_rows(rng, rows):
+    amounts = rng.normal(12, 3, rows)
+    amounts[rng.random(rows) < 0.1] = np.nan
+    return pd.DataFrame(
+        {
+            'SK_ID_PREV': rng.integers(1_000_000, 1_000_300, rows),
+            'SK_ID_CURR': rng.integers(100_000, 100_100, rows),
+            'MONTHS_BALANCE': rng.integers(-96, 0, rows),
+            'CNT_INSTALMENT_FUTURE': amounts,
+            'SK_DPD': rng.integers(0, 30, rows),
+            'NAME_CONTRACT_STATUS': rng.choice(['Active', 'Completed', 'Signed'], rows),
+        }
+    )
+
+
+def installments_rows(rng, rows):
+    return pd.DataFrame(
+        {
+            'SK_ID_PREV': rng.integers(1_000_000, 1_000_300, rows),
+            'SK_ID_CURR': rng.integers(100_000, 100_100, rows),
+            'NUM_INSTALMENT_NUMBER': rng.integers(1, 60, rows),
+            'DAYS_INSTALMENT': rng.integers(-2_000, 0, rows).astype(float),
+            'AMT_INSTALMENT': rng.gamma(2.0, 5_000, rows),
+            'AMT_PAYMENT': rng.gamma(2.0, 5_000, rows),
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    'preprocess, file_name, make_rows, features',
+    [
+        (preprocess_POS_CASH_balance, 'POS_CASH_balance.csv', pos_cash_rows, None),
+        (
+            preprocess_POS_CASH_balance,
+            'POS_CASH_balance.csv',
+            pos_cash_rows,
+            ['POS_SK_DPD_MAX', 'POS_CNT_INSTALMENT_FUTURE_LAST', 'POS_NAME_CONTRACT_STATUS_Active'],
+        ),
+        (preprocess_installments_payments, 'installments_payments.csv', installments_rows, None),
+        (
+            preprocess_installments_payments,
+            'installments_payments.csv',
+            installments_rows,
+            ['INSTA_AMT_PAYMENT_SUM', 'INSTA_AMT_INSTALMENT_MEAN_365D'],
+        ),
+    ],
+)
+def test_update_matches_full_recomputation(tmp_path, preprocess, file_name, make_rows, features):
+    rng = np.random.default_rng(0)
+    history, new_rows = make_rows(rng, 2_000), make_rows(rng, 50)
+    history_directory, full_directory = tmp_path / 'history', tmp_path / 'full'
+    history_directory.mkdir()
+    full_directory.mkdir()
+    history.to_csv(history_directory / file_name, index=False)
+    pd.concat([history, new_rows]).to_csv(full_directory / file_name, index=False)
+
+    def stage(directory):
+        return preprocess(file_directory=str(directory) + os.sep, stage_cache=False, verbose=False, features=features)
+
+    stage(history_directory).update(new_rows.iloc[:20])
+    # The second update starts from the stored state
+    refreshed = stage(history_directory).update(new_rows.iloc[20:])
+
+    expected = stage(full_directory).main()
+    expected = expected[expected['SK_ID_CURR'].isin(new_rows['SK_ID_CURR'].iloc[20:])].reset_index(drop=True)
+    pd.testing.assert_frame_equal(refreshed, expected)
+    assert os.path.exists(history_directory / 'state' / preprocess.__name__ / 'state.feather')
+
+
+def test_state_is_computed_again_when_the_table_changes(tmp_path):
+    rng = np.random.default_rng(0)
+    history, new_rows = pos_cash_rows(rng, 2_000), pos_cash_rows(rng, 50)
+    history.iloc[:1_000].to_csv(tmp_path / 'POS_CASH_balance.csv', index=False)
+
+    def stage():
+        return preprocess_POS_CASH_balance(file_directory=str(tmp_path) + os.sep, stage_cache=False, verbose=False)
+
+    stage().update(new_rows)
+    # The table now holds the whole history, the rows of the update being left out of it
+    history.to_csv(tmp_path / 'POS_CASH_balance.csv', index=False)
+    numerical, categorical = stage().incremental_aggregator().result()
+
+    pd.testing.assert_frame_equal(stage().combine_aggregations(numerical, categorical), stage().main())
+
+
+@pytest.fixture
+def raw_directory(tmp_path):
+    rng = np.random.default_rng(0)
+    pos_cash_rows(rng, 2_000).to_csv(tmp_path / 'POS_CASH_balance.csv', index=False)
+    pos_cash_rows(rng, 2_000).rename(columns={'CNT_INSTALMENT_FUTURE': 'AMT_BALANCE'}).to_csv(
+        tmp_path / 'credit_card_balance.csv', index=False
+    )
+    installments_rows(rng, 2_000).to_csv(tmp_path / 'installments_payments.csv', index=False)
+    credits = 500
+    pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_100, credits),
+            'SK_ID_BUREAU': np.arange(credits),
+            'CREDIT_ACTIVE': rng.choice(['Active', 'Closed'], credits),
+            'DAYS_CREDIT': rng.integers(-2_900, 0, credits),
+        }
+    ).to_csv(tmp_path / 'bureau.csv', index=False)
+    pd.DataFrame(
+        {
+            'SK_ID_BUREAU': rng.integers(0, credits - 50, 2_000),
+            'MONTHS_BALANCE': rng.integers(-60, 0, 2_000),
+            'STATUS': rng.choice(['C', '0', 'X', '1', '2', '5'], 2_000),
+        }
+    ).to_csv(tmp_path / 'bureau_balance.csv', index=False)
+    return str(tmp_path) + os.sep
+
+
+@pytest.mark.parametrize(
+    'preprocess',
+    [
+        preprocess_POS_CASH_balance,
+        preprocess_credit_card_balance,
+        preprocess_installments_payments,
+        preprocess_bureau_balance_and_bureau,
+    ],
+)
+def test_streamed_stage_matches_in_memory_stage(raw_directory, preprocess):
+    def stage(**kwargs):
+        return preprocess(file_directory=raw_directory, stage_cache=False, verbose=False, **kwargs).main()
+
+    in_memory = stage()
+    # The streaks of bureau_balance need the months of each credit at once
+    features = [column for column in in_memory.columns[1:] if 'STREAK' not in column]
+
+    streamed = stage(streaming=True, chunksize=300, features=features)
+    pd.testing.assert_frame_equal(streamed, in_memory[['SK_ID_CURR', *features]])
+
+
+def test_streaming_rejects_what_cannot_be_streamed(raw_directory):
+    with pytest.raises(ValueError, match='hierarchical'):
+        preprocess_POS_CASH_balance(file_directory=raw_directory, streaming=True, hierarchical=True)
+    with pytest.raises(ValueError, match='streaks'):
+        preprocess_bureau_balance_and_bureau(
+            file_directory=raw_directory, stage_cache=False, verbose=False, streaming=True
+        ).main()
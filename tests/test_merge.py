@@ -1,3 +1,17 @@
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import merge_all_tables
+from src.utils import reduce_memory_usage
+
+
 # import os
 # import sys
 
@@ -52,3 +66,112 @@
 
 
 # # To do : others class and merge function
+
+
+def chained_merge(application_train, application_test, *aggregated_tables):
+    # Former path: chained merges, then filling, renaming, alignment and reduction, each on a copy
+    merged = []
+    for application in [application_train, application_test]:
+        for table in aggregated_tables:
+            application = application.merge(table, on='SK_ID_CURR', how='left')
+        merged.append(application.fillna(0).infer_objects().rename(columns=lambda x: re.sub('[^A-Za-z0-9_]+', '', x)))
+    train, test = merged
+    train = train.drop(columns=(set(train.columns) - set(test.columns)) - {'TARGET'})
+    test = test.drop(columns=set(test.columns) - set(train.columns))
+    return tuple(reduce_memory_usage(table.drop(columns='SK_ID_CURR'), policy='storage') for table in (train, test))
+
+
+def merge_inputs():
+    rng = np.random.default_rng(0)
+
+    def application(rows, first_id):
+        amounts = rng.gamma(2.0, 100_000, rows)
+        amounts[rng.random(rows) < 0.1] = np.nan
+        return pd.DataFrame(
+            {
+                'SK_ID_CURR': rng.permutation(np.arange(first_id, first_id + rows)).astype(np.int32),
+                'AMT_CREDIT': amounts,
+                'CNT_CHILDREN': rng.integers(0, 5, rows).astype(np.int8),
+                'FLAG_OWN_CAR': rng.random(rows) < 0.5,
+                'NAME_TYPE_SUITE_Spouse, partner': rng.integers(0, 2, rows).astype(np.uint8),
+            }
+        )
+
+    application_train = application(500, 100_000).assign(TARGET=rng.integers(0, 2, 500), ONLY_TRAIN=1)
+    application_test = application(200, 100_500).assign(ONLY_TEST=2.5)
+    # Aggregated tables cover part of the applicants, plus customers without application
+    aggregated_tables = []
+    for i in range(5):
+        ids = rng.choice(np.arange(100_000, 101_000), 400, replace=False)
+        means = rng.normal(0, 10 ** (i + 1), 400)
+        means[rng.random(400) < 0.2] = np.nan
+        aggregated_tables.append(
+            pd.DataFrame(
+                {
+                    'SK_ID_CURR': ids,
+                    f'TABLE{i}_MEAN': means,
+                    f'TABLE{i}_COUNT': rng.integers(1, 300 * (i + 1), 400),
+                    f'TABLE{i}_FLAG': rng.random(400) < 0.5,
+                }
+            )
+        )
+    aggregated_tables.append(aggregated_tables.pop(0).iloc[:0])
+    return application_train, application_test, aggregated_tables
+
+
+# The former path relies on the downcasting of `fillna`, deprecated by pandas
+@pytest.mark.filterwarnings('ignore:Downcasting object dtype arrays:FutureWarning')
+def test_single_pass_merge_matches_chained_merges():
+    application_train, application_test, aggregated_tables = merge_inputs()
+    merged = merge_all_tables(application_train, application_test, *aggregated_tables)
+    expected = chained_merge(application_train, application_test, *aggregated_tables)
+    for table, expected_table in zip(merged, expected):
+        pd.testing.assert_frame_equal(table, expected_table)
+    assert 'ONLY_TRAIN' not in merged[0] and 'TARGET' in merged[0] and 'ONLY_TEST' not in merged[1]
+    assert 'NAME_TYPE_SUITE_Spousepartner' in merged[1]
+
+
+@pytest.mark.parametrize('engine', ['pandas', 'polars'])
+def test_combined_merge_matches_separate_merges(engine):
+    if engine == 'polars':
+        pytest.importorskip('polars')
+    application_train, application_test, aggregated_tables = merge_inputs()
+    application_train = application_train.drop(columns='ONLY_TRAIN')
+    application_test = application_test.drop(columns='ONLY_TEST')
+
+    separate = merge_all_tables(application_train, application_test, *aggregated_tables, engine=engine)
+    train, test = merge_all_tables(
+        application_train, application_test, *aggregated_tables, engine=engine, combined=True
+    )
+    # Both splits share the dtypes reduced over all the customers
+    assert train.dtypes.drop('TARGET').equals(test.dtypes)
+    for table, expected in zip([train, test], separate):
+        pd.testing.assert_frame_equal(table, expected, check_dtype=False, rtol=1e-3)
+
+    with pytest.raises(ValueError):
+        merge_all_tables(application_train.assign(ONLY_TRAIN=1), application_test, *aggregated_tables, combined=True)
+
+
+def test_sparse_frequencies_stay_sparse_through_the_merge():
+    application_train, application_test, aggregated_tables = merge_inputs()
+    rng = np.random.default_rng(1)
+    frequencies = rng.random((400, 3))
+    frequencies[frequencies < 0.8] = 0
+    sparse_tables = [
+        aggregated_tables[0].assign(
+            **{f'TABLE1_STATUS_{i}': pd.arrays.SparseArray(frequencies[:, i], fill_value=0) for i in range(3)}
+        ),
+        *aggregated_tables[1:],
+    ]
+    dense_tables = [sparse_tables[0].assign(**{f'TABLE1_STATUS_{i}': frequencies[:, i] for i in range(3)})]
+
+    sparse = merge_all_tables(application_train, application_test, *sparse_tables)
+    dense = merge_all_tables(application_train, application_test, *dense_tables, *aggregated_tables[1:])
+    for table, expected in zip(sparse, dense):
+        assert (table.dtypes[[f'TABLE1_STATUS_{i}' for i in range(3)]] == pd.SparseDtype(np.float32, 0)).all()
+        assert table.memory_usage().sum() < expected.memory_usage().sum()
+        table = table.astype({f'TABLE1_STATUS_{i}': np.float32 for i in range(3)})
+        pd.testing.assert_frame_equal(table, expected, check_dtype=False, rtol=1e-3)
+
+    with pytest.raises(ValueError):
+        merge_all_tables(application_train, application_test, *sparse_tables, engine='polars')
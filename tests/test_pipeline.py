@@ -0,0 +1,147 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from loguru import logger
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import (
+    preprocess_bureau_balance_and_bureau,
+    preprocess_credit_card_balance,
+    preprocess_POS_CASH_balance,
+)
+from src.pipeline import collect_shards, partition_stage, run_sharded_stage, run_stages
+
+
+@pytest.fixture
+def raw_directory(tmp_path):
+    rng = np.random.default_rng(0)
+    for file_name in ['POS_CASH_balance.csv', 'credit_card_balance.csv']:
+        pd.DataFrame(
+            {
+                'SK_ID_PREV': rng.integers(1_000_000, 1_000_100, 500),
+                'SK_ID_CURR': rng.integers(100_000, 100_050, 500),
+                'MONTHS_BALANCE': rng.integers(-96, 0, 500),
+                'AMT_BALANCE': rng.normal(1e4, 1e3, 500),
+                'SK_DPD': rng.integers(0, 30, 500),
+                'NAME_CONTRACT_STATUS': rng.choice(['Active', 'Completed', 'Signed'], 500),
+            }
+        ).to_csv(tmp_path / file_name, index=False)
+    pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_050, 200),
+            'SK_ID_BUREAU': np.arange(200),
+            'CREDIT_ACTIVE': rng.choice(['Active', 'Closed'], 200),
+            'AMT_CREDIT_SUM': rng.normal(1e4, 1e3, 200),
+        }
+    ).to_csv(tmp_path / 'bureau.csv', index=False)
+    pd.DataFrame(
+        {
+            'SK_ID_BUREAU': rng.integers(0, 220, 1_000),
+            'MONTHS_BALANCE': rng.integers(-60, 0, 1_000),
+            'STATUS': rng.choice(['C', '0', 'X', '1'], 1_000),
+        }
+    ).to_csv(tmp_path / 'bureau_balance.csv', index=False)
+    return str(tmp_path) + os.sep
+
+
+def test_stages_run_in_workers_match_sequential_run(raw_directory, tmp_path):
+    output_directory = str(tmp_path / 'stages')
+
+    results = run_stages(
+        raw_directory, workers=2, output_directory=output_directory, stages=['pos_cash', 'credit_card_balance']
+    )
+
+    assert sorted(os.listdir(output_directory)) == ['credit_card_balance.feather', 'pos_cash.feather']
+    pd.testing.assert_frame_equal(
+        results['pos_cash'], preprocess_POS_CASH_balance(file_directory=raw_directory, stage_cache=False).main()
+    )
+    pd.testing.assert_frame_equal(
+        results['credit_card_balance'],
+        preprocess_credit_card_balance(file_directory=raw_directory, stage_cache=False).main(),
+    )
+
+
+def test_stages_over_their_memory_budget_run_one_at_a_time(raw_directory, tmp_path):
+    messages = []
+    handler = logger.add(messages.append, level='WARNING')
+    try:
+        results = run_stages(
+            raw_directory,
+            workers=2,
+            memory_limit_mb=1,
+            output_directory=str(tmp_path / 'stages'),
+            stages=['pos_cash', 'credit_card_balance', 'bureau'],
+        )
+    finally:
+        logger.remove(handler)
+
+    assert any('run one at a time' in message for message in messages)
+    pd.testing.assert_frame_equal(
+        results['pos_cash'], preprocess_POS_CASH_balance(file_directory=raw_directory, stage_cache=False).main()
+    )
+    pd.testing.assert_frame_equal(
+        results['bureau'], preprocess_bureau_balance_and_bureau(file_directory=raw_directory, stage_cache=False).main()
+    )
+
+
+def test_sharded_stage_matches_whole_stage(raw_directory, tmp_path):
+    result = run_sharded_stage('bureau', raw_directory, shards=3, workers=2, shard_directory=str(tmp_path / 'shards'))
+
+    expected = preprocess_bureau_balance_and_bureau(file_directory=raw_directory, stage_cache=False).main()
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_shards_run_by_separate_processes(raw_directory, tmp_path):
+    shard_directory = str(tmp_path / 'shards')
+    partition_stage('pos_cash', raw_directory, None, shard_directory, shards=4)
+
+    # Two processes standing in for the nodes of a cluster, each running half of the shards
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    for node in range(2):
+        subprocess.run(
+            [
+                sys.executable,
+                '-c',
+                'import sys; sys.path.append(sys.argv[1]); from src.pipeline import run_shard; '
+                f'[run_shard("pos_cash", sys.argv[2], None, sys.argv[3], index) for index in range({node}, 4, 2)]',
+                root,
+                raw_directory,
+                shard_directory,
+            ],
+            check=True,
+        )
+
+    expected = preprocess_POS_CASH_balance(file_directory=raw_directory, stage_cache=False).main()
+    pd.testing.assert_frame_equal(collect_shards('pos_cash', shard_directory, 4), expected)
+
+
+def test_sparse_frequencies_survive_workers_cache_and_shards(raw_directory, tmp_path):
+    stage_kwargs = {stage: {'sparse': True} for stage in ['bureau', 'credit_card_balance']}
+    results = run_stages(raw_directory, workers=2, stages=list(stage_kwargs), stage_kwargs=stage_kwargs)
+    sharded = run_sharded_stage(
+        'bureau', raw_directory, shards=3, workers=2, shard_directory=str(tmp_path / 'shards'), sparse=True
+    )
+
+    for stage, preprocess in [
+        ('bureau', preprocess_bureau_balance_and_bureau),
+        ('credit_card_balance', preprocess_credit_card_balance),
+    ]:
+        expected = preprocess(file_directory=raw_directory, stage_cache=False, sparse=True).main()
+        assert any(isinstance(dtype, pd.SparseDtype) for dtype in expected.dtypes)
+        pd.testing.assert_frame_equal(results[stage], expected)
+        # Stored in the stage cache, then served from it
+        cache_directory = str(tmp_path / 'stage_cache')
+        for _ in range(2):
+            cached = preprocess(file_directory=raw_directory, stage_cache_directory=cache_directory, sparse=True).main()
+            pd.testing.assert_frame_equal(cached, expected)
+        dense = preprocess(file_directory=raw_directory, stage_cache=False).main()
+        pd.testing.assert_frame_equal(expected.astype(dense.dtypes), dense)
+    pd.testing.assert_frame_equal(
+        sharded,
+        preprocess_bureau_balance_and_bureau(file_directory=raw_directory, stage_cache=False, sparse=True).main(),
+    )
@@ -0,0 +1,110 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from settings.params import MODEL_PARAMS
+from src.datasets import (
+    preprocess_bureau_balance_and_bureau,
+    preprocess_credit_card_balance,
+    preprocess_POS_CASH_balance,
+    preprocess_previous_application,
+)
+
+
+@pytest.fixture
+def raw_directory(tmp_path):
+    rng = np.random.default_rng(0)
+    rows = 2_000
+    amounts = rng.normal(1e4, 1e3, rows)
+    amounts[rng.random(rows) < 0.2] = np.nan
+    statuses = rng.choice(['Active', 'Completed', 'Signed', None], rows).astype(object)
+    for file_name in ['POS_CASH_balance.csv', 'credit_card_balance.csv']:
+        pd.DataFrame(
+            {
+                'SK_ID_PREV': rng.integers(1_000_000, 1_000_300, rows),
+                'SK_ID_CURR': rng.integers(100_000, 100_100, rows),
+                'MONTHS_BALANCE': rng.integers(-96, 0, rows),
+                'AMT_BALANCE': amounts,
+                'SK_DPD': rng.integers(0, 30, rows),
+                'NAME_CONTRACT_STATUS': statuses,
+            }
+        ).to_csv(tmp_path / file_name, index=False)
+
+    pd.DataFrame(
+        {
+            'SK_ID_PREV': np.arange(rows),
+            'SK_ID_CURR': rng.integers(100_000, 100_100, rows),
+            'AMT_CREDIT': amounts,
+            'AMT_ANNUITY': rng.gamma(2.0, 5_000, rows),
+            'DAYS_DECISION': rng.integers(-2_000, 0, rows),
+            'NAME_CONTRACT_STATUS': statuses,
+        }
+    ).to_csv(tmp_path / 'previous_application.csv', index=False)
+
+    credits = 500
+    pd.DataFrame(
+        {
+            'SK_ID_CURR': rng.integers(100_000, 100_100, credits),
+            'SK_ID_BUREAU': np.arange(credits),
+            'CREDIT_ACTIVE': rng.choice(['Active', 'Closed', 'Sold'], credits),
+            'DAYS_CREDIT': rng.integers(-2_900, 0, credits),
+            'AMT_CREDIT_SUM': amounts[:credits],
+        }
+    ).to_csv(tmp_path / 'bureau.csv', index=False)
+    pd.DataFrame(
+        {
+            'SK_ID_BUREAU': rng.integers(0, credits - 50, rows),
+            'MONTHS_BALANCE': rng.integers(-60, 0, rows),
+            'STATUS': rng.choice(['C', '0', 'X', '1', '2', '5'], rows),
+        }
+    ).to_csv(tmp_path / 'bureau_balance.csv', index=False)
+    return str(tmp_path) + os.sep
+
+
+@pytest.mark.parametrize(
+    'preprocess, kwargs',
+    [
+        (preprocess_previous_application, {}),
+        (preprocess_POS_CASH_balance, {'hierarchical': True}),
+        (preprocess_credit_card_balance, {}),
+        (preprocess_bureau_balance_and_bureau, {}),
+    ],
+)
+def test_projected_stage_matches_full_stage(raw_directory, preprocess, kwargs):
+    full = preprocess(file_directory=raw_directory, stage_cache=False, verbose=False, **kwargs).main()
+    features = list(full.columns[1::3]) + ['NOT_A_FEATURE']
+
+    projected = preprocess(
+        file_directory=raw_directory, stage_cache=False, verbose=False, features=features, **kwargs
+    ).main()
+    pd.testing.assert_frame_equal(projected, full[['SK_ID_CURR', *features[:-1]]])
+
+
+def test_bureau_balance_is_not_read_without_its_features(raw_directory):
+    full = preprocess_bureau_balance_and_bureau(file_directory=raw_directory, stage_cache=False, verbose=False).main()
+    features = ['BUREAU_BUREAU_DAYS_CREDIT', 'BUREAU_BUREAU_AMT_CREDIT_SUM_MAX', 'BUREAU_CREDIT_ACTIVE_Closed']
+
+    os.remove(raw_directory + 'bureau_balance.csv')
+    projected = preprocess_bureau_balance_and_bureau(
+        file_directory=raw_directory, stage_cache=False, verbose=False, features=features
+    ).main()
+    pd.testing.assert_frame_equal(projected, full[['SK_ID_CURR', *features]])
+
+
+def test_bureau_stage_keeps_the_features_of_the_model(raw_directory):
+    bureau = pd.read_csv(raw_directory + 'bureau.csv')
+    rng = np.random.default_rng(1)
+    for column in ['DAYS_CREDIT_ENDDATE', 'DAYS_ENDDATE_FACT', 'AMT_CREDIT_SUM_OVERDUE', 'DAYS_CREDIT_UPDATE']:
+        bureau[column] = rng.integers(-2_900, 0, len(bureau))
+    bureau.to_csv(raw_directory + 'bureau.csv', index=False)
+    features = [feature for feature in MODEL_PARAMS['features_selected'] if feature.startswith('BUREAU_')]
+
+    projected = preprocess_bureau_balance_and_bureau(
+        file_directory=raw_directory, stage_cache=False, verbose=False, features=MODEL_PARAMS['features_selected']
+    ).main()
+    assert sorted(projected.columns) == sorted(['SK_ID_CURR', *features])
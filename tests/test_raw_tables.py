@@ -0,0 +1,114 @@
+import os
+import sys
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src import raw_tables
+from src.raw_tables import read_raw_table
+
+
+@pytest.fixture
+def raw_csv(tmp_path):
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(
+        {
+            'SK_ID_CURR': np.arange(100000, 100500),
+            'MONTHS_BALANCE': rng.integers(-96, 0, 500),
+            'AMT_BALANCE': rng.normal(1e4, 1e3, 500),
+            'NAME_CONTRACT_STATUS': rng.choice(['Active', 'Completed', 'Signed'], 500),
+        }
+    )
+    file_path = tmp_path / 'POS_CASH_balance.csv'
+    table.to_csv(file_path, index=False)
+    return str(file_path)
+
+
+@pytest.fixture
+def csv_reads(monkeypatch):
+    calls = []
+    read_csv_with_schema = raw_tables.read_csv_with_schema
+
+    def counting_read_csv_with_schema(*args, **kwargs):
+        calls.append(args[0])
+        return read_csv_with_schema(*args, **kwargs)
+
+    monkeypatch.setattr(raw_tables, 'read_csv_with_schema', counting_read_csv_with_schema)
+    return calls
+
+
+def test_read_raw_table_hits_cache_on_second_call(raw_csv, csv_reads):
+    cold = read_raw_table(raw_csv)
+    warm = read_raw_table(raw_csv)
+
+    assert len(csv_reads) == 1
+    assert os.path.exists(os.path.join(os.path.dirname(raw_csv), 'cache', 'POS_CASH_balance.feather'))
+    pd.testing.assert_frame_equal(cold, warm)
+    assert warm['MONTHS_BALANCE'].dtype == np.int8
+    assert warm['NAME_CONTRACT_STATUS'].dtype == 'category'
+
+
+def test_read_raw_table_selects_columns(raw_csv):
+    read_raw_table(raw_csv)
+
+    warm = read_raw_table(raw_csv, usecols=['SK_ID_CURR', 'AMT_BALANCE'])
+    uncached = read_raw_table(raw_csv, use_cache=False, usecols=['SK_ID_CURR', 'AMT_BALANCE'])
+
+    assert list(warm.columns) == ['SK_ID_CURR', 'AMT_BALANCE']
+    pd.testing.assert_frame_equal(warm, uncached)
+
+
+def test_read_raw_table_ignores_touch_without_content_change(raw_csv, csv_reads):
+    read_raw_table(raw_csv)
+    stat = os.stat(raw_csv)
+    os.utime(raw_csv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    read_raw_table(raw_csv)
+
+    assert len(csv_reads) == 1
+
+
+def test_read_raw_table_rebuilds_when_content_changes(raw_csv, csv_reads):
+    read_raw_table(raw_csv)
+    table = pd.read_csv(raw_csv)
+    table['AMT_BALANCE'] = 0.0
+    table.to_csv(raw_csv, index=False)
+
+    reloaded = read_raw_table(raw_csv)
+
+    assert len(csv_reads) == 2
+    assert (reloaded['AMT_BALANCE'] == 0).all()
+
+
+def test_read_raw_table_compute_policy_avoids_float16(raw_csv):
+    table = pd.read_csv(raw_csv)
+    table['CNT_INSTALMENT'] = np.arange(len(table)) % 60 / 2
+    table.to_csv(raw_csv, index=False)
+
+    storage = read_raw_table(raw_csv)
+    compute = read_raw_table(raw_csv, dtype_policy='compute')
+    uncached = read_raw_table(raw_csv, use_cache=False, dtype_policy='compute')
+
+    assert storage['CNT_INSTALMENT'].dtype == np.float16
+    assert compute['CNT_INSTALMENT'].dtype == np.float32
+    assert compute['MONTHS_BALANCE'].dtype == np.int8
+    pd.testing.assert_frame_equal(compute, uncached)
+
+
+def test_read_raw_table_streams_member_of_zip_archive(raw_csv, tmp_path):
+    archive_path = tmp_path / 'archive' / 'home-credit-default-risk.zip'
+    archive_path.parent.mkdir()
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.write(raw_csv, 'POS_CASH_balance.csv')
+    member_path = os.path.join(str(archive_path), 'POS_CASH_balance.csv')
+
+    cold = read_raw_table(member_path)
+    warm = read_raw_table(member_path)
+
+    pd.testing.assert_frame_equal(cold, read_raw_table(raw_csv, use_cache=False))
+    pd.testing.assert_frame_equal(cold, warm)
+    assert sorted(os.listdir(archive_path.parent)) == ['cache', 'home-credit-default-risk.zip', 'schemas']
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.schemas import iter_csv_with_schema, load_schema, read_csv_with_schema
+from src.utils import reduce_memory_usage
+
+
+@pytest.fixture
+def raw_csv(tmp_path):
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame(
+        {
+            'SK_ID_PREV': np.arange(1000000, 1001000),
+            'SK_ID_CURR': rng.integers(100000, 456255, 1000),
+            'NUM_INSTALMENT_NUMBER': rng.integers(1, 100, 1000),
+            'DAYS_ENTRY_PAYMENT': np.where(rng.random(1000) < 0.1, np.nan, rng.integers(-3000, 0, 1000)),
+            'AMT_PAYMENT': rng.normal(1e5, 1e4, 1000),
+            'NAME_CONTRACT_STATUS': rng.choice(['Approved', 'Refused', None], 1000),
+        }
+    )
+    file_path = tmp_path / 'installments_payments.csv'
+    table.to_csv(file_path, index=False)
+    return str(file_path)
+
+
+def test_schema_matches_reduce_memory_usage(raw_csv):
+    schema = load_schema(raw_csv)
+    table = read_csv_with_schema(raw_csv, schema, chunksize=128)
+    expected = reduce_memory_usage(pd.read_csv(raw_csv))
+
+    assert schema['rows'] == 1000
+    assert table['NAME_CONTRACT_STATUS'].dtype == 'category'
+    numerical = expected.select_dtypes(include=[np.number]).columns
+    assert table[numerical].dtypes.equals(expected[numerical].dtypes)
+    pd.testing.assert_frame_equal(table[numerical], expected[numerical], check_exact=False, rtol=1e-3)
+    pd.testing.assert_series_equal(
+        table['NAME_CONTRACT_STATUS'].astype(object), expected['NAME_CONTRACT_STATUS'], check_dtype=False
+    )
+
+
+def test_schema_is_regenerated_when_the_data_changes(raw_csv):
+    assert load_schema(raw_csv)['columns']['NUM_INSTALMENT_NUMBER'] == 'int8'
+
+    table = pd.read_csv(raw_csv)
+    table.loc[0, 'NUM_INSTALMENT_NUMBER'] = 300
+    table.to_csv(raw_csv, index=False)
+    schema = load_schema(raw_csv)
+
+    assert schema['columns']['NUM_INSTALMENT_NUMBER'] == 'int16'
+    assert read_csv_with_schema(raw_csv, schema)['NUM_INSTALMENT_NUMBER'].max() == 300
+
+
+def test_columns_missing_from_the_schema_fall_back_to_reduce_memory_usage(raw_csv):
+    schema = load_schema(raw_csv)
+    del schema['columns']['NUM_INSTALMENT_NUMBER']
+
+    table = read_csv_with_schema(raw_csv, schema)
+
+    assert table['NUM_INSTALMENT_NUMBER'].dtype == np.int8
+    assert list(table.columns) == list(pd.read_csv(raw_csv, nrows=0).columns)
+
+
+def test_string_columns_share_the_vocabulary_of_the_schema(raw_csv):
+    schema = load_schema(raw_csv)
+    dtype = pd.CategoricalDtype(['Approved', 'Refused'])
+
+    chunks = list(iter_csv_with_schema(raw_csv, schema, chunksize=5))
+    table = read_csv_with_schema(raw_csv, schema, chunksize=128)
+
+    assert schema['categories'] == {'NAME_CONTRACT_STATUS': ['Approved', 'Refused']}
+    assert all(chunk['NAME_CONTRACT_STATUS'].dtype == dtype for chunk in chunks)
+    assert table['NAME_CONTRACT_STATUS'].dtype == dtype
+    assert table['NAME_CONTRACT_STATUS'].cat.codes.dtype == np.int8
+    pd.testing.assert_series_equal(
+        table['NAME_CONTRACT_STATUS'], pd.concat(chunks, ignore_index=True)['NAME_CONTRACT_STATUS']
+    )
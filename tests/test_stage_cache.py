@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.datasets import preprocess_POS_CASH_balance
+from src.stage_cache import StageCache
+
+
+@pytest.fixture
+def raw_directory(tmp_path):
+    rng = np.random.default_rng(0)
+    pd.DataFrame(
+        {
+            'SK_ID_PREV': rng.integers(1_000_000, 1_000_100, 500),
+            'SK_ID_CURR': rng.integers(100_000, 100_050, 500),
+            'MONTHS_BALANCE': rng.integers(-96, 0, 500),
+            'SK_DPD': rng.integers(0, 30, 500),
+            'NAME_CONTRACT_STATUS': rng.choice(['Active', 'Completed', 'Signed'], 500),
+        }
+    ).to_csv(tmp_path / 'POS_CASH_balance.csv', index=False)
+    return str(tmp_path) + os.sep
+
+
+def fail(*args, **kwargs):
+    raise AssertionError('The stage was computed instead of being read from the stage cache.')
+
+
+def test_unchanged_stage_is_read_from_the_cache(raw_directory, monkeypatch):
+    computed = preprocess_POS_CASH_balance(file_directory=raw_directory).main()
+
+    monkeypatch.setattr(preprocess_POS_CASH_balance, 'load_dataframe', fail)
+    cached = preprocess_POS_CASH_balance(file_directory=raw_directory, verbose=False).main()
+
+    pd.testing.assert_frame_equal(cached, computed)
+
+
+def test_changed_parameters_or_inputs_are_computed_again(raw_directory):
+    preprocess_POS_CASH_balance(file_directory=raw_directory).main()
+
+    other_spec = preprocess_POS_CASH_balance(file_directory=raw_directory, aggregation_spec={'*': ['max']}).main()
+    assert 'POS_SK_DPD_MAX' in other_spec and 'POS_SK_DPD' not in other_spec
+
+    file_path = raw_directory + 'POS_CASH_balance.csv'
+    table = pd.read_csv(file_path)
+    table['SK_DPD'] += 1
+    table.to_csv(file_path, index=False)
+    changed_input = preprocess_POS_CASH_balance(file_directory=raw_directory).main()
+    expected = preprocess_POS_CASH_balance(file_directory=raw_directory, stage_cache=False).main()
+    pd.testing.assert_frame_equal(changed_input, expected)
+
+
+def test_eviction_by_age_then_size(raw_directory):
+    directory = raw_directory + 'stage_cache'
+    preprocess_POS_CASH_balance(file_directory=raw_directory).main()
+    preprocess_POS_CASH_balance(file_directory=raw_directory, aggregation_spec={'*': ['max']}).main()
+    preprocess_POS_CASH_balance(file_directory=raw_directory, aggregation_spec={'*': ['min']}).main()
+    entries = sorted(StageCache(directory).entries(), key=lambda entry: entry[1]['last_used'])
+    assert len(entries) == 3
+
+    # The first entry was last used 40 days ago
+    stale_directory, stale_manifest = entries[0]
+    stale_manifest['last_used'] = time.time() - 40 * 24 * 3600
+    pd.Series(stale_manifest).to_json(os.path.join(stale_directory, 'manifest.json'))
+    assert StageCache(directory, max_age_days=30, max_size_mb=None).evict() == [stale_directory]
+
+    # Room for a single entry: the least recently used one goes
+    size_mb = entries[2][1]['size'] / 1024**2
+    assert StageCache(directory, max_age_days=None, max_size_mb=size_mb).evict() == [entries[1][0]]
+    assert [entry for entry, _ in StageCache(directory).entries()] == [entries[2][0]]
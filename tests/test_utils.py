@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.utils import reduce_memory_usage
+
+
+def test_reduce_memory_usage_picks_smallest_dtypes():
+    df = pd.DataFrame(
+        {
+            'SMALL_INT': [1, -5, 100],
+            'NAME': ['a', 'b', 'c'],
+            'INT16': [0, 127, -300],
+            'INT32': [0, 40000, 1],
+            'FLAG': [True, False, True],
+            'UINT': np.array([0, 1, 2], dtype=np.uint8),
+            'HALF': [0.5, np.nan, 1.5],
+            'SINGLE': [1e5, 0.0, np.nan],
+            'ALL_NAN': [np.nan, np.nan, np.nan],
+            'CATEGORY': pd.Categorical(['x', 'y', 'x']),
+        },
+        index=[10, 20, 30],
+    )
+    original = df.copy()
+
+    reduced = reduce_memory_usage(df)
+
+    assert reduced.dtypes.to_dict() == {
+        'SMALL_INT': np.int8,
+        'NAME': object,
+        'INT16': np.int16,
+        'INT32': np.int32,
+        'FLAG': np.float16,
+        'UINT': np.float16,
+        'HALF': np.float16,
+        'SINGLE': np.float32,
+        'ALL_NAN': np.float64,
+        'CATEGORY': 'category',
+    }
+    assert list(reduced.index) == [10, 20, 30]
+    pd.testing.assert_frame_equal(reduced.astype(original.dtypes), original)
+    pd.testing.assert_frame_equal(df, original)
+
+
+def test_reduce_memory_usage_compute_policy_keeps_float32():
+    df = pd.DataFrame({'HALF': [0.5, np.nan, 1.5], 'WIDE': [1e300, 0.0, 1.0], 'SMALL_INT': [1, 2, 3]})
+
+    reduced = reduce_memory_usage(df, policy='compute')
+
+    assert reduced.dtypes.to_dict() == {'HALF': np.float32, 'WIDE': np.float64, 'SMALL_INT': np.int8}